@@ -216,9 +216,9 @@ class BMCS(oo.MCS):
         self.flush()
         self._buffered = enable
 
-    def update(self):
-        # handle any incoming packets
-        packet = async.receive_next_packet(self.system_index)
+    def update(self, timeout=0):
+        # handle any incoming packets, waiting up to timeout [ms] for one
+        packet = async.receive_next_packet(self.system_index, int(timeout))
         #self.flush()
         # update all packet states
         self.handler.digest(packet)
@@ -267,6 +267,19 @@ class BMCS(oo.MCS):
             self.system_index, channel_index, diff, hold_time)
         self.handler.request(async.SA_COMPLETED_PACKET_TYPE, channel_index)
 
+    @bset
+    def move(self, channel_indices, positions, relative=False, hold_time=0):
+        """Move several channels, all commands are sent in one flush"""
+        if self.moving(channel_indices):
+            raise raw.SmaractError("Attempt to move when moving")
+        if relative:
+            f = async.go_to_position_relative
+        else:
+            f = async.go_to_position_absolute
+        for (ci, p) in zip(channel_indices, positions):
+            f(self.system_index, ci, p, hold_time)
+            self.handler.request(async.SA_COMPLETED_PACKET_TYPE, ci)
+
     @bset
     def move_open_loop(
             self, channel_index, steps, amplitude=4092, frequency=1000):
@@ -285,22 +298,27 @@ class BMCS(oo.MCS):
             async.stop(self.system_index, channel_index)
 
     def moving(self, channel_index=None, update=True):
-        if channel_index is None:
-            return any(self.moving(i, update) for i in self._channels)
         if update:
             self.update()
+        if channel_index is None:
+            channel_index = self._channels
+        if isinstance(channel_index, (list, tuple)):
+            return any(self.moving(i, False) for i in channel_index)
         return (
             self.handler.count(
                 async.SA_COMPLETED_PACKET_TYPE, channel_index)
             != 0)
 
-    def wait(self, channel_index=None, timeout=10):
-        # wait till done moving
+    def wait(self, channel_index=None, timeout=10, pause=0.1):
+        # wait till done moving, blocking on the packet stream (for up to
+        # pause seconds at a time) instead of spinning
         t0 = time.time()
-        while self.moving(channel_index, update=True):
-            if time.time() - t0 > timeout:
+        while self.moving(channel_index, update=False):
+            left = timeout - (time.time() - t0)
+            if left <= 0:
                 raise raw.SmaractError(
                     "wait exceeded timeout: %s" % timeout)
+            self.update(min(left, pause) * 1000)
 
     # -------------- configuration -------------
     @bset
@@ -344,6 +362,13 @@ class BMCS(oo.MCS):
     def get_position(self, channel_index):
         self.poll_position(channel_index)
 
+    def get_positions(self, channel_indices):
+        """Poll several channels in one flush"""
+        for ci in channel_indices:
+            self.poll_position(ci, flush=False)
+        self.flush()
+        return [self.last_position(ci) for ci in channel_indices]
+
     @bset
     def poll_status(self, channel_index):
         async.get_status(self.system_index, channel_index)
@@ -494,7 +519,7 @@ class FakeBMCS(oo.FakeMCS):
     def buffered_output(self, enable):
         pass
 
-    def update(self):
+    def update(self, timeout=0):
         pass
 
     def flush(self):
@@ -530,6 +555,9 @@ class FakeBMCS(oo.FakeMCS):
     def get_position(self, ci, **kwargs):
         return self._position[ci]
 
+    def get_positions(self, cis, **kwargs):
+        return [self._position[ci] for ci in cis]
+
     def poll_status(self, ci, **kwargs):
         pass
 
@@ -622,3 +650,10 @@ class FakeBMCS(oo.FakeMCS):
             self._position[i] = p
         else:
             self._position[i] = max(mi, min(p, ma))
+
+    def move(self, cis, ps, relative=False, hold_time=0, **kwargs):
+        for (i, p) in zip(cis, ps):
+            if relative:
+                self.move_relative(i, p)
+            else:
+                self.move_absolute(i, p)
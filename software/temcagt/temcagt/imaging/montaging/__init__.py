@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 
 
+from . import index
+from . import journal
 from . import planning
 from . import roi
+from . import settle
 
-__all__ = ['planning', 'roi']
+__all__ = ['index', 'journal', 'planning', 'roi', 'settle']
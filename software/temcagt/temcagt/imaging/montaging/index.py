@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Index of montage sessions by roi and montage id
+
+Each session records its directory, tile journal (see journal) and the
+session it resumed (if any). Completed (by default not vetoed) tiles
+(with their saved paths) are read back from the journals of a session
+and the sessions it resumed so an aborted montage can be resumed by
+re-planning only the missing tiles (see missing_indices).
+
+The index is a json file:
+    {roi key: {montage id: session, ...}, ...}
+"""
+
+import hashlib
+import json
+import os
+import time
+
+from ... import config
+from ... import log
+from . import journal
+
+
+logger = log.get_logger(__name__)
+
+# montage config keys that do not change which tiles are planned
+unplanned_keys = ('order', 'filter_method')
+
+
+def roi_key(mcfg):
+    """Key for a montage config (roi and tiling)"""
+    d = dict([(k, mcfg[k]) for k in mcfg if k not in unplanned_keys])
+    s = json.dumps(d, sort_keys=True, cls=config.parser.NumpyAwareParser)
+    return hashlib.md5(s).hexdigest()[:16]
+
+
+class SessionIndex(object):
+    def __init__(self, fn):
+        self.fn = os.path.expanduser(fn)
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.fn):
+            with open(self.fn, 'r') as f:
+                self.rois = json.load(f)
+        else:
+            self.rois = {}
+
+    def save(self):
+        d = os.path.dirname(self.fn)
+        if d != '' and not os.path.exists(d):
+            os.makedirs(d)
+        tmp_fn = self.fn + '.tmp'
+        with open(tmp_fn, 'w') as f:
+            json.dump(
+                self.rois, f, indent=1, cls=config.parser.NumpyAwareParser)
+        os.rename(tmp_fn, self.fn)
+
+    def add_session(
+            self, key, montage_id, directory, journal_fn, n_tiles,
+            resumes=None):
+        self.load()
+        self.rois.setdefault(key, {})[montage_id] = {
+            'id': montage_id,
+            'directory': directory,
+            'journal': journal_fn,
+            'n_tiles': n_tiles,
+            'start': time.time(),
+            'finished': False,
+            'resumes': resumes,
+        }
+        if resumes is not None:
+            self.rois[key][resumes]['resumed_by'] = montage_id
+        self.save()
+
+    def finish_session(self, key, montage_id, **kwargs):
+        self.load()
+        s = self.rois[key][montage_id]
+        s['finished'] = True
+        s['finish'] = time.time()
+        s.update(kwargs)
+        self.save()
+
+    def sessions(self, key):
+        """Sessions for a roi key, oldest first"""
+        return sorted(
+            self.rois.get(key, {}).values(), key=lambda s: s['start'])
+
+    def session(self, key, montage_id=None):
+        """Find a session, defaults to the latest unfinished session
+
+        Sessions that were already resumed are not considered
+        """
+        if montage_id is not None:
+            if montage_id not in self.rois.get(key, {}):
+                raise KeyError(
+                    "Unknown montage %s for roi %s" % (montage_id, key))
+            return self.rois[key][montage_id]
+        unfinished = [
+            s for s in self.sessions(key)
+            if not (s['finished'] or s.get('resumed_by', None))]
+        if not len(unfinished):
+            raise KeyError("No unfinished montage for roi %s" % key)
+        return unfinished[-1]
+
+    def chain(self, key, montage_id):
+        """A session and all the sessions it resumed, oldest first"""
+        sessions = []
+        while montage_id is not None:
+            s = self.rois[key][montage_id]
+            if s in sessions:
+                raise ValueError("Resume loop at %s" % montage_id)
+            sessions.insert(0, s)
+            montage_id = s['resumes']
+        return sessions
+
+    def journals(self, key, montage_id):
+        return [
+            s['journal'] for s in self.chain(key, montage_id)
+            if os.path.exists(s['journal'])]
+
+    def completed_tiles(self, key, montage_id, include_vetoed=False):
+        """Completed tiles of a session (and those it resumed)
+
+        Vetoed tiles are not completed unless include_vetoed is True.
+        Returns {(row, col): tile}, later tiles replace earlier ones
+        """
+        tiles = {}
+        for fn in self.journals(key, montage_id):
+            for t in journal.read_journal(fn):
+                if t.get('vetoed', False) and not include_vetoed:
+                    continue
+                tiles[(t['meta']['row'], t['meta']['col'])] = t
+        return tiles
+
+
+def missing_indices(pts, completed):
+    """Indices of points (x, y, r, c) without a completed (row, col) tile"""
+    return [
+        i for (i, p) in enumerate(pts) if (p[2], p[3]) not in completed]
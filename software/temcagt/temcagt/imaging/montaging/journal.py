@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Append only (line delimited json) tile journal
+
+Each tile is written (and flushed) as one line as soon as it is done so
+the journal can be tailed while a montage runs (see tail_journal). The
+file is fsync'd every sync_every tiles or sync_interval seconds. At the
+end of a montage the journal is compacted to the _tiles.json format
+(a json list of tiles, see compact, with only the last tile for each
+row and column).
+
+A crash can leave a partial last line, this is skipped on reading.
+"""
+
+import json
+import os
+import time
+
+from ... import config
+from ... import log
+
+
+logger = log.get_logger(__name__)
+
+
+class TileJournal(object):
+    def __init__(self, fn, sync_every=16, sync_interval=5.0):
+        self.fn = os.path.expanduser(fn)
+        d = os.path.dirname(self.fn)
+        if d != '' and not os.path.exists(d):
+            os.makedirs(d)
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.n = 0
+        self.n_unsynced = 0
+        self.last_sync = time.time()
+        self.file = open(self.fn, 'a')
+
+    def __del__(self):
+        self.close()
+
+    def write(self, tile):
+        self.file.write(
+            json.dumps(tile, cls=config.parser.NumpyAwareParser) + '\n')
+        self.file.flush()
+        self.n += 1
+        self.n_unsynced += 1
+        if (
+                self.n_unsynced >= self.sync_every or
+                time.time() - self.last_sync >= self.sync_interval):
+            self.sync()
+
+    def sync(self):
+        if self.file is None or self.file.closed:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.n_unsynced = 0
+        self.last_sync = time.time()
+
+    def close(self):
+        if getattr(self, 'file', None) is None or self.file.closed:
+            return
+        self.sync()
+        self.file.close()
+
+
+def read_journal(fn):
+    """Yield tiles from a journal, skipping a partial or corrupt line"""
+    with open(os.path.expanduser(fn), 'r') as f:
+        for (i, l) in enumerate(f):
+            if not l.endswith('\n'):
+                logger.warning(
+                    "read_journal skipping partial line %i in %s", i, fn)
+                return
+            try:
+                yield json.loads(l)
+            except ValueError as e:
+                logger.warning(
+                    "read_journal skipping line %i in %s: %s", i, fn, e)
+
+
+def tail_journal(fn, poll=0.5, stop=None):
+    """Yield tiles as they are appended to a journal
+
+    Stops when stop() returns True (checked while waiting for tiles)
+    """
+    fn = os.path.expanduser(fn)
+    while not os.path.exists(fn):
+        if stop is not None and stop():
+            return
+        time.sleep(poll)
+    with open(fn, 'r') as f:
+        buf = ''
+        while True:
+            l = f.readline()
+            if l == '':
+                if stop is not None and stop():
+                    return
+                time.sleep(poll)
+                continue
+            buf += l
+            if not buf.endswith('\n'):
+                # partially written, wait for the rest
+                continue
+            l, buf = buf, ''
+            try:
+                yield json.loads(l)
+            except ValueError as e:
+                logger.warning("tail_journal skipping line in %s: %s", fn, e)
+
+
+def tile_key(tile):
+    return (tile['meta']['row'], tile['meta']['col'])
+
+
+def compact(journal_fn, tiles_fn=None):
+    """Write a journal as a _tiles.json list, returns (tiles_fn, n)
+
+    journal_fn can be a list of journals (from resumed montages) to
+    combine, tiles_fn defaults to the (last) journal_fn with .json.
+    Only the last tile for each (row, col) is kept (a re-imaged tile
+    replaces an earlier one). Tiles are streamed (the first pass only
+    records where the last tile for each key is) so the full list is
+    never held in memory
+    """
+    if isinstance(journal_fn, (str, unicode)):
+        journal_fn = [journal_fn, ]
+    if tiles_fn is None:
+        tiles_fn = os.path.splitext(journal_fn[-1])[0] + '.json'
+    last = {}
+    for (ji, fn) in enumerate(journal_fn):
+        for (ti, tile) in enumerate(read_journal(fn)):
+            last[tile_key(tile)] = (ji, ti)
+    tmp_fn = tiles_fn + '.tmp'
+    n = 0
+    with open(tmp_fn, 'w') as f:
+        f.write('[')
+        for (ji, fn) in enumerate(journal_fn):
+            for (ti, tile) in enumerate(read_journal(fn)):
+                if last[tile_key(tile)] != (ji, ti):
+                    # replaced by a later tile
+                    continue
+                if n:
+                    f.write(', ')
+                json.dump(tile, f, cls=config.parser.NumpyAwareParser)
+                n += 1
+        f.write(']')
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_fn, tiles_fn)
+    logger.info("Compacted %i tiles from %s to %s", n, journal_fn, tiles_fn)
+    return tiles_fn, n
+
+
+def load_tiles(fn):
+    """Load tiles from a _tiles.json or a journal (.jsonl)"""
+    if os.path.splitext(fn)[1] == '.jsonl':
+        return list(read_journal(fn))
+    return config.parser.load(fn)
@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 
+import time
+
 import numpy
-from shapely.geometry import Polygon
+from shapely.geometry import Polygon, box
+from shapely.prepared import prep
+from shapely.strtree import STRtree
 
 from ... import log
 
@@ -15,6 +19,96 @@ def intersect(tpts,rpts):
     rpoly = Polygon(rpts)
     return tpoly.intersects(rpoly)
 
+
+def points_in_polygon(xs, ys, rpts):
+    """Vectorized (even-odd) ray casting test of points in a polygon"""
+    xs = numpy.asarray(xs, dtype='f8')[:, numpy.newaxis]
+    ys = numpy.asarray(ys, dtype='f8')[:, numpy.newaxis]
+    rpts = numpy.asarray(rpts, dtype='f8')
+    x0, y0 = rpts[:, 0], rpts[:, 1]
+    x1, y1 = numpy.roll(x0, -1), numpy.roll(y0, -1)
+    crosses = (y0 > ys) != (y1 > ys)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        xi = x0 + (ys - y0) * (x1 - x0) / (y1 - y0)
+    return ((crosses & (xs < xi)).sum(axis=1) % 2) == 1
+
+
+def segments_intersect_rects(ls, rs, ts, bs, rpts):
+    """Test if any polygon edge touches each rect (Liang-Barsky)"""
+    ls, rs, ts, bs = [
+        numpy.asarray(v, dtype='f8')[:, numpy.newaxis]
+        for v in (ls, rs, ts, bs)]
+    rpts = numpy.asarray(rpts, dtype='f8')
+    x0, y0 = rpts[:, 0], rpts[:, 1]
+    dx = numpy.roll(x0, -1) - x0
+    dy = numpy.roll(y0, -1) - y0
+    u0 = numpy.zeros((len(ls), len(rpts)))
+    u1 = numpy.ones_like(u0)
+    ok = numpy.ones(u0.shape, dtype=bool)
+    for (p, q) in ((-dx, x0 - ls), (dx, rs - x0), (-dy, y0 - ts),
+                   (dy, bs - y0)):
+        p = numpy.broadcast_to(p, u0.shape)
+        q = numpy.broadcast_to(q, u0.shape)
+        parallel = p == 0
+        ok &= ~(parallel & (q < 0))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            u = q / p
+        u0 = numpy.where(~parallel & (p < 0), numpy.maximum(u0, u), u0)
+        u1 = numpy.where(~parallel & (p > 0), numpy.minimum(u1, u), u1)
+    return (ok & (u0 <= u1)).any(axis=1)
+
+
+def _numpy_tile_mask(ls, rs, ts, bs, rpts, chunk_size=4096):
+    mask = numpy.zeros(len(ls), dtype=bool)
+    # only test tiles that overlap the roi bounding box
+    rl, rt = rpts.min(axis=0)
+    rr, rb = rpts.max(axis=0)
+    inds = numpy.where((ls <= rr) & (rs >= rl) & (ts <= rb) & (bs >= rt))[0]
+    for i in xrange(0, len(inds), chunk_size):
+        ci = inds[i:i + chunk_size]
+        l, r, t, b = ls[ci], rs[ci], ts[ci], bs[ci]
+        # an edge touches the tile or the tile is inside the polygon
+        m = segments_intersect_rects(l, r, t, b, rpts)
+        u = ~m
+        if u.any():
+            m[u] = points_in_polygon(l[u], t[u], rpts)
+        mask[ci] = m
+    return mask
+
+
+def _shapely_tile_mask(ls, rs, ts, bs, rpts):
+    rpoly = Polygon(rpts)
+    prpoly = prep(rpoly)
+    boxes = [box(*b) for b in zip(ls, ts, rs, bs)]
+    indices = dict([(id(b), i) for (i, b) in enumerate(boxes)])
+    mask = numpy.zeros(len(ls), dtype=bool)
+    for b in STRtree(boxes).query(rpoly):
+        if prpoly.intersects(b):
+            mask[indices[id(b)]] = True
+    return mask
+
+
+def tile_mask(pts, fov, rpts, method='numpy'):
+    """Return a bool array, True for tiles (points) that touch the roi
+
+    pts : tile centers (x, y, ...), tiles are fov (width, height)
+    rpts : roi polygon vertices
+    method : 'numpy' (vectorized edge and ray casting tests) or
+        'shapely' (STRtree query + prepared geometry)
+    """
+    if not len(pts):
+        return numpy.zeros(0, dtype=bool)
+    a = numpy.asarray([p[:2] for p in pts], dtype='f8')
+    rpts = numpy.asarray(rpts, dtype='f8')
+    hxfov, hyfov = fov[0] / 2., fov[1] / 2.
+    ls, rs = a[:, 0] - hxfov, a[:, 0] + hxfov
+    ts, bs = a[:, 1] - hyfov, a[:, 1] + hyfov
+    if method == 'shapely':
+        return _shapely_tile_mask(ls, rs, ts, bs, rpts)
+    elif method == 'numpy':
+        return _numpy_tile_mask(ls, rs, ts, bs, rpts)
+    raise ValueError("Invalid tile mask method: %s" % method)
+
 def calculate_coordinates(cfg):
     logger.info("calculate_coordinates %s", cfg)
     bbpts = {
@@ -24,30 +118,128 @@ def calculate_coordinates(cfg):
     }[cfg['method']](cfg)
     # return bounding box if rectangular roi
     if cfg.get('vertices',None) is None:
-        return bbpts
+        return order_points(bbpts, cfg.get('order', None))
     # if use_vertices flag set to flase then also return bbpts
     if cfg.get('use_vertices',True) is False:
-        return bbpts
+        return order_points(bbpts, cfg.get('order', None))
     # otherwise remove tiles not in the roi
     # vertices are normalized, so we turn them into real coordsinates here
     rpts  = numpy.array(cfg['vertices']) * \
             numpy.array([cfg['width'],cfg['height']]) + \
             numpy.array([cfg['left'],cfg['top']])
-    xfov, yfov = cfg['fov']
-    hxfov = xfov / 2.
-    hyfov = yfov / 2.
-    npts = [] 
-    for p in bbpts:
-        x, y, _, _ = p
-        l = x - hxfov
-        r = x + hxfov
-        t = y - hyfov
-        b = y + hyfov
-        tpts = numpy.array([[l, t], [r, t], [r, b], [l, b]])
-        if intersect(tpts, rpts):
-            npts.append(p)
-    return npts
+    mask = tile_mask(
+        bbpts, cfg['fov'], rpts, cfg.get('filter_method', 'numpy'))
+    return order_points(
+        [p for (p, m) in zip(bbpts, mask) if m], cfg.get('order', None))
+
+
 
+def move_times(pts, speed, settle, eps=1e-6):
+    """Predicted time of each move between consecutive points
+
+    speed : (x, y) stage speed (units per second)
+    settle : (x, y) settle time after moving each axis, a move of
+        both axes settles for the larger of the two
+    """
+    a = numpy.asarray([p[:2] for p in pts], dtype='f8')
+    if len(a) < 2:
+        return numpy.zeros(0)
+    d = numpy.abs(numpy.diff(a, axis=0))
+    return _move_cost(d[:, 0], d[:, 1], speed, settle, eps)
+
+
+def _move_cost(dx, dy, speed, settle, eps=1e-6):
+    t = numpy.maximum(dx / float(speed[0]), dy / float(speed[1]))
+    mx, my = dx > eps, dy > eps
+    s = numpy.where(
+        mx & my, max(settle), numpy.where(
+            mx, settle[0], numpy.where(my, settle[1], 0.)))
+    return t + s
+
+
+def predict_duration(pts, speed, settle, grab_time=0.):
+    """Predicted montage time (moves + settles + grabs) for an ordering"""
+    return float(move_times(pts, speed, settle).sum() + grab_time * len(pts))
+
+
+def _nearest_neighbour_order(a, speed, settle):
+    n = len(a)
+    order = numpy.empty(n, dtype='i8')
+    left = numpy.ones(n, dtype=bool)
+    i = 0
+    for k in xrange(n):
+        order[k] = i
+        left[i] = False
+        if k == n - 1:
+            break
+        inds = numpy.where(left)[0]
+        d = numpy.abs(a[inds] - a[i])
+        i = inds[numpy.argmin(
+            _move_cost(d[:, 0], d[:, 1], speed, settle))]
+    return order
+
+
+def _two_opt(a, order, speed, settle, deadline):
+    """Improve an open path (first point fixed) by 2-opt moves"""
+    n = len(order)
+    improved = True
+    while improved and time.time() < deadline:
+        improved = False
+        for i in xrange(n - 2):
+            if time.time() > deadline:
+                break
+            # gain of reversing order[i + 1:j + 1] for every j > i + 1
+            # edges (i, i + 1) and (j, j + 1) become (i, j), (i + 1, j + 1)
+            js = numpy.arange(i + 2, n)
+            ii = numpy.repeat(i, len(js))
+            delta = (
+                _pair_cost(a, order, ii, js, speed, settle) -
+                _pair_cost(a, order, ii[:1], ii[:1] + 1, speed, settle))
+            jn = js[:-1]
+            delta[:-1] += (
+                _pair_cost(a, order, ii[:-1] + 1, jn + 1, speed, settle) -
+                _pair_cost(a, order, jn, jn + 1, speed, settle))
+            j = numpy.argmin(delta)
+            if delta[j] < -1e-9:
+                j = js[j]
+                order[i + 1:j + 1] = order[i + 1:j + 1][::-1].copy()
+                improved = True
+    return order
+
+
+def _pair_cost(a, order, i, j, speed, settle):
+    d = numpy.abs(a[order[i]] - a[order[j]])
+    return _move_cost(d[:, 0], d[:, 1], speed, settle)
+
+
+def order_points(pts, cfg=None):
+    """Reorder points to minimize predicted move + settle time
+
+    cfg (montage 'order' config)
+        method : 'plan' (keep the planned order) or 'optimize'
+            (nearest neighbour start improved with 2-opt)
+        speed : (x, y) stage speed
+        settle : (x, y) settle times
+        time_limit : seconds to spend improving the order
+    """
+    if cfg is None or cfg.get('method', 'plan') == 'plan' or len(pts) < 3:
+        return pts
+    if cfg['method'] != 'optimize':
+        raise ValueError("Invalid ordering method: %s" % cfg['method'])
+    speed, settle = cfg['speed'], cfg['settle']
+    deadline = time.time() + cfg.get('time_limit', 1.0)
+    a = numpy.asarray([p[:2] for p in pts], dtype='f8')
+    order = _nearest_neighbour_order(a, speed, settle)
+    order = _two_opt(a, order, speed, settle, deadline)
+    opts = [pts[i] for i in order]
+    t0 = predict_duration(pts, speed, settle)
+    t1 = predict_duration(opts, speed, settle)
+    logger.info(
+        "order_points predicted move time: plan %.1f s, optimized %.1f s",
+        t0, t1)
+    if t1 >= t0:
+        return pts
+    return opts
 
 
 def skip_points(points, skip):
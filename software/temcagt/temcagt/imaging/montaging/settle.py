@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Predict stage settle time from move distance and direction
+
+After a move the stage drifts and the drift decays roughly as:
+    drift = A * distance * exp(-t / tau)
+so the time to settle below a drift tolerance is:
+    t = tau * log(A * distance / tolerance)
+A and tau are fit (per axis and direction) by least squares on
+    log(drift / distance) = log(A) - t / tau
+from (distance, settle time, measured drift) samples. Drift is the
+largest shift measured between frames of the grab after the settle.
+
+Until an axis/direction has min_samples samples the fixed (fallback)
+settle time for that axis is used. tau can only be fit if the settle
+times vary (by at least min_spread), until then tau is assumed to be
+fallback / decays (so only A is fit).
+"""
+
+import numpy
+
+from ... import log
+
+
+logger = log.get_logger(__name__)
+
+
+def direction_key(axis, d):
+    return '%s%s' % (axis, '+' if d >= 0 else '-')
+
+
+class SettleModel(object):
+    """
+    fallback : (x, y) settle times used before enough samples
+    tolerance : acceptable drift (same units as measured drift)
+    min_settle, max_settle : clip predictions to this range
+    min_samples : samples needed (per axis/direction) to predict
+    min_drift : drifts are clipped to at least this (for the log)
+    min_spread : settle time standard deviation needed to fit tau
+    decays : prior tau is fallback / decays
+    """
+    def __init__(
+            self, fallback, tolerance=1.0, min_settle=0.0, max_settle=1.0,
+            min_samples=10, min_drift=0.1, min_spread=0.001, decays=3.):
+        self.fallback = {'x': float(fallback[0]), 'y': float(fallback[1])}
+        self.tolerance = float(tolerance)
+        self.min_settle = float(min_settle)
+        self.max_settle = float(max_settle)
+        self.min_samples = int(min_samples)
+        self.min_drift = float(min_drift)
+        self.min_spread = float(min_spread)
+        self.decays = float(decays)
+        self.clear()
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Build from a montager settling_time config"""
+        mcfg = cfg.get('model', {})
+        m = cls(
+            (cfg['x'], cfg['y']),
+            tolerance=mcfg.get('tolerance', 1.0),
+            min_settle=mcfg.get('min', 0.0),
+            max_settle=mcfg.get('max', 1.0),
+            min_samples=mcfg.get('min_samples', 10))
+        if 'state' in mcfg:
+            m.set_state(mcfg['state'])
+        return m
+
+    def clear(self):
+        # least squares sums per key: n, t, y, tt, ty
+        self.sums = {}
+
+    def get_state(self):
+        return dict([(k, list(v)) for (k, v) in self.sums.items()])
+
+    def set_state(self, state):
+        self.sums = dict([
+            (k, numpy.array(v, dtype='f8')) for (k, v) in state.items()])
+
+    def add_sample(self, axis, distance, settle, drift):
+        """Add one sample for a single axis move"""
+        d = abs(distance)
+        if d == 0:
+            return
+        k = direction_key(axis, distance)
+        y = numpy.log(max(drift, self.min_drift) / d)
+        s = self.sums.setdefault(k, numpy.zeros(5, dtype='f8'))
+        s += [1., settle, y, settle * settle, settle * y]
+
+    def update(self, dx, dy, settle, drift):
+        """Refine the model with a measured drift after a move"""
+        if settle is None or drift is None:
+            return
+        self.add_sample('x', dx, settle, drift)
+        self.add_sample('y', dy, settle, drift)
+
+    def fit(self, records):
+        """Add samples from records of (dx, dy, settle, drift)"""
+        for r in records:
+            self.update(*r)
+
+    def parameters(self, key):
+        """Return (log(A), tau) for a key or None if not fit"""
+        s = self.sums.get(key, None)
+        if s is None or s[0] < self.min_samples:
+            return None
+        n, st, sy, stt, sty = s
+        den = n * stt - st * st
+        if den > (n * self.min_spread) ** 2:
+            slope = (n * sty - st * sy) / den
+            if slope < 0:
+                return (sy - slope * st) / n, -1. / slope
+        # settle times don't vary (or drift is not decaying), use prior tau
+        tau = self.fallback[key[0]] / self.decays
+        if tau <= 0:
+            return None
+        return (sy + st / tau) / n, tau
+
+    def predict_axis(self, axis, distance):
+        if distance == 0:
+            return 0.
+        p = self.parameters(direction_key(axis, distance))
+        if p is None:
+            return self.fallback[axis]
+        la, tau = p
+        t = tau * (la + numpy.log(abs(distance) / self.tolerance))
+        return float(numpy.clip(t, self.min_settle, self.max_settle))
+
+    def predict(self, dx, dy):
+        """Settle time for a move of (dx, dy), None if no move"""
+        ts = [
+            self.predict_axis(a, d) for (a, d) in (('x', dx), ('y', dy))
+            if d != 0]
+        if not len(ts):
+            return None
+        return max(ts)
+
+
+def records_from_tiles(tiles):
+    """Extract (dx, dy, settle, drift) records from montage tiles"""
+    records = []
+    for t in tiles:
+        m = t.get('meta', {})
+        if 'move' not in m or t.get('drift', None) is None:
+            continue
+        if m.get('settle', None) is None:
+            continue
+        records.append((m['move'][0], m['move'][1], m['settle'], t['drift']))
+    return records
@@ -1,8 +1,17 @@
 #!/usr/bin/env python
 
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
+import numpy
+
+from . import index
+from . import journal
 from . import planning
+from . import settle
 
 
 class PlanningTest(unittest.TestCase):
@@ -36,8 +45,189 @@ class PlanningTest(unittest.TestCase):
         cr = planning.calculate_coordinates(d)
         self.assertEqual(gr, cr)
 
+    def tile_mask(self):
+        # L shaped roi
+        rpts = [[0, 0], [30, 0], [30, 10], [10, 10], [10, 30], [0, 30]]
+        pts = [
+            (x, y, 0, 0) for y in numpy.arange(-10, 45, 4.)
+            for x in numpy.arange(-10, 45, 4.)]
+        t = []
+        for (x, y, _, _) in pts:
+            t.append(planning.intersect([
+                [x - 2, y - 2], [x + 2, y - 2],
+                [x + 2, y + 2], [x - 2, y + 2]], rpts))
+        for method in ('numpy', 'shapely'):
+            m = planning.tile_mask(pts, (4, 4), rpts, method)
+            self.assertEqual(list(m), t)
+        with self.assertRaises(ValueError):
+            planning.tile_mask(pts, (4, 4), rpts, 'error')
+
+    def order_points(self):
+        rs = numpy.random.RandomState(0)
+        pts = [(x, y, 0, 0) for (x, y) in rs.rand(50, 2) * 100]
+        cfg = {
+            'method': 'optimize', 'speed': (10., 10.),
+            'settle': (0.1, 0.3), 'time_limit': 5.0}
+        opts = planning.order_points(pts, cfg)
+        self.assertEqual(sorted(opts), sorted(pts))
+        self.assertEqual(opts[0], pts[0])
+        self.assertLess(
+            planning.predict_duration(opts, cfg['speed'], cfg['settle']),
+            planning.predict_duration(pts, cfg['speed'], cfg['settle']))
+        # settle only for moved axes
+        t = planning.move_times(
+            [(0, 0), (10, 0), (10, 10), (0, 0)], (10., 5.), (0.1, 0.3))
+        self.assertTrue(numpy.allclose(t, [1.1, 2.3, 2.3]))
+        self.assertIs(planning.order_points(pts, {'method': 'plan'}), pts)
+
+
+class SettleTest(unittest.TestCase):
+    def settle_model(self):
+        m = settle.SettleModel(
+            (0.08, 0.3), tolerance=1.0, max_settle=2.0, min_samples=5)
+        # not enough samples, use fallback
+        self.assertEqual(m.predict(10., 0.), 0.08)
+        self.assertEqual(m.predict(10., -10.), 0.3)
+        self.assertIsNone(m.predict(0., 0.))
+        # constant settle times, only A is fit (tau = fallback / decays)
+        for i in xrange(5):
+            m.update(0., -100., 0.3, 10.)
+        la, tau = m.parameters('y-')
+        self.assertAlmostEqual(tau, 0.1)
+        self.assertAlmostEqual(la, numpy.log(0.1) + 3.)
+        # drift = 0.5 * d * exp(-t / 0.1)
+        for d in (100., 1000., 10000.):
+            for t in (0.1, 0.2, 0.4):
+                m.update(d, 0, t, 0.5 * d * numpy.exp(-t / 0.1))
+        la, tau = m.parameters('x+')
+        self.assertAlmostEqual(tau, 0.1)
+        self.assertAlmostEqual(la, numpy.log(0.5))
+        t = m.predict(1000., 0.)
+        self.assertAlmostEqual(t, 0.1 * numpy.log(0.5 * 1000.))
+        # longer moves settle longer, other directions use fallback
+        self.assertLess(m.predict(100., 0.), m.predict(10000., 0.))
+        self.assertEqual(m.predict(-1000., 0.), 0.08)
+        self.assertEqual(m.predict(1000., 1.), max(t, 0.3))
+        # state round trip
+        m2 = settle.SettleModel((0.08, 0.3), min_samples=5, max_settle=2.0)
+        m2.set_state(m.get_state())
+        self.assertAlmostEqual(m2.predict(1000., 0.), t)
+        # fit from tiles
+        tiles = [
+            {'meta': {'move': [1000., 0], 'settle': 0.1}, 'drift': 1.},
+            {'meta': {'move': [1000., 0], 'settle': 0.1}, 'drift': None},
+            {'meta': {'settle': 0.1}, 'drift': 1.}]
+        self.assertEqual(
+            settle.records_from_tiles(tiles), [(1000., 0, 0.1, 1.)])
+
+
+class JournalTest(unittest.TestCase):
+    def journal(self):
+        d = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(d, 'm_tiles.jsonl')
+            tiles = [
+                {'meta': {'loc': i, 'row': 0, 'col': i, 'x': numpy.float64(i)},
+                 'vetoed': False}
+                for i in xrange(5)]
+            j = journal.TileJournal(fn, sync_every=2)
+            for t in tiles:
+                j.write(t)
+            self.assertEqual(j.n, 5)
+            self.assertEqual(j.n_unsynced, 1)
+            # readable before close
+            self.assertEqual(list(journal.read_journal(fn)), tiles)
+            j.close()
+            # a crash can leave a partial line
+            with open(fn, 'a') as f:
+                f.write('{"meta": {"lo')
+            self.assertEqual(list(journal.read_journal(fn)), tiles)
+            self.assertEqual(journal.load_tiles(fn), tiles)
+            # tail stops when asked
+            tailed = []
+            for t in journal.tail_journal(
+                    fn, poll=0.01, stop=lambda: len(tailed) == 5):
+                tailed.append(t)
+            self.assertEqual(tailed, tiles)
+            # compact to the _tiles.json format
+            tfn, n = journal.compact(fn)
+            self.assertEqual(tfn, os.path.join(d, 'm_tiles.json'))
+            self.assertEqual(n, 5)
+            with open(tfn, 'r') as f:
+                self.assertEqual(json.load(f), tiles)
+            self.assertEqual(journal.load_tiles(tfn), tiles)
+        finally:
+            shutil.rmtree(d)
+
+
+class IndexTest(unittest.TestCase):
+    def session_index(self):
+        d = tempfile.mkdtemp()
+        try:
+            mcfg = {'roi': {'center': [0, 0]}, 'order': {'method': 'plan'}}
+            key = index.roi_key(mcfg)
+            # planning order does not change the key
+            mcfg2 = {'roi': {'center': [0, 0]}, 'order': {'method': 'x'}}
+            self.assertEqual(index.roi_key(mcfg2), key)
+            self.assertNotEqual(
+                index.roi_key({'roi': {'center': [0, 1]}}), key)
+            pts = [(0, 0, r, c) for r in xrange(2) for c in xrange(3)]
+            ifn = os.path.join(d, 'index.json')
+            si = index.SessionIndex(ifn)
+            with self.assertRaises(KeyError):
+                si.session(key)
+            # first montage aborts after 3 tiles (1 vetoed)
+            jfn0 = os.path.join(d, 'a_tiles.jsonl')
+            si.add_session(key, 'a', d, jfn0, len(pts))
+            j = journal.TileJournal(jfn0)
+            for p in pts[:2]:
+                j.write({'meta': {'row': p[2], 'col': p[3]}})
+            j.write({'meta': {'row': 1, 'col': 0}, 'vetoed': True})
+            j.close()
+            si = index.SessionIndex(ifn)
+            s = si.session(key)
+            self.assertEqual(s['id'], 'a')
+            done = si.completed_tiles(key, 'a')
+            self.assertEqual(sorted(done.keys()), [(0, 0), (0, 1)])
+            self.assertEqual(index.missing_indices(pts, done), [2, 3, 4, 5])
+            # resume, re-images the vetoed tile and aborts
+            jfn1 = os.path.join(d, 'b_tiles.jsonl')
+            si.add_session(key, 'b', d, jfn1, 4, resumes='a')
+            j = journal.TileJournal(jfn1)
+            j.write({'meta': {'row': 0, 'col': 2}})
+            j.write({'meta': {'row': 1, 'col': 0}})
+            j.write({'meta': {'row': 1, 'col': 1}, 'vetoed': True})
+            j.close()
+            self.assertEqual(si.session(key)['id'], 'b')
+            self.assertEqual(
+                [s['id'] for s in si.chain(key, 'b')], ['a', 'b'])
+            done = si.completed_tiles(key, 'b')
+            # vetoed tiles are not completed (unless included)
+            self.assertEqual(index.missing_indices(pts, done), [4, 5])
+            done = si.completed_tiles(key, 'b', include_vetoed=True)
+            self.assertEqual(index.missing_indices(pts, done), [5])
+            si.finish_session(key, 'b', n_completed=1)
+            with self.assertRaises(KeyError):
+                si.session(key)
+            self.assertEqual(si.session(key, 'a')['resumed_by'], 'b')
+            # compact the chain, keeping the re-imaged tile
+            tfn, n = journal.compact(si.journals(key, 'b'))
+            self.assertEqual(n, 5)
+            tiles = journal.load_tiles(tfn)
+            keys = [journal.tile_key(t) for t in tiles]
+            self.assertEqual(len(set(keys)), len(keys))
+            t = tiles[keys.index((1, 0))]
+            self.assertFalse(t.get('vetoed', False))
+        finally:
+            shutil.rmtree(d)
+
 
 suite = unittest.TestSuite()
 suite.addTest(PlanningTest('grid_coordinates'))
 suite.addTest(PlanningTest('calculate_coordinates'))
+suite.addTest(PlanningTest('tile_mask'))
+suite.addTest(PlanningTest('order_points'))
+suite.addTest(SettleTest('settle_model'))
+suite.addTest(JournalTest('journal'))
+suite.addTest(IndexTest('session_index'))
 #suite.addTest(PlanningTest('mask_coordinates'))
@@ -31,12 +31,14 @@ from . import cropping
 from . import linearpolar
 from . import focus
 from . import histogram
+from . import normalize
 from . import oo
 from . import shift
+from . import stats
 from . import stitching
 
 
 __all__ = [
-    'contrast', 'cropping', 'linearpolar', 'focus', 'histogram', 'oo', 'shift',
-    'stitching'
+    'contrast', 'cropping', 'linearpolar', 'focus', 'histogram', 'normalize',
+    'oo', 'shift', 'stats', 'stitching'
 ]
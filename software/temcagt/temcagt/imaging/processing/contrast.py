@@ -18,9 +18,25 @@ def check_contrast(im, crop=None):
     logger.debug("check_contrast")
     if isinstance(im, (list, tuple)):
         return [check_contrast(i, crop) for i in im]
+    if im.ndim == 3:
+        return check_contrast_stack(im, crop)
     if crop is not None:
         r = numpy.std(cropping.crop(im, crop))
     else:
         r = numpy.std(im)
     logger.debug("check_contrast result %s" % r)
     return r
+
+
+def check_contrast_stack(stack, crop=None, out=None):
+    """Std of each image in a (N x H x W) stack (or list of images)
+
+    out : a length N float array to store the results in
+    """
+    stack = cropping.as_stack(stack)
+    if crop is not None:
+        stack = cropping.crop_stack(stack, crop)
+    if out is None:
+        out = numpy.empty(len(stack), dtype='f8')
+    numpy.std(stack, axis=(1, 2), out=out)
+    return out
@@ -2,6 +2,8 @@
 """
 """
 
+import numpy
+
 from ... import log
 
 
@@ -31,3 +33,26 @@ def crop(im, dims):
         return [crop(i, calculate_crop(im[0], dims)) for i in im]
     dims = calculate_crop(im, dims)
     return im[[slice(*d) for d in dims]]
+
+
+def as_stack(ims, out=None, dtype=None):
+    """Copy a list of equally sized images into a (N x H x W) stack
+
+    out : a previously allocated stack to reuse (if the shape matches)
+    """
+    if isinstance(ims, numpy.ndarray) and ims.ndim == 3:
+        return ims
+    s = (len(ims), ) + ims[0].shape
+    if dtype is None:
+        dtype = ims[0].dtype
+    if out is None or out.shape != s or out.dtype != dtype:
+        out = numpy.empty(s, dtype=dtype)
+    for (i, im) in enumerate(ims):
+        out[i] = im
+    return out
+
+
+def crop_stack(stack, dims):
+    """Crop every image of a (N x H x W) stack (returns a view)"""
+    dims = calculate_crop(stack[0], dims)
+    return stack[tuple([slice(None)] + [slice(*d) for d in dims])]
@@ -22,3 +22,33 @@ def histogram(im, **kwargs):
     #n = numpy.sqrt(im.size)
     #kwargs['bins'] = kwargs.get('bins', n)
     #return numpy.histogram(im.flat, **kwargs)
+
+
+def histogram_stack(stack, bins=None, out=None):
+    """Histogram each image in a (N x H x W) stack in one pass
+
+    As histogram, each image uses bins spanning its own [min, max)
+    Returns counts (N x bins) and bin starts (N x bins), counts are
+    stored in out if provided
+    """
+    n = len(stack)
+    flat = stack.reshape(n, -1)
+    if bins is None:
+        bins = int(numpy.sqrt(flat.shape[1]))
+    bins = int(bins)
+    mi = flat.min(axis=1).astype('i8')
+    ma = flat.max(axis=1).astype('i8')
+    span = numpy.where(ma > mi, ma - mi, 1).astype('f8')
+    b = numpy.floor(
+        (flat - mi[:, numpy.newaxis]) * (bins / span)[:, numpy.newaxis])
+    b = b.astype('i8')
+    # values at the max are outside [min, max) so are not counted
+    valid = (b >= 0) & (b < bins) & (ma > mi)[:, numpy.newaxis]
+    b += (numpy.arange(n) * bins)[:, numpy.newaxis]
+    counts = numpy.bincount(b[valid], minlength=n * bins).reshape(n, bins)
+    if out is None:
+        out = numpy.empty((n, bins), dtype='f4')
+    out[:] = counts
+    edges = mi[:, numpy.newaxis] + (
+        (ma - mi)[:, numpy.newaxis] * numpy.linspace(0, 1, bins))
+    return out, edges
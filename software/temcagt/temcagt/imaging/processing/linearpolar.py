@@ -1,6 +1,13 @@
+import collections
+
 import numpy
 
 
+# flat polar sampling indices keyed by (shape, center, radii, phase_width)
+max_cached_indices = 8
+_indices = collections.OrderedDict()
+
+
 def polar2cart(r, theta, center):
     x = r * numpy.cos(theta) + center[0]
     y = r * numpy.sin(theta) + center[1]
@@ -17,17 +24,44 @@ def compute_image_xy_cart(im, center=None, phase_width=3000,
 
 
 def compute_xy_cart(initial_radius, final_radius, phase_width, center):
-    theta, R = numpy.meshgrid(x=numpy.linspace(0, 2*numpy.pi, phase_width),
-                              y=numpy.arange(initial_radius, final_radius))
+    theta, R = numpy.meshgrid(
+        numpy.linspace(0, 2*numpy.pi, phase_width),
+        numpy.arange(initial_radius, final_radius))
     return polar2cart(R, theta, center)
 
 
+def polar_indices(shape, center, final_radius, initial_radius, phase_width):
+    """Flat (raveled) image indices of the polar samples
+
+    Indices are computed once per set of arguments and cached
+    (up to max_cached_indices sets)
+    """
+    key = (
+        tuple(shape[:2]), tuple(center), final_radius, initial_radius,
+        phase_width)
+    if key in _indices:
+        inds = _indices.pop(key)
+    else:
+        Xcart, Ycart = compute_xy_cart(
+            initial_radius, final_radius, phase_width, center)
+        inds = numpy.ravel_multi_index(
+            (Ycart.astype(int), Xcart.astype(int)), shape[:2])
+        while len(_indices) >= max_cached_indices:
+            _indices.popitem(last=False)
+    _indices[key] = inds
+    return inds
+
+
 def img2polar(img, center=None, final_radius=None, initial_radius=0,
               phase_width=3000, xy_cart=None):
     if center is None:
         center = (img.shape[1] / 2, img.shape[0] / 2)
     if final_radius is None:
         final_radius = min(center[0], center[1])
+    if xy_cart is None and img.ndim == 2:
+        inds = polar_indices(
+            img.shape, center, final_radius, initial_radius, phase_width)
+        return numpy.take(numpy.ascontiguousarray(img).ravel(), inds)
     if xy_cart is None:
         Xcart, Ycart = compute_xy_cart(
             initial_radius, final_radius, phase_width, center)
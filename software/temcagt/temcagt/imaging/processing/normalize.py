@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Normalize a grab (multiply by a background) and measure contrast
+(std dev of pixels in a crop) in a single pass over the image.
+
+The image is processed in blocks of rows so the contrast statistics are
+accumulated while the normalized rows are still in cache. If numba is
+installed a compiled per-pixel kernel can be used instead.
+"""
+
+import cv2
+import numpy
+
+try:
+    import numba
+    has_numba = True
+except ImportError:
+    has_numba = False
+
+from ... import log
+
+
+logger = log.get_logger(__name__)
+
+# rows per block for the numpy kernel
+block_rows = 64
+
+
+def _numpy_kernel(grab, bg, out, crop):
+    (y0, y1), (x0, x1) = crop
+    s = 0.
+    ss = 0.
+    h = grab.shape[0]
+    for r0 in xrange(0, h, block_rows):
+        r1 = min(r0 + block_rows, h)
+        cv2.multiply(grab[r0:r1], bg[r0:r1], out[r0:r1], dtype=cv2.CV_32F)
+        cy0 = max(r0, y0)
+        cy1 = min(r1, y1)
+        if cy0 < cy1:
+            c = out[cy0:cy1, x0:x1]
+            s += float(c.sum(dtype='f8'))
+            ss += float(numpy.einsum('ij,ij->', c, c, dtype='f8'))
+    return s, ss
+
+
+if has_numba:
+    @numba.njit(cache=True)
+    def _compiled_kernel(grab, bg, out, y0, y1, x0, x1):
+        s = 0.
+        ss = 0.
+        for i in range(grab.shape[0]):
+            in_rows = (i >= y0) and (i < y1)
+            for j in range(grab.shape[1]):
+                v = grab[i, j] * bg[i, j]
+                out[i, j] = v
+                if in_rows and (j >= x0) and (j < x1):
+                    s += v
+                    ss += v * v
+        return s, ss
+else:
+    _compiled_kernel = None
+
+
+def normalize(grab, bg, out, crop=None, kernel=None):
+    """
+    Write grab * bg to out and return the std dev of out[crop]
+
+    crop : [(y0, y1), (x0, x1)] region for the contrast measurement,
+        if None the whole image is used
+    kernel : 'numpy', 'compiled' or None (compiled if numba is available)
+    """
+    logger.debug("normalize %s %s", hex(id(grab)), crop)
+    if crop is None:
+        crop = [(0, grab.shape[0]), (0, grab.shape[1])]
+    (y0, y1), (x0, x1) = crop
+    n = (y1 - y0) * (x1 - x0)
+    if kernel is None:
+        kernel = 'compiled' if has_numba else 'numpy'
+    if kernel == 'compiled':
+        if not has_numba:
+            raise ValueError("compiled kernel requires numba")
+        s, ss = _compiled_kernel(grab, bg, out, y0, y1, x0, x1)
+    elif kernel == 'numpy':
+        s, ss = _numpy_kernel(grab, bg, out, crop)
+    else:
+        raise ValueError("Unknown normalize kernel: %s" % (kernel, ))
+    if n == 0:
+        return 0.
+    m = s / n
+    return max(ss / n - m * m, 0.) ** 0.5
@@ -8,6 +8,8 @@ Image processor class that
 
 import inspect
 
+import numpy
+
 from . import contrast
 from . import shift
 from ...config.checkers import require
@@ -51,9 +53,18 @@ class ImageProcessor(object):
         self._func = f
         self._iskw = get_kwarg_checker(f)
 
+    def set_batch_function(self, f):
+        """Set a function that processes a stack (or list) in one call"""
+        self._batch_func = f
+        self._batch_iskw = get_kwarg_checker(f)
+
     def validate(self):
         return True
 
+    def validate_batch(self):
+        """Validate self.results, return one bool per item"""
+        return numpy.ones(len(self.results), dtype=bool)
+
     def configure(self, config):
         self.config.update(config)
 
@@ -70,11 +81,38 @@ class ImageProcessor(object):
         self.valid = self.validate()
         logger.debug("ImageProcessor[%s] valid? %s", self, self.valid)
 
+    def submit_batch(self, batch, **kwargs):
+        """Process a batch (see set_batch_function) storing results
+
+        Without a batch function each item is submitted in turn.
+        Extra kwargs (e.g. out arrays) are passed to the batch function.
+        """
+        self.check_config()
+        if getattr(self, '_batch_func', None) is None:
+            results, valids = [], []
+            for item in batch:
+                self.submit(item)
+                results.append(self.result)
+                valids.append(self.valid)
+            self.results = results
+            self.valids = numpy.array(valids, dtype=bool)
+            return self.valids
+        kw = dict([
+            (k, self.config[k]) for k in self.config
+            if self._batch_iskw(k)])
+        kw.update(kwargs)
+        logger.debug("ImageProcessor[%s] submit_batch with %s",
+                     self, (hex(id(batch)), kw))
+        self.results = self._batch_func(batch, **kw)
+        self.valids = self.validate_batch()
+        return self.valids
+
 
 class ContrastChecker(ImageProcessor):
     def __init__(self, config=None):
         ImageProcessor.__init__(self, config)
         self.set_function(contrast.check_contrast)
+        self.set_batch_function(contrast.check_contrast_stack)
 
     def check_config(self):
         [require(self.config, k) for k in 'crop min'.split()]
@@ -82,6 +120,9 @@ class ContrastChecker(ImageProcessor):
     def validate(self):
         return self.result >= self.config['min']
 
+    def validate_batch(self):
+        return numpy.asarray(self.results) >= self.config['min']
+
 
 class ShiftChecker(ImageProcessor):
     def __init__(self, config=None):
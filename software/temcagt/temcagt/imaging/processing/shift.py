@@ -37,6 +37,9 @@ from ... import log
 
 logger = log.get_logger(__name__)
 
+# cached phase correlation plans by (height, width)
+_phase_plans = {}
+
 
 def parse_shift_results(shifts):
     logger.debug("parse_shift_results %s",
@@ -56,10 +59,141 @@ def parse_shift_results(shifts):
     return rs
 
 
+def phase_plan(shape):
+    """
+    Get (or build and cache) the window and padded dft buffer used
+    to phase correlate images with the given shape
+    """
+    shape = tuple(shape)
+    if shape not in _phase_plans:
+        h, w = shape
+        dh = cv2.getOptimalDFTSize(h)
+        dw = cv2.getOptimalDFTSize(w)
+        _phase_plans[shape] = {
+            'window': cv2.createHanningWindow((w, h), cv2.CV_32F),
+            'padded': numpy.zeros((dh, dw), dtype='f4'),
+            'dft_shape': (dh, dw),
+        }
+    return _phase_plans[shape]
+
+
+def _windowed_dft(im, plan):
+    h, w = im.shape
+    p = plan['padded']
+    numpy.multiply(im, plan['window'], p[:h, :w])
+    return cv2.dft(p, flags=cv2.DFT_COMPLEX_OUTPUT)
+
+
+def _subpixel_offset(m, a, b):
+    # vertex of parabola through (-1, m), (0, a), (1, b)
+    d = m - 2 * a + b
+    if d == 0:
+        return 0.
+    return 0.5 * (m - b) / d
+
+
+class PhaseCorrelator(object):
+    """
+    Measure shifts between a template and images using phase correlation
+
+    The window, dft size and template spectrum are computed once
+    and reused for every matched image so the cost per match does
+    not depend on the search range.
+
+    match returns a dict with the same keys as find_shifts:
+        x, y : integer shift of the image relative to the template
+        d : shift distance
+        m : normalized cross correlation (TM_CCORR_NORMED) of a tcrop
+            sized template at the found shift (comparable to template
+            matching results)
+        p : phase correlation peak
+    and sx, sy (subpixel shift) if subpixel is True
+    """
+    def __init__(self, tcrop=400, mcrop=500, subpixel=False):
+        self.tcrop = tcrop
+        self.mcrop = mcrop
+        self.subpixel = subpixel
+        self.template = None
+        self._template_dft = None
+
+    def set_template(self, im):
+        if im is None:
+            self.template = None
+            self._template_dft = None
+            return
+        mim = cropping.crop(im, self.mcrop)
+        self.template = numpy.array(mim, dtype='f4')
+        self._plan = phase_plan(self.template.shape)
+        self._template_dft = _windowed_dft(self.template, self._plan)
+        # for normalized cross correlation of the central tcrop region
+        self._tc = cropping.calculate_crop(self.template, self.tcrop)
+        t = cropping.crop(self.template, self._tc)
+        self._t = t
+        self._tss = float(numpy.dot(t.ravel(), t.ravel()))
+
+    def correlate(self, im):
+        """Return the phase correlation surface of im vs the template"""
+        if self.template is None:
+            raise ValueError("PhaseCorrelator template is not set")
+        mim = cropping.crop(im, self.mcrop)
+        f = _windowed_dft(mim, self._plan)
+        c = cv2.mulSpectrums(f, self._template_dft, 0, conjB=True)
+        mag = cv2.magnitude(c[:, :, 0], c[:, :, 1])
+        mag[mag == 0] = 1.
+        c[:, :, 0] /= mag
+        c[:, :, 1] /= mag
+        return cv2.idft(c, flags=cv2.DFT_REAL_OUTPUT | cv2.DFT_SCALE), mim
+
+    def ncc(self, mim, x, y):
+        (y0, y1), (x0, x1) = self._tc
+        h, w = mim.shape
+        if (
+                (y0 + y) < 0 or (y1 + y) > h or
+                (x0 + x) < 0 or (x1 + x) > w or
+                self._tss == 0):
+            return 0.
+        r = numpy.asarray(mim[y0 + y:y1 + y, x0 + x:x1 + x], dtype='f4')
+        rss = float(numpy.dot(r.ravel(), r.ravel()))
+        if rss == 0:
+            return 0.
+        return float(numpy.dot(self._t.ravel(), r.ravel())) / (
+            (self._tss * rss) ** 0.5)
+
+    def match(self, im):
+        c, mim = self.correlate(im)
+        _, p, _, (px, py) = cv2.minMaxLoc(c)
+        dh, dw = c.shape
+        x = px if px <= dw / 2 else px - dw
+        y = py if py <= dh / 2 else py - dh
+        r = dict(
+            x=x, y=y, d=(x * x + y * y) ** 0.5,
+            m=self.ncc(mim, x, y), p=float(p))
+        if self.subpixel:
+            r['sx'] = x + _subpixel_offset(
+                c[py, px - 1], c[py, px], c[py, (px + 1) % dw])
+            r['sy'] = y + _subpixel_offset(
+                c[py - 1, px], c[py, px], c[(py + 1) % dh, px])
+        return r
+
+
+def find_shifts_phase(ims, tcrop=400, mcrop=500, subpixel=False):
+    """
+    Phase correlation version of find_shifts (see PhaseCorrelator)
+    """
+    logger.debug("find_shifts_phase %s", (map(lambda im: hex(id(im)), ims),
+                 tcrop, mcrop, subpixel))
+    pc = PhaseCorrelator(tcrop, mcrop, subpixel)
+    pc.set_template(ims[0])
+    return [pc.match(im) for im in ims[1:]]
+
+
 def find_shifts(ims, tcrop=400, mcrop=500, method='TM_CCORR_NORMED'):
     """
     Requires full images
 
+    method can be any cv2 template matching method or PHASE_CORR
+    to use phase correlation (see find_shifts_phase)
+
     Returns list of dicts of shift information for each subsequent frame
     relative to the first (used as a template).
 
@@ -70,6 +204,8 @@ def find_shifts(ims, tcrop=400, mcrop=500, method='TM_CCORR_NORMED'):
     """
     logger.debug("find_shifts %s", (map(lambda im: hex(id(im)), ims),
                  tcrop, mcrop, method))
+    if method == 'PHASE_CORR':
+        return find_shifts_phase(ims, tcrop, mcrop)
     if ims[0].dtype in (numpy.float32, numpy.uint8):
         tc = lambda a: a
     else:
@@ -106,6 +242,36 @@ def deshift(ims, shifts):
     return sims
 
 
+def accumulate(total, count, im, shift=None):
+    """
+    Add a deshifted image to a running sum (total) and increment the
+    number of images (count) that contributed to each pixel.
+
+    shift : dict(x, y, ...) or None (for the template)
+
+    The average is total / count (see deshift_and_average)
+    """
+    if shift is None:
+        x, y = 0, 0
+    else:
+        x, y = int(shift['x']), int(shift['y'])
+    h, w = im.shape
+    if abs(x) >= w or abs(y) >= h:
+        return
+    if x >= 0:
+        ts, ims = slice(0, w - x), slice(x, w)
+    else:
+        ts, ims = slice(-x, w), slice(0, w + x)
+    if y >= 0:
+        tr, imr = slice(0, h - y), slice(y, h)
+    else:
+        tr, imr = slice(-y, h), slice(0, h + y)
+    t = total[tr, ts]
+    numpy.add(t, im[imr, ims], out=t)
+    c = count[tr, ts]
+    numpy.add(c, 1, out=c)
+
+
 def deshift_and_average(ims, shifts):
     logger.debug("deshift_and_average %s", (map(lambda im: hex(id(im)), ims),
                  shifts))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Compute image stats (focus, histogram, std, mean and beam profile)
+
+All crop based measures are computed from one strided subsample of the
+crop that is copied (once) into a preallocated float buffer. Scratch
+buffers for the gradient and histogram are reused between images.
+"""
+
+import cv2
+import numpy
+
+from ... import log
+from . import cropping
+from . import focus
+
+
+logger = log.get_logger(__name__)
+
+# measures computed from the (subsampled) crop
+crop_measures = ('focus', 'histogram', 'std', 'mean')
+all_measures = crop_measures + ('beam', )
+
+
+def beam_profile(im, index):
+    """Diagonal profile from the corner of camera index"""
+    if index == 0:
+        vs = im.diagonal()
+    elif index == 1:
+        vs = im[:, ::-1].diagonal()
+    elif index == 2:
+        vs = im[:, ::-1].diagonal()[::-1]
+    else:
+        vs = im.diagonal()[::-1]
+    t = vs[len(vs) / 2:].max() / 2.
+    inds = numpy.where(vs > t)[0]
+    if len(inds):
+        i = int(inds[0])
+    else:
+        i = -1
+    return {
+        'vs': numpy.array(vs),
+        't': float(t),
+        'i': i,
+    }
+
+
+class StatsEngine(object):
+    """
+    crop : crop (see cropping.calculate_crop) for crop measures
+    stride : sample every stride pixels (in both dimensions) of the crop
+    bins : number of histogram bins
+    focus_method : name of a function in focus
+    index : camera index (for the beam profile)
+
+    Focus (gradient_focus) is scaled by stride ** 2 to roughly match
+    the magnitude of the unsampled measure.
+    """
+    def __init__(
+            self, crop=512, stride=1, bins=256,
+            focus_method='gradient_focus', index=0):
+        self.crop = crop
+        self.stride = max(1, int(stride))
+        self.bins = int(bins)
+        if not hasattr(focus, focus_method):
+            logger.warning(
+                "StatsEngine[%s] unknown focus method %s, "
+                "using gradient_focus", self, focus_method)
+            focus_method = 'gradient_focus'
+        self.focus_method = focus_method
+        self.index = index
+        self._sub = None
+        self._grad = None
+        self._hist = numpy.empty((self.bins, 1), 'f4')
+
+    @classmethod
+    def from_config(cls, cfg, index=0):
+        return cls(
+            crop=cfg.get('crop', 512), stride=cfg.get('stride', 1),
+            bins=cfg.get('bins', 256),
+            focus_method=cfg.get('focus_method', 'gradient_focus'),
+            index=index)
+
+    def enabled(self, cfg):
+        """Measures enabled in a stats config"""
+        return [m for m in all_measures if cfg.get(m, False)]
+
+    def subsample(self, im):
+        c = cropping.crop(im, self.crop)
+        if self.stride != 1:
+            c = c[::self.stride, ::self.stride]
+        if self._sub is None or self._sub.shape != c.shape:
+            logger.debug(
+                "StatsEngine[%s] allocating scratch: %s", self, c.shape)
+            self._sub = numpy.empty(c.shape, 'f4')
+            self._grad = numpy.empty((c.shape[0] - 1, c.shape[1]), 'f4')
+        self._sub[:] = c
+        return self._sub
+
+    def compute(self, im, measures=None):
+        """Compute measures (all if None) for im and return a dict"""
+        if measures is None:
+            measures = all_measures
+        stats = {}
+        if any([m in crop_measures for m in measures]):
+            s = self.subsample(im)
+        if 'focus' in measures:
+            if self.focus_method == 'gradient_focus':
+                cv2.absdiff(s[1:], s[:-1], self._grad)
+                stats['focus'] = float(
+                    cv2.sumElems(self._grad)[0] * self.stride ** 2)
+            else:
+                f = getattr(focus, self.focus_method)
+                stats['focus'] = float(numpy.mean(f(s)))
+        if 'mean' in measures or 'std' in measures:
+            m, sd = cv2.meanStdDev(s)
+            if 'mean' in measures:
+                stats['mean'] = float(m[0, 0])
+            if 'std' in measures:
+                stats['std'] = float(sd[0, 0])
+        if 'histogram' in measures:
+            mi, ma = cv2.minMaxLoc(s)[:2]
+            if mi == ma:
+                self._hist[:] = 0
+            else:
+                cv2.calcHist(
+                    [s], [0], None, [self.bins], [mi, ma], self._hist)
+            stats['histogram'] = (
+                self._hist[:, 0].copy(), numpy.linspace(mi, ma, self.bins))
+        if 'beam' in measures:
+            stats['beam'] = beam_profile(im, self.index)
+        return stats
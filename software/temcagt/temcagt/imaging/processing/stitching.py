@@ -26,11 +26,20 @@ so they are stitched as followed
       4 (match 2) 2
 """
 
+import collections
 import copy
+import hashlib
+import json
+import os
 
 import cv2
 import numpy
 
+from ... import log
+
+
+logger = log.get_logger(__name__)
+
 
 def crop_image(im, crop):
     return im[slice(*crop[1]), slice(*crop[0])]
@@ -98,27 +107,131 @@ def find_shifts(ims, tcrops, mcrops, method='TM_CCORR_NORMED', start=(0, 0)):
     return shifts
 
 
+class TileIndex(object):
+    """Grid bucketed spatial index of tile bounding boxes
+
+    Tiles are added to every (cell_size x cell_size) grid cell they
+    touch so only tiles sharing a cell are checked for overlap.
+    cell_size defaults to the largest tile dimension.
+    """
+    def __init__(self, shapes, shifts, cell_size=None):
+        self.lefts = numpy.array([int(s[0]) for s in shifts])
+        self.tops = numpy.array([int(s[1]) for s in shifts])
+        self.rights = self.lefts + numpy.array([s[1] for s in shapes])
+        self.bottoms = self.tops + numpy.array([s[0] for s in shapes])
+        if cell_size is None:
+            cell_size = max(max(s) for s in shapes)
+        self.cell_size = int(cell_size)
+        self.cells = {}
+        for i in xrange(len(shifts)):
+            for c in self.tile_cells(i):
+                self.cells.setdefault(c, []).append(i)
+
+    def __len__(self):
+        return len(self.lefts)
+
+    def tile_cells(self, i):
+        cs = self.cell_size
+        for cy in xrange(
+                self.tops[i] // cs, (self.bottoms[i] - 1) // cs + 1):
+            for cx in xrange(
+                    self.lefts[i] // cs, (self.rights[i] - 1) // cs + 1):
+                yield (cx, cy)
+
+    def neighbours(self, i):
+        """Indices of tiles that overlap tile i (not including i)"""
+        c = set()
+        for k in self.tile_cells(i):
+            c.update(self.cells[k])
+        c.discard(i)
+        c = numpy.array(sorted(c), dtype='i8')
+        if not len(c):
+            return c
+        return c[
+            (self.lefts[c] < self.rights[i]) &
+            (self.rights[c] > self.lefts[i]) &
+            (self.tops[c] < self.bottoms[i]) &
+            (self.bottoms[c] > self.tops[i])]
+
+
+class TileWeights(object):
+    """Piecewise constant blending weights (1 / overlap count) of a tile
+
+    Stored as rectangles: column segments start at xs, row segments at
+    ys and counts[yi, xi] is the number of tiles covering a segment.
+    """
+    def __init__(self, shape, xs, ys, counts):
+        self.shape = tuple(shape)
+        self.xs = xs
+        self.ys = ys
+        self.counts = counts
+
+    @property
+    def nbytes(self):
+        return self.xs.nbytes + self.ys.nbytes + self.counts.nbytes
+
+    def rects(self):
+        """Yield (left, right, top, bottom, weight) rectangles"""
+        xe = list(self.xs[1:]) + [self.shape[1]]
+        ye = list(self.ys[1:]) + [self.shape[0]]
+        for (yi, (t, b)) in enumerate(zip(self.ys, ye)):
+            for (xi, (l, r)) in enumerate(zip(self.xs, xe)):
+                yield l, r, t, b, 1. / self.counts[yi, xi]
+
+    def expand(self, ds=1, dtype='f8'):
+        """Dense weights (equal to w[::ds, ::ds] of the full weights)"""
+        yi = numpy.searchsorted(
+            self.ys, numpy.arange(0, self.shape[0], ds), 'right') - 1
+        xi = numpy.searchsorted(
+            self.xs, numpy.arange(0, self.shape[1], ds), 'right') - 1
+        return (1. / self.counts.astype(dtype))[numpy.ix_(yi, xi)]
+
+
+def expand_weights(w, ds=1):
+    """Return dense weights for either TileWeights or an array"""
+    if isinstance(w, TileWeights):
+        return w.expand(ds)
+    if ds != 1:
+        return w[::ds, ::ds]
+    return w
+
+
+def tile_weights(index, shape, i):
+    """Compute TileWeights for tile i of a TileIndex"""
+    height, width = shape
+    n = index.neighbours(i)
+    # overlaps in tile coordinates
+    l = numpy.clip(index.lefts[n] - index.lefts[i], 0, width)
+    r = numpy.clip(index.rights[n] - index.lefts[i], 0, width)
+    t = numpy.clip(index.tops[n] - index.tops[i], 0, height)
+    b = numpy.clip(index.bottoms[n] - index.tops[i], 0, height)
+    xs = numpy.unique(numpy.concatenate(([0], l, r)))
+    xs = xs[xs < width]
+    ys = numpy.unique(numpy.concatenate(([0], t, b)))
+    ys = ys[ys < height]
+    # count overlaps per segment with a 2d difference array
+    d = numpy.zeros((len(ys) + 1, len(xs) + 1), dtype='i4')
+    li = numpy.searchsorted(xs, l)
+    ri = numpy.searchsorted(xs, r)
+    ti = numpy.searchsorted(ys, t)
+    bi = numpy.searchsorted(ys, b)
+    numpy.add.at(d, (ti, li), 1)
+    numpy.add.at(d, (ti, ri), -1)
+    numpy.add.at(d, (bi, li), -1)
+    numpy.add.at(d, (bi, ri), 1)
+    counts = d.cumsum(0).cumsum(1)[:-1, :-1] + 1
+    return TileWeights(shape, xs, ys, counts)
+
+
+def calculate_tile_weights(shapes, shifts, index=None):
+    """Compute compact (TileWeights) weights for each tile"""
+    if index is None:
+        index = TileIndex(shapes, shifts)
+    return [tile_weights(index, s, i) for (i, s) in enumerate(shapes)]
+
+
 def calculate_weights(shapes, shifts):
-    ws = []
-    for (shape, s) in zip(shapes, shifts):
-        height, width = shape
-        w = numpy.ones(shape, dtype='f8')
-        for s2 in shifts:
-            if id(s) == id(s2):
-                continue
-            # calculate overlapping block
-            left = s2[0] - s[0]
-            right = left + width
-            left = max(left, 0)
-            right = min(width, right)
-            top = s2[1] - s[1]
-            bottom = top + height
-            top = max(top, 0)
-            bottom = min(height, bottom)
-            if right > 0 and left < width and bottom > 0 and top < height:
-                w[top:bottom, left:right] += 1
-        ws.append(1. / w)
-    return ws
+    return [w.expand() for w in calculate_tile_weights(shapes, shifts)]
 
 
 def calculate_bounding_box(shapes, shifts):
@@ -153,7 +266,7 @@ def stitch(ims, shifts, weights=None, bbox=None, canvas=None):
             s[1] + im.shape[0] - top,
             s[1] - top,
         )
-        canvas[e[3]:e[2], e[0]:e[1]] += im * w
+        canvas[e[3]:e[2], e[0]:e[1]] += im * expand_weights(w)
     return canvas
 
 
@@ -180,7 +293,14 @@ def scalable_stitch(ims, max_shape, shifts, weights=None, bbox=None):
         if weights is not None:
             weights = copy.copy(weights)
             for i in xrange(len(weights)):
-                weights[i] = weights[i][::sy, ::sx]
+                if isinstance(weights[i], TileWeights):
+                    if sx != sy:
+                        raise Exception(
+                            "Invalid downsampling, %s x %s, must be uniform"
+                            % (sx, sy))
+                    weights[i] = weights[i].expand(int(sx))
+                else:
+                    weights[i] = weights[i][::sy, ::sx]
                 if weights[i].shape != s:
                     raise Exception(
                         "Failed to downsample weights %s to shape %s"
@@ -190,8 +310,273 @@ def scalable_stitch(ims, max_shape, shifts, weights=None, bbox=None):
     return stitch(ims, shifts, weights, bbox)
 
 
+class ChunkedCanvas(object):
+    """Stitched canvas stored on disk as fixed size (square) chunks
+
+    Each chunk is saved in directory as a .npy file (named by chunk row
+    and column). Only cache_size chunks are kept in memory, the least
+    recently used chunk is written back when another is needed so
+    memory is bounded by cache_size * chunk_size ** 2 * itemsize.
+
+    Canvas coordinates are those of bbox (left, right, top, bottom).
+    create : write the (empty) canvas meta data, see open
+    """
+    meta_filename = 'canvas.json'
+
+    def __init__(
+            self, directory, bbox, chunk_size=2048, cache_size=16,
+            dtype='f4', create=True):
+        self.directory = os.path.expanduser(directory)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.bbox = tuple(int(v) for v in bbox)
+        self.shape = (
+            self.bbox[3] - self.bbox[2], self.bbox[1] - self.bbox[0])
+        self.chunk_size = int(chunk_size)
+        self.cache_size = max(1, int(cache_size))
+        self.dtype = numpy.dtype(dtype)
+        self.chunks = collections.OrderedDict()
+        self.stored = set()
+        self.n_loads = 0
+        self.n_saves = 0
+        if create:
+            self.save_meta()
+
+    @classmethod
+    def open(cls, directory, cache_size=16):
+        """Open a previously stitched (and flushed) canvas"""
+        directory = os.path.expanduser(directory)
+        with open(os.path.join(directory, cls.meta_filename), 'r') as f:
+            m = json.load(f)
+        c = cls(
+            directory, m['bbox'], m['chunk_size'], cache_size, m['dtype'],
+            create=False)
+        c.stored = set(tuple(k) for k in m['stored'])
+        return c
+
+    def save_meta(self):
+        with open(os.path.join(self.directory, self.meta_filename), 'w') as f:
+            json.dump({
+                'bbox': self.bbox, 'chunk_size': self.chunk_size,
+                'dtype': self.dtype.str, 'stored': sorted(self.stored)}, f)
+
+    def chunk_filename(self, key):
+        return os.path.join(self.directory, '%i_%i.npy' % key)
+
+    def chunk_shape(self, key):
+        cs = self.chunk_size
+        return (
+            min(cs, self.shape[0] - key[0] * cs),
+            min(cs, self.shape[1] - key[1] * cs))
+
+    def chunk_keys(self, left, right, top, bottom):
+        """Keys (row, col) of chunks touching a region (canvas coords)"""
+        cs = self.chunk_size
+        l = max(left - self.bbox[0], 0) // cs
+        r = (min(right - self.bbox[0], self.shape[1]) - 1) // cs
+        t = max(top - self.bbox[2], 0) // cs
+        b = (min(bottom - self.bbox[2], self.shape[0]) - 1) // cs
+        for ci in xrange(t, b + 1):
+            for cj in xrange(l, r + 1):
+                yield (ci, cj)
+
+    def chunk(self, key):
+        if key in self.chunks:
+            c = self.chunks.pop(key)
+            self.chunks[key] = c
+            return c
+        while len(self.chunks) >= self.cache_size:
+            self._write_chunk(*self.chunks.popitem(last=False))
+        if key in self.stored:
+            c = numpy.load(self.chunk_filename(key))
+            self.n_loads += 1
+        else:
+            c = numpy.zeros(self.chunk_shape(key), dtype=self.dtype)
+        self.chunks[key] = c
+        return c
+
+    def _write_chunk(self, key, c):
+        logger.debug("ChunkedCanvas[%s] writing chunk %s", self, key)
+        numpy.save(self.chunk_filename(key), c)
+        self.stored.add(key)
+        self.n_saves += 1
+
+    def _regions(self, left, right, top, bottom):
+        """Yield (key, chunk slice, region slice) for a region"""
+        cs = self.chunk_size
+        for key in self.chunk_keys(left, right, top, bottom):
+            # chunk extent in canvas coords
+            cl = self.bbox[0] + key[1] * cs
+            ct = self.bbox[2] + key[0] * cs
+            ch, cw = self.chunk_shape(key)
+            l, r = max(left, cl), min(right, cl + cw)
+            t, b = max(top, ct), min(bottom, ct + ch)
+            yield (
+                key,
+                (slice(t - ct, b - ct), slice(l - cl, r - cl)),
+                (slice(t - top, b - top), slice(l - left, r - left)))
+
+    def add(self, im, x, y, weight=1.):
+        """Add im * weight with the top left corner of im at (x, y)"""
+        h, w = im.shape[:2]
+        for (key, cs, rs) in self._regions(x, x + w, y, y + h):
+            c = self.chunk(key)
+            c[cs] += im[rs] * weight
+
+    def add_tile(self, im, x, y, weights=None):
+        """Add a tile, weights can be TileWeights, an array or None"""
+        if isinstance(weights, TileWeights):
+            # blend one constant weight rectangle at a time
+            for (l, r, t, b, v) in weights.rects():
+                self.add(im[t:b, l:r], x + l, y + t, v)
+        elif weights is None:
+            self.add(im, x, y)
+        else:
+            self.add(im * weights, x, y)
+
+    def read(self, left, right, top, bottom):
+        """Read a region (canvas coords) into a new array"""
+        out = numpy.zeros((bottom - top, right - left), dtype=self.dtype)
+        for (key, cs, rs) in self._regions(left, right, top, bottom):
+            if key in self.chunks:
+                out[rs] = self.chunks[key][cs]
+            elif key in self.stored:
+                out[rs] = numpy.load(
+                    self.chunk_filename(key), mmap_mode='r')[cs]
+        return out
+
+    def to_array(self):
+        return self.read(*self.bbox)
+
+    def flush(self):
+        """Write all cached chunks to disk (and empty the cache)"""
+        while len(self.chunks):
+            self._write_chunk(*self.chunks.popitem(last=False))
+        self.save_meta()
+
+
+def read_tile(tile):
+    """Read a tile from a tif filename (memory mapped) or pass it through"""
+    if isinstance(tile, (str, unicode)):
+        from ..tifio import raw
+        return raw.read_tif(tile, memmap=True)[0]
+    return tile
+
+
+def stream_stitch(
+        tiles, shifts, canvas, weights=None, shapes=None, reader=None):
+    """Stitch tiles into a ChunkedCanvas reading one tile at a time
+
+    tiles : tif filenames or arrays (read with reader, see read_tile)
+    shapes : tile shapes, needed to compute weights when not provided
+    Tiles are visited in row-major order of their shifts so chunks
+    shared by neighbouring tiles are still in the chunk cache.
+    """
+    if reader is None:
+        reader = read_tile
+    if weights is None:
+        if shapes is None:
+            shapes = [reader(t).shape for t in tiles]
+        weights = calculate_tile_weights(shapes, shifts)
+    order = sorted(
+        xrange(len(tiles)), key=lambda i: (shifts[i][1], shifts[i][0]))
+    for i in order:
+        im = reader(tiles[i])
+        canvas.add_tile(im, int(shifts[i][0]), int(shifts[i][1]), weights[i])
+        del im
+    canvas.flush()
+    return canvas
+
+
+def downsample_image(im, ds):
+    """Area downsample im by ds to (height / ds, width / ds)"""
+    if ds == 1:
+        return im
+    h, w = im.shape[:2]
+    return cv2.resize(
+        numpy.asarray(im), (int(w / ds), int(h / ds)),
+        interpolation=cv2.INTER_AREA)
+
+
+class TilePyramid(object):
+    """Power of two downsampled levels of tiles cached in a directory
+
+    The first time a tile (filename) is requested at any ds > 1, levels
+    2, 4, ... 2 ** max_level are computed from one read of the tile
+    and saved to directory as a single .npz. Later requests load only
+    the nearest level (the largest power of two <= ds) and, if ds is
+    not a power of two, downsample that level the rest of the way.
+    Cache entries are keyed by path, size and modification time.
+    """
+    def __init__(self, directory, max_level=6, reader=None):
+        self.directory = os.path.expanduser(directory)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.max_level = int(max_level)
+        if reader is None:
+            reader = read_tile
+        self.reader = reader
+        self.n_builds = 0
+
+    def cache_filename(self, tile):
+        fn = os.path.abspath(os.path.expanduser(tile))
+        st = os.stat(fn)
+        k = hashlib.md5(
+            '%s:%i:%f' % (fn, st.st_size, st.st_mtime)).hexdigest()
+        return os.path.join(self.directory, k + '.npz')
+
+    def build(self, tile):
+        """Compute and save all levels of a tile, returns the cache fn"""
+        cfn = self.cache_filename(tile)
+        im = numpy.asarray(self.reader(tile))
+        levels = {'shape': numpy.array(im.shape)}
+        for l in xrange(1, self.max_level + 1):
+            if min(im.shape[:2]) < 2:
+                break
+            im = downsample_image(im, 2)
+            levels['l%i' % l] = im
+        logger.debug(
+            "TilePyramid[%s] caching %s levels of %s to %s",
+            self, len(levels) - 1, tile, cfn)
+        # write to a temporary file so a partial cache is never read
+        tfn = cfn[:-4] + '.tmp.npz'
+        numpy.savez(tfn, **levels)
+        os.rename(tfn, cfn)
+        self.n_builds += 1
+        return cfn
+
+    def get(self, tile, ds=1):
+        """Return tile downsampled by ds"""
+        if ds == 1:
+            return self.reader(tile)
+        level = min(int(numpy.log2(ds)), self.max_level)
+        if level < 1:
+            # no cached level is small enough (ds < 2)
+            return downsample_image(self.reader(tile), ds)
+        cfn = self.cache_filename(tile)
+        if not os.path.exists(cfn):
+            self.build(tile)
+        c = numpy.load(cfn)
+        try:
+            shape = c['shape']
+            while level > 0 and 'l%i' % level not in c.files:
+                level -= 1
+            if level == 0:
+                # tile too small (or max_level 0) to cache any levels
+                return downsample_image(self.reader(tile), ds)
+            im = c['l%i' % level]
+        finally:
+            c.close()
+        if ds == 2 ** level:
+            return im
+        # finish downsampling from the nearest cached level
+        return cv2.resize(
+            im, (int(shape[1] / ds), int(shape[0] / ds)),
+            interpolation=cv2.INTER_AREA)
+
+
 class Stitcher(object):
-    def __init__(self, max_height, max_width, shifts):
+    def __init__(self, max_height, max_width, shifts, cache_directory=None):
         # these are the shifts at 1x downsampling (full size)
         #self.full_size = (float(max_height), float(max_width))
         self.full_size = (
@@ -202,6 +587,9 @@ class Stitcher(object):
         # self._canvases
         #self.shifts = [map(float, s) for s in shifts]
         self.shifts = [map(int, s) for s in shifts]
+        self.pyramid = None
+        if cache_directory is not None:
+            self.pyramid = TilePyramid(cache_directory)
 
     @property
     def shifts(self):
@@ -213,8 +601,9 @@ class Stitcher(object):
             1: value}
         # reset cache
         shapes = [self.full_size] * len(value)
+        # full size weights are kept as TileWeights (rectangles)
         self._weights = {
-            1: calculate_weights(shapes, value)}
+            1: calculate_tile_weights(shapes, value)}
         self._bboxes = {
             1: calculate_bounding_box(shapes, value)}
         self._canvases = {
@@ -222,7 +611,7 @@ class Stitcher(object):
 
     def lookup_weights(self, ds):
         if ds not in self._weights:
-            self._weights[ds] = [w[::ds, ::ds] for w in self._weights[1]]
+            self._weights[ds] = [w.expand(int(ds)) for w in self._weights[1]]
         return self._weights[ds]
 
     def lookup_bbox(self, ds):
@@ -245,6 +634,25 @@ class Stitcher(object):
         c[:, :] = 0.
         return c
 
+    def stream(self, tiles, directory, chunk_size=2048, cache_size=16):
+        """Stitch full size tiles (filenames) into a ChunkedCanvas"""
+        canvas = ChunkedCanvas(
+            directory, self.lookup_bbox(1), chunk_size, cache_size)
+        return stream_stitch(
+            tiles, self.shifts, canvas, self.lookup_weights(1))
+
+    def stitch_tiles(self, tiles, ds=1, shifts=None):
+        """Stitch tiles (filenames) at downsample ds
+
+        If a cache_directory was provided, tiles are read from the
+        cached pyramid instead of being re-read at full size.
+        """
+        if self.pyramid is None:
+            ims = [downsample_image(read_tile(t), ds) for t in tiles]
+        else:
+            ims = [self.pyramid.get(t, ds) for t in tiles]
+        return self.stitch(ims, shifts)
+
     def compute(self, ims, tcrops, mcrops):
         pass
 
@@ -258,7 +666,7 @@ class Stitcher(object):
             raise Exception(
                 "Failed to stitch images, nonuniform downsampling %s %s"
                 % (dsx, dsy))
-        ds = dsx
+        ds = int(dsx)
         for im in ims[1:]:
             if im.shape != s:
                 raise Exception(
@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 
+import os
+import shutil
+import tempfile
 import unittest
 
 import numpy
@@ -8,8 +11,14 @@ import scipy.misc
 
 from . import contrast
 from . import cropping
+from . import focus
+from . import histogram
+from . import linearpolar
+from . import normalize
 from . import oo
 from . import shift
+from . import stats
+from . import stitching
 
 from ...config.checkers import require
 from ...config.base import ConfigError
@@ -57,6 +66,99 @@ class ContrastTest(unittest.TestCase):
         self.assertEqual(t, r)
 
 
+class BatchTest(unittest.TestCase):
+    def stack(self):
+        rs = numpy.random.RandomState(0)
+        ims = [rs.randint(0, 4096, (60, 70)).astype('u2') for _ in xrange(4)]
+        ims[2][:] = 7
+        s = cropping.as_stack(ims)
+        self.assertEqual(s.shape, (4, 60, 70))
+        self.assertIs(cropping.as_stack(ims, out=s), s)
+        self.assertTrue(numpy.all(cropping.crop_stack(s, 20)[1] ==
+                                  cropping.crop(ims[1], 20)))
+        out = numpy.empty(4)
+        r = contrast.check_contrast_stack(ims, 20, out=out)
+        self.assertIs(r, out)
+        for (im, v) in zip(ims, r):
+            self.assertAlmostEqual(contrast.check_contrast(im, 20), v)
+        counts, edges = histogram.histogram_stack(s, 50)
+        for i in (0, 1, 3):
+            c, e = histogram.histogram(ims[i], bins=50)
+            self.assertTrue(numpy.all(c == counts[i]))
+            self.assertTrue(numpy.allclose(e, edges[i]))
+        self.assertEqual(counts[2].sum(), 0)
+
+    def contrast_checker(self):
+        rs = numpy.random.RandomState(1)
+        s = rs.randint(0, 4096, (3, 60, 70)).astype('u2')
+        s[1] = 7
+        cc = oo.ContrastChecker({'crop': 20, 'min': 100})
+        self.assertEqual(list(cc.submit_batch(s)), [True, False, True])
+        self.assertEqual(len(cc.results), 3)
+
+
+class NormalizeTest(unittest.TestCase):
+    def normalize(self):
+        rs = numpy.random.RandomState(0)
+        # strided like a camera grab
+        grab = rs.randint(0, 4096, (300, 320)).astype('u2')[:, :300]
+        bg = rs.rand(300, 300).astype('f4') + 0.5
+        t = grab * bg
+        crop = cropping.calculate_crop(t, 100)
+        kernels = ['numpy']
+        if normalize.has_numba:
+            kernels.append('compiled')
+        for k in kernels:
+            out = numpy.empty((300, 300), dtype='f4')
+            r = normalize.normalize(grab, bg, out, crop, kernel=k)
+            self.assertTrue(numpy.allclose(out, t))
+            self.assertAlmostEqual(r, numpy.std(cropping.crop(t, 100)), 2)
+            r = normalize.normalize(grab, bg, out, kernel=k)
+            self.assertAlmostEqual(r, numpy.std(t), 2)
+        with self.assertRaises(ValueError):
+            normalize.normalize(grab, bg, out, kernel='error')
+
+
+class FocusTest(unittest.TestCase):
+    def psd_focus(self):
+        rs = numpy.random.RandomState(0)
+        im = rs.rand(64, 80)
+        xy = linearpolar.compute_image_xy_cart(im, phase_width=100)
+        p = linearpolar.img2polar(im, phase_width=100, xy_cart=xy)
+        self.assertEqual(p.shape, (32, 100))
+        self.assertTrue(numpy.all(
+            p == linearpolar.img2polar(im, phase_width=100)))
+        # polar indices are cached
+        i = linearpolar.polar_indices(im.shape, (40, 32), 32, 0, 100)
+        self.assertIs(
+            i, linearpolar.polar_indices(im.shape, (40, 32), 32, 0, 100))
+        f = focus.psd_focus(im, phase_width=100)
+        self.assertEqual(f.shape, (32, ))
+
+
+class StatsTest(unittest.TestCase):
+    def compute(self):
+        rs = numpy.random.RandomState(0)
+        im = rs.randint(0, 4096, (300, 300)).astype('u2')
+        c = cropping.crop(im, 100).astype('f4')
+        e = stats.StatsEngine(crop=100)
+        r = e.compute(im)
+        self.assertEqual(sorted(r.keys()), sorted(stats.all_measures))
+        self.assertAlmostEqual(r['mean'], numpy.mean(c), 2)
+        self.assertAlmostEqual(r['std'], numpy.std(c), 2)
+        self.assertAlmostEqual(
+            r['focus'], focus.gradient_focus(c), delta=r['focus'] * 1e-4)
+        self.assertEqual(len(r['histogram'][0]), 256)
+        # only requested measures are computed
+        r = e.compute(im, ['std'])
+        self.assertEqual(r.keys(), ['std'])
+        # subsampled
+        e = stats.StatsEngine(crop=100, stride=2)
+        r = e.compute(im, ['mean', 'std'])
+        self.assertAlmostEqual(r['mean'], numpy.mean(c[::2, ::2]), 2)
+        self.assertEqual(e._sub.shape, (50, 50))
+
+
 class ShiftTest(unittest.TestCase):
     def parse_shift_results(self):
         a = [numpy.zeros((5, 5)) for _ in xrange(4)]
@@ -110,6 +212,51 @@ class ShiftTest(unittest.TestCase):
         for sr in r:
             self.assertLess(sr['m'], 0.95)
 
+    def phase_correlate(self):
+        im = numpy.random.RandomState(0).rand(300, 300).astype('f4')
+        c = cropping.calculate_crop(im, 200)
+        crop = lambda dy, dx: im[
+            c[0][0] + dy:c[0][1] + dy,
+            c[1][0] + dx:c[1][1] + dx,
+        ]
+        ims = [crop(0, 0), crop(0, 0), crop(3, -7), crop(-20, 15)]
+        t = shift.find_shifts(
+            ims, tcrop=100, mcrop=150, method='TM_CCORR_NORMED')
+        r = shift.find_shifts(
+            ims, tcrop=100, mcrop=150, method='PHASE_CORR')
+        self.assertEqual(len(r), len(ims) - 1)
+        for (sr, st) in zip(r, t):
+            for k in ('x', 'y', 'd'):
+                self.assertEqual(sr[k], st[k])
+            self.assertAlmostEqual(sr['m'], st['m'], 4)
+        pc = shift.PhaseCorrelator(100, 150, subpixel=True)
+        pc.set_template(ims[0])
+        r = pc.match(ims[2])
+        self.assertAlmostEqual(r['sx'], 7, 0)
+        self.assertAlmostEqual(r['sy'], -3, 0)
+        pc.set_template(None)
+        self.assertIsNone(pc.template)
+
+    def accumulate(self):
+        rs = numpy.random.RandomState(0)
+        ims = [rs.rand(20, 30).astype('f4') for _ in xrange(3)]
+        shifts = [dict(x=2, y=-3), dict(x=-4, y=1)]
+        total = numpy.zeros((20, 30), dtype='f4')
+        count = numpy.zeros((20, 30), dtype='f4')
+        shift.accumulate(total, count, ims[0])
+        for (im, s) in zip(ims[1:], shifts):
+            shift.accumulate(total, count, im, s)
+        self.assertEqual(count.max(), 3)
+        self.assertEqual(count.min(), 1)
+        self.assertEqual(count[3, 0], 2)
+        self.assertAlmostEqual(total[3, 0], ims[0][3, 0] + ims[1][0, 2])
+        self.assertAlmostEqual(total[0, 4], ims[0][0, 4] + ims[2][1, 0])
+        t = ims[0][5:10, 5:10] + ims[1][2:7, 7:12] + ims[2][6:11, 1:6]
+        self.assertTrue(numpy.allclose(total[5:10, 5:10], t))
+        # shifts larger than the image contribute nothing
+        shift.accumulate(total, count, ims[0], dict(x=30, y=0))
+        self.assertEqual(count.max(), 3)
+
     def deshift(self):
         lena = scipy.misc.lena()
         c = cropping.calculate_crop(lena, 100)
@@ -134,6 +281,114 @@ class ShiftTest(unittest.TestCase):
         #pylab.show()
 
 
+class StitchTest(unittest.TestCase):
+    def calculate_weights(self):
+        rs = numpy.random.RandomState(0)
+        shape = (40, 50)
+        shifts = [
+            [c * 45 + rs.randint(-3, 4), r * 35 + rs.randint(-3, 4)]
+            for r in xrange(4) for c in xrange(5)]
+        shapes = [shape] * len(shifts)
+        # brute force: count every overlapping tile
+        bws = []
+        for s in shifts:
+            w = numpy.ones(shape)
+            for s2 in shifts:
+                if s2 is s:
+                    continue
+                l, t = s2[0] - s[0], s2[1] - s[1]
+                w[max(t, 0):max(t + shape[0], 0),
+                  max(l, 0):max(l + shape[1], 0)] += 1
+            bws.append(1. / w)
+        index = stitching.TileIndex(shapes, shifts)
+        self.assertEqual(list(index.neighbours(0)), [1, 5, 6])
+        tws = stitching.calculate_tile_weights(shapes, shifts, index)
+        ws = stitching.calculate_weights(shapes, shifts)
+        for (bw, tw, w) in zip(bws, tws, ws):
+            self.assertTrue(numpy.allclose(bw, w))
+            self.assertTrue(numpy.allclose(bw[::3, ::3], tw.expand(3)))
+            self.assertLess(tw.nbytes, bw.nbytes)
+            r = numpy.zeros(shape)
+            for (l, rt, t, b, v) in tw.rects():
+                r[t:b, l:rt] = v
+            self.assertTrue(numpy.allclose(bw, r))
+        ims = [rs.rand(*shape) for _ in shifts]
+        self.assertTrue(numpy.allclose(
+            stitching.stitch(ims, shifts, bws),
+            stitching.stitch(ims, shifts, tws)))
+
+    def chunked_canvas(self):
+        rs = numpy.random.RandomState(1)
+        shape = (40, 50)
+        shifts = [
+            [c * 45 + rs.randint(-3, 4), r * 35 + rs.randint(-3, 4)]
+            for r in xrange(3) for c in xrange(3)]
+        ims = [rs.rand(*shape) for _ in shifts]
+        d = tempfile.mkdtemp()
+        try:
+            bbox = stitching.calculate_bounding_box(
+                [shape] * len(shifts), shifts)
+            canvas = stitching.ChunkedCanvas(
+                d, bbox, chunk_size=16, cache_size=3, dtype='f8')
+            stitching.stream_stitch(ims, shifts, canvas)
+            self.assertEqual(len(canvas.chunks), 0)
+            self.assertGreater(canvas.n_loads, 0)
+            s = stitching.stitch(ims, shifts)
+            self.assertTrue(numpy.allclose(canvas.to_array(), s))
+            c = stitching.ChunkedCanvas.open(d)
+            self.assertTrue(numpy.allclose(
+                c.read(bbox[0] + 30, bbox[0] + 70, bbox[2] + 5, bbox[2] + 50),
+                s[5:50, 30:70]))
+            # opening does not overwrite the stored chunk list
+            c = stitching.ChunkedCanvas.open(d)
+            self.assertEqual(c.stored, canvas.stored)
+            self.assertTrue(numpy.allclose(c.to_array(), s))
+        finally:
+            shutil.rmtree(d)
+
+    def pyramid(self):
+        rs = numpy.random.RandomState(2)
+        shape = (64, 80)
+        shifts = [[0, 0], [70, 2], [1, 56], [72, 54]]
+        d = tempfile.mkdtemp()
+        try:
+            fns = []
+            for i in xrange(len(shifts)):
+                fns.append(os.path.join(d, '%i.npy' % i))
+                numpy.save(fns[-1], rs.rand(*shape).astype('f4'))
+            p = stitching.TilePyramid(
+                os.path.join(d, 'cache'), max_level=2, reader=numpy.load)
+            im = numpy.load(fns[0])
+            self.assertTrue(numpy.allclose(
+                p.get(fns[0], 2), stitching.downsample_image(im, 2)))
+            self.assertEqual(p.n_builds, 1)
+            self.assertEqual(p.get(fns[0], 4).shape, (16, 20))
+            self.assertEqual(p.get(fns[0], 8).shape, (8, 10))
+            self.assertEqual(p.get(fns[0], 3).shape, (21, 26))
+            self.assertEqual(p.n_builds, 1)
+            # ds < 2 reads the tile
+            self.assertTrue(numpy.allclose(
+                p.get(fns[0], 1.5), stitching.downsample_image(im, 1.5)))
+            self.assertEqual(p.n_builds, 1)
+            # a cache without levels reads the tile
+            cd = os.path.join(d, 'cache0')
+            stitching.TilePyramid(
+                cd, max_level=0, reader=numpy.load).build(fns[0])
+            p0 = stitching.TilePyramid(cd, max_level=2, reader=numpy.load)
+            self.assertTrue(numpy.allclose(
+                p0.get(fns[0], 4), stitching.downsample_image(im, 4)))
+            self.assertEqual(p0.n_builds, 0)
+            s = stitching.Stitcher(shape[0], shape[1], shifts)
+            s.pyramid = p
+            c = s.stitch_tiles(fns, 4)
+            self.assertEqual(p.n_builds, len(fns))
+            self.assertEqual(c.shape, (30, 38))
+            c = s.stitch_tiles(fns, 4)
+            self.assertEqual(p.n_builds, len(fns))
+        finally:
+            shutil.rmtree(d)
+
+
 class OOTest(unittest.TestCase):
     def kwarg_checker(self):
         def foo(a, b=None, c=None):
@@ -219,9 +474,19 @@ suite = unittest.TestSuite()
 suite.addTest(CropTest('calculate_crop'))
 suite.addTest(CropTest('crop'))
 suite.addTest(ContrastTest('check_contrast'))
+suite.addTest(BatchTest('stack'))
+suite.addTest(BatchTest('contrast_checker'))
+suite.addTest(NormalizeTest('normalize'))
+suite.addTest(FocusTest('psd_focus'))
+suite.addTest(StatsTest('compute'))
 suite.addTest(ShiftTest('parse_shift_results'))
 suite.addTest(ShiftTest('find_shifts'))
+suite.addTest(ShiftTest('phase_correlate'))
+suite.addTest(ShiftTest('accumulate'))
 suite.addTest(ShiftTest('deshift'))
+suite.addTest(StitchTest('calculate_weights'))
+suite.addTest(StitchTest('chunked_canvas'))
+suite.addTest(StitchTest('pyramid'))
 suite.addTest(OOTest('kwarg_checker'))
 suite.addTest(OOTest('validate'))
 suite.addTest(OOTest('configure'))
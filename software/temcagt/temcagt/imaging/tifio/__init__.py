@@ -2,6 +2,7 @@
 
 from . import oo
 from . import raw
-from .oo import FakeSaver, TifSaver, ThreadedSaver
+from .oo import AsyncSaver, FakeSaver, TifSaver, ThreadedSaver
 
-__all__ = ['oo', 'raw', 'FakeSaver', 'TifSaver', 'ThreadedSaver']
+__all__ = [
+    'oo', 'raw', 'AsyncSaver', 'FakeSaver', 'TifSaver', 'ThreadedSaver']
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+Benchmark tif write throughput and compression ratio
+
+Writes frames with each compression setting (see raw.write_tif) and
+reports write throughput (MB/s of uncompressed image data) and the
+compression ratio (image bytes / file bytes). Frames are synthetic
+(smooth structure + shot noise) or read from recorded tifs.
+
+    python -m temcagt.imaging.tifio.benchmark -n 20
+    python -m temcagt.imaging.tifio.benchmark \\
+        -r '/data/session/0/0001/*_m.tif' -s none lzw deflate:2 zstd
+
+Settings are compression[:predictor], e.g. deflate:1 for no predictor.
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+
+from ... import config
+from ... import log
+from . import raw
+
+
+logger = log.get_logger(__name__)
+
+default_settings = ['none', 'lzw', 'deflate', 'deflate:1', 'zstd']
+
+
+def synthetic_frames(n, shape=(2048, 2048), seed=0):
+    """u2 frames of smooth structure with shot noise (~12 bits)"""
+    rs = numpy.random.RandomState(seed)
+    y, x = numpy.mgrid[:shape[0], :shape[1]].astype('f4')
+    for i in xrange(n):
+        f = rs.uniform(0.005, 0.02, 4)
+        s = 1500. + 500. * (
+            numpy.sin(x * f[0] + y * f[1] + i) *
+            numpy.cos(x * f[2] - y * f[3]))
+        yield rs.poisson(s).astype('u2')
+
+
+def recorded_frames(pattern, n):
+    fns = sorted(glob.glob(os.path.expanduser(pattern)))
+    if not len(fns):
+        raise IOError("No files found for %s" % pattern)
+    for i in xrange(n):
+        yield raw.read_tif(fns[i % len(fns)], memmap=False)[0]
+
+
+def parse_setting(s):
+    """Parse compression[:predictor] into (compression, predictor)"""
+    if ':' in s:
+        c, p = s.split(':')
+        p = int(p)
+    else:
+        c, p = s, None
+    if c == 'none':
+        c = None
+    return c, p
+
+
+def run(frames, settings=None, directory=None):
+    """Write frames with each setting, returns a dict of results"""
+    if settings is None:
+        settings = default_settings
+    frames = list(frames)
+    cleanup = directory is None
+    if directory is None:
+        directory = tempfile.mkdtemp()
+    results = {}
+    try:
+        for s in settings:
+            c, p = parse_setting(s)
+            n_bytes, f_bytes, t = 0, 0, 0.
+            for (i, im) in enumerate(frames):
+                fn = os.path.join(directory, '%s_%i.tif' % (s, i))
+                t0 = time.time()
+                raw.write_tif(fn, im, compression=c, predictor=p)
+                t += time.time() - t0
+                n_bytes += im.nbytes
+                f_bytes += os.path.getsize(fn)
+                if i == 0:
+                    r, _ = raw.read_tif(fn)
+                    if not numpy.array_equal(r, im):
+                        raise ValueError("Setting %s is not lossless" % s)
+                os.remove(fn)
+            results[s] = {
+                'n': len(frames),
+                'seconds': t,
+                'mb_per_second': n_bytes / t / 1E6 if t else 0.,
+                'ratio': n_bytes / float(f_bytes),
+            }
+    finally:
+        if cleanup:
+            shutil.rmtree(directory)
+    return results
+
+
+def report(results, f=sys.stdout):
+    f.write("%-12s %6s %10s %8s\n" % ('setting', 'n', 'MB/s', 'ratio'))
+    for s in sorted(results, key=lambda s: -results[s]['ratio']):
+        r = results[s]
+        f.write("%-12s %6i %10.1f %8.2f\n" % (
+            s, r['n'], r['mb_per_second'], r['ratio']))
+
+
+def command_line_run(args=None):
+    p = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    p.add_argument('-n', '--frames', type=int, default=10)
+    p.add_argument('-r', '--recorded', help="glob of tifs to use as frames")
+    p.add_argument(
+        '-s', '--settings', nargs='+', default=default_settings,
+        help="compression[:predictor] settings to test")
+    p.add_argument('-d', '--directory', help="directory to write to")
+    p.add_argument('-o', '--output', help="save results (json) here")
+    a = p.parse_args(args)
+    if a.recorded is not None:
+        frames = recorded_frames(a.recorded, a.frames)
+    else:
+        frames = synthetic_frames(a.frames)
+    results = run(frames, a.settings, a.directory)
+    report(results)
+    if a.output is not None:
+        with open(a.output, 'w') as f:
+            json.dump(results, f, cls=config.parser.NumpyAwareParser)
+    return results
+
+
+if __name__ == '__main__':
+    command_line_run()
@@ -6,6 +6,7 @@ import threading
 import Queue
 import weakref
 
+import concurrent.futures
 import numpy
 
 from ... import log
@@ -81,81 +82,213 @@ class TifSaver(Saver):
         [self.save_image(im, fn_format) for im in ims]
 
 
-def _save_thread(weak_self, dtype):
-    while True:
+class QueueFull(Exception):
+    pass
+
+
+def _save_thread(weak_self, queue, stop):
+    while not stop.is_set():
+        try:
+            item = queue.get(True, thread_timeout)
+        except Queue.Empty:
+            if weak_self() is None:
+                break
+            continue
+        if item is None:
+            queue.task_done()
+            break
         self = weak_self()
         if self is None:
             break
-        if self._stop.is_set():
-            break
         try:
-            # get next images in queue
-            ims, fnf = self._queue.get(True, thread_timeout)
-            for (i, im) in enumerate(ims):
-                im.meta['grab'] = i
-                im.meta['x'] = im.meta.get('x', 0)
-                im.meta['y'] = im.meta.get('y', 0)
-                im.meta['row'] = im.meta.get('row', 999)
-                im.meta['col'] = im.meta.get('col', 999)
-                # save them
-                if im.dtype != dtype:
-                    raw_save(im.astype(dtype), fnf, self.directory)
-                else:
-                    raw_save(im, fnf, self.directory)
-            self._queue.task_done()
-        except Queue.Empty:
-            pass
+            self._write(*item)
+        finally:
+            queue.task_done()
         del self
 
 
-class ThreadedSaver(TifSaver):
-    def __init__(self, directory=None, dtype=None):
-        super(ThreadedSaver, self).__init__(directory, dtype)
-        self._thread = None
-        self._queue = Queue.Queue()
+class AsyncSaver(TifSaver):
+    """
+    Save images from a pool of writer threads
+
+    workers : number of writer threads
+    max_queue : maximum number of queued images (0 = unbounded)
+    policy : what to do when the queue is full
+        'block' wait (up to timeout seconds) for space
+        'drop' drop the image (its future fails with QueueFull)
+
+    save_image returns a concurrent.futures.Future that resolves to
+    the saved filename. flush waits for every image queued before it.
+    """
+    def __init__(
+            self, directory=None, dtype=None, workers=2, max_queue=16,
+            policy='block', timeout=None):
+        super(AsyncSaver, self).__init__(directory, dtype)
+        if policy not in ('block', 'drop'):
+            raise ValueError("Invalid queue policy: %s" % policy)
+        self.policy = policy
+        self.timeout = timeout
+        self.n_workers = max(1, int(workers))
+        self._queue = Queue.Queue(max_queue)
         self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._threads = []
+        self.clear_stats()
+        self.start()
+
+    def start(self):
+        if len(self._threads):
+            return
         self._stop.clear()
-        self._start_thread()
+        for i in xrange(self.n_workers):
+            t = threading.Thread(
+                target=_save_thread,
+                args=(weakref.ref(self), self._queue, self._stop))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        logger.debug(
+            "%s[%s] started %s threads",
+            type(self).__name__, self, len(self._threads))
+
+    def stop(self, wait=True):
+        """Stop the writer threads (after the queue empties if wait)"""
+        if not len(self._threads):
+            return
+        logger.debug("%s[%s] stopping threads", type(self).__name__, self)
+        if wait:
+            for _ in self._threads:
+                self._queue.put(None)
+        else:
+            self._stop.set()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        # cancel anything left in the queue
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if item is not None:
+                item[2].cancel()
+                with self._lock:
+                    self._pending.discard(item[2])
+
+    def clear_stats(self):
+        with self._lock:
+            # seconds is the summed write time of all workers
+            self._stats = {
+                'n': 0, 'dropped': 0, 'errors': 0,
+                'bytes': 0, 'seconds': 0.}
+            self._stats_start = time.time()
+
+    def get_stats(self):
+        """Save counts and throughput since the last clear_stats
+
+        bytes_per_second is the aggregate (all worker) throughput over
+        the wall time since clear_stats, write_seconds is the mean time
+        for one write
+        """
+        with self._lock:
+            s = self._stats.copy()
+            s['in_flight'] = len(self._pending)
+            s['elapsed'] = time.time() - self._stats_start
+        s['queue_depth'] = self._queue.qsize()
+        if s['elapsed'] > 0:
+            s['bytes_per_second'] = s['bytes'] / s['elapsed']
+        else:
+            s['bytes_per_second'] = 0.
+        if s['n'] > 0:
+            s['write_seconds'] = s['seconds'] / s['n']
+        else:
+            s['write_seconds'] = 0.
+        return s
 
-    def _start_thread(self):
-        if self._thread is not None:
-            self._stop_thread()
+    def _write(self, im, fn_format, future):
+        try:
+            if not future.set_running_or_notify_cancel():
+                return
+            t0 = time.time()
+            if im.dtype != self._dtype:
+                im = im.astype(self._dtype)
+            fn = resolve_filename(im.meta, fn_format, self.directory)
+            raw.write_tif(fn, im, **im.meta)
+            dt = time.time() - t0
+            with self._lock:
+                self._stats['n'] += 1
+                self._stats['bytes'] += im.nbytes
+                self._stats['seconds'] += dt
+            future.set_result(fn)
+        except Exception as e:
+            logger.error(
+                "%s[%s] failed to save image: %s",
+                type(self).__name__, self, e, exc_info=True)
+            with self._lock:
+                self._stats['errors'] += 1
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._pending.discard(future)
 
-        self._thread = threading.Thread(
-            target=_save_thread, args=(weakref.ref(self), self._dtype))
-        self._thread.daemon = True
-        logger.debug("ThreadedSaver[%s] starting thread", self)
-        self._thread.start()
-        logger.debug("ThreadedSaver[%s] thread started", self)
+    def save_image(self, im, fn_format):
+        f = concurrent.futures.Future()
+        with self._lock:
+            self._pending.add(f)
+        try:
+            self._queue.put(
+                (im, fn_format, f), self.policy == 'block', self.timeout)
+        except Queue.Full:
+            logger.warning(
+                "%s[%s] queue full, dropping image",
+                type(self).__name__, self)
+            with self._lock:
+                self._pending.discard(f)
+                self._stats['dropped'] += 1
+            f.set_exception(QueueFull(
+                "Save queue full [%s]" % self._queue.maxsize))
+        return f
 
-    def _stop_thread(self):
-        if self._thread is None:
-            return
-        logger.debug("ThreadedSaver[%s] stopping thread", self)
+    def save_images(self, ims, fn_format):
+        if not isinstance(ims, (list, tuple)):
+            raise ValueError(
+                "save_images expects a list or tuple not %s" % (type(ims)))
+        return [self.save_image(im, fn_format) for im in ims]
+
+    def flush(self, timeout=None):
+        """Wait for all images queued so far to be saved
+
+        Returns True if all were saved (or failed) before timeout
+        """
+        with self._lock:
+            fs = list(self._pending)
+        done, not_done = concurrent.futures.wait(fs, timeout)
+        return len(not_done) == 0
+
+    def __del__(self):
+        logger.debug("%s[%s] __del__", type(self).__name__, self)
         self._stop.set()
-        time.sleep(thread_timeout * 2)
-        logger.debug("ThreadedSaver[%s] joining thread", self)
-        self._thread.join()
-        logger.debug("ThreadedSaver[%s] thread joined", self)
-        self._thread = None
 
-    def save_image(self, im, fn_format):
-        self.save_images([im, ], fn_format)
+
+class ThreadedSaver(AsyncSaver):
+    """Single writer thread with an unbounded queue"""
+    def __init__(self, directory=None, dtype=None):
+        super(ThreadedSaver, self).__init__(
+            directory, dtype, workers=1, max_queue=0)
 
     def save_images(self, ims, fn_format):
         logger.debug("ThreadedSaver[%s] save_image", self)
-        #for i in ims:
-        #    logger.debug(
-        #        "save_images filename: %s" %
-        #        resolve_filename(i.meta, fn_format))
         if not isinstance(ims, (list, tuple)):
             raise ValueError(
                 "save_images expects a list or tuple not %s" % (type(ims)))
-        #logger.debug(
-        #    "ThreadedSaver[%s] metric %s",
-        #    self, ims[0].meta.get('metric', None))
-        self._queue.put((ims, fn_format))
+        for (i, im) in enumerate(ims):
+            im.meta['grab'] = i
+            im.meta['x'] = im.meta.get('x', 0)
+            im.meta['y'] = im.meta.get('y', 0)
+            im.meta['row'] = im.meta.get('row', 999)
+            im.meta['col'] = im.meta.get('col', 999)
+        return [AsyncSaver.save_image(self, im, fn_format) for im in ims]
 
-    def __del__(self):
-        logger.debug("ThreadedSaver[%s] __del__", self)
-        self._stop_thread()
+    def save_image(self, im, fn_format):
+        return self.save_images([im, ], fn_format)[0]
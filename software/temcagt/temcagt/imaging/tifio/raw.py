@@ -4,7 +4,9 @@
 
 import json
 import datetime
+import mmap
 import os
+import struct
 
 import libtiff
 import numpy
@@ -46,42 +48,240 @@ tag_names = [
     'YResolution',
 ]
 
+tag_codes = {
+    'Artist': 315,
+    'BitsPerSample': 258,
+    'Compression': 259,
+    'Copyright': 33432,
+    'DateTime': 306,
+    'DocumentName': 269,
+    'ExtraSamples': 338,
+    'FillOrder': 266,
+    'HostComputer': 316,
+    'ImageDescription': 270,
+    'ImageLength': 257,
+    'ImageWidth': 256,
+    'Make': 271,
+    'MaxSampleValue': 281,
+    'MinSampleValue': 280,
+    'Model': 272,
+    'Orientation': 274,
+    'PlanarConfiguration': 284,
+    'Predictor': 317,
+    'ResolutionUnit': 296,
+    'RowsPerStrip': 278,
+    'SampleFormat': 339,
+    'SamplesPerPixel': 277,
+    'Software': 305,
+    'StripByteCounts': 279,
+    'StripOffsets': 273,
+    'TileWidth': 322,
+    'XPosition': 286,
+    'XResolution': 282,
+    'YPosition': 287,
+    'YResolution': 283,
+}
+
+# tiff field type: (struct format, size)
+field_types = {
+    1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8),
+    6: ('b', 1), 7: ('B', 1), 8: ('h', 2), 9: ('i', 4), 10: ('ii', 8),
+    11: ('f', 4), 12: ('d', 8), 16: ('Q', 8), 17: ('q', 8), 18: ('Q', 8),
+}
+
+# SampleFormat: numpy kind
+sample_kinds = {1: 'u', 2: 'i', 3: 'f'}
+
+# compression names accepted by write_tif (and the libtiff name)
+compressions = {
+    None: 'none',
+    'none': 'none',
+    'lzw': 'lzw',
+    'deflate': 'adobe_deflate',
+    'zstd': 'zstd',
+    'packbits': 'packbits',
+}
+
 time_format = '{0:%Y:%m:%d %H:%M:%S}\x00'
 #software_version = 'dev'  # TODO get software version
 software_version = __version_full__
 
 
+class UnmappableTif(ValueError):
+    pass
+
+
+def _read_field(buf, o, byteorder, ftype, count, bigtiff):
+    """Read the value of an IFD entry at offset o"""
+    fmt, size = field_types.get(ftype, (None, None))
+    if fmt is None:
+        return None
+    n = size * count
+    inline = 8 if bigtiff else 4
+    if n > inline:
+        o = struct.unpack_from(
+            byteorder + ('Q' if bigtiff else 'I'), buf, o)[0]
+    if ftype == 2:
+        return buf[o:o + count].rstrip('\x00')
+    if ftype in (5, 10):
+        v = struct.unpack_from(byteorder + fmt[0] * (2 * count), buf, o)
+        v = [float(v[i]) / v[i + 1] if v[i + 1] else 0.
+             for i in xrange(0, len(v), 2)]
+    else:
+        v = struct.unpack_from(byteorder + fmt * count, buf, o)
+    if count == 1:
+        return v[0]
+    return list(v)
+
+
+def read_ifd(buf):
+    """Parse the header and first IFD of a tif in buf
+
+    Returns (byteorder, tags) where tags is a dict of code: value
+    """
+    bo = {'II': '<', 'MM': '>'}.get(buf[:2], None)
+    if bo is None:
+        raise UnmappableTif("Invalid byte order: %r" % buf[:2])
+    magic = struct.unpack_from(bo + 'H', buf, 2)[0]
+    if magic == 42:
+        bigtiff = False
+        o = struct.unpack_from(bo + 'I', buf, 4)[0]
+        n = struct.unpack_from(bo + 'H', buf, o)[0]
+        o += 2
+        efmt, esize = bo + 'HHI', 12
+    elif magic == 43:
+        bigtiff = True
+        o = struct.unpack_from(bo + 'Q', buf, 8)[0]
+        n = struct.unpack_from(bo + 'Q', buf, o)[0]
+        o += 8
+        efmt, esize = bo + 'HHQ', 20
+    else:
+        raise UnmappableTif("Invalid tif magic number: %s" % magic)
+    tags = {}
+    for i in xrange(n):
+        e = o + i * esize
+        code, ftype, count = struct.unpack_from(efmt, buf, e)
+        tags[code] = _read_field(
+            buf, e + struct.calcsize(efmt), bo, ftype, count, bigtiff)
+    return bo, tags
+
+
+def _as_list(v):
+    if isinstance(v, list):
+        return v
+    return [v]
+
+
+def _tag(tags, name, default=None):
+    return tags.get(tag_codes[name], default)
+
+
+def map_tif(fn):
+    """Read an uncompressed, striped tif as a read-only memory map
+
+    The file is opened (and the IFD parsed) once, the image is a view
+    of the mapped file. Raises UnmappableTif for layouts that cannot be
+    mapped (compressed, tiled, non-contiguous strips...).
+    """
+    logger.debug("map_tif %s", fn)
+    with open(os.path.expanduser(fn), 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    bo, tags = read_ifd(buf)
+    if _tag(tags, 'Compression', 1) != 1:
+        raise UnmappableTif("Compressed tif: %s" % _tag(tags, 'Compression'))
+    if _tag(tags, 'TileWidth') is not None:
+        raise UnmappableTif("Tiled tif")
+    spp = _tag(tags, 'SamplesPerPixel', 1)
+    if spp != 1 and _tag(tags, 'PlanarConfiguration', 1) != 1:
+        raise UnmappableTif("Planar tif")
+    bits = set(_as_list(_tag(tags, 'BitsPerSample', 1)))
+    kinds = set(_as_list(_tag(tags, 'SampleFormat', 1)))
+    if len(bits) != 1 or len(kinds) != 1:
+        raise UnmappableTif("Mixed sample formats")
+    bits, kind = bits.pop(), sample_kinds.get(kinds.pop(), None)
+    if kind is None or bits not in (8, 16, 32, 64):
+        raise UnmappableTif("Unsupported sample format %s %s" % (kind, bits))
+    dtype = numpy.dtype('%s%s%i' % (bo, kind, bits / 8))
+    offsets = _as_list(_tag(tags, 'StripOffsets'))
+    counts = _as_list(_tag(tags, 'StripByteCounts'))
+    for i in xrange(1, len(offsets)):
+        if offsets[i] != offsets[i - 1] + counts[i - 1]:
+            raise UnmappableTif("Non-contiguous strips")
+    shape = (_tag(tags, 'ImageLength'), _tag(tags, 'ImageWidth'))
+    if spp != 1:
+        shape += (spp, )
+    n = int(numpy.prod(shape))
+    if sum(counts) < n * dtype.itemsize:
+        raise UnmappableTif("Strips too small for image %s" % (shape, ))
+    im = numpy.frombuffer(buf, dtype, n, offsets[0]).reshape(shape)
+    info = {}
+    for k in tag_names:
+        v = _tag(tags, k)
+        if v is not None:
+            info[k] = v
+    v = _tag(tags, 'ImageDescription')
+    if (v is not None) and (v != ''):
+        info.update(parse_description(v))
+    return im, info
+
+
 def read_tif(fn, memmap=True):
     logger.debug("read_tif %s memap? %s", fn, memmap)
-    if memmap:
-        logger.debug("read_tif loading image")
-        f = libtiff.TIFFfile(fn)
-        im = f.get_tiff_array()[0]
-        f.close()
-        logger.debug("read_tif loading info")
-        f = libtiff.TIFF.open(fn)
-        info = {}
-        for k in tag_names:
-            v = f.GetField(k)
-            if v is not None:
-                info[k] = v
-        v = f.GetField('ImageDescription')
-        if (v is not None) and (v != ''):
-            info.update(parse_description(v))
-        f.close()
+    try:
+        im, info = map_tif(fn)
+        if not memmap:
+            im = numpy.array(im)
         return im, info
-    im, info = read_tif(fn, memmap=True)
-    return numpy.asarray(im), info
+    except UnmappableTif as e:
+        logger.debug("read_tif falling back to libtiff for %s: %s", fn, e)
+    # libtiff decodes compressed strips, like map_tif only the
+    # first page (directory) of a stack is read
+    f = libtiff.TIFF.open(fn)
+    logger.debug("read_tif loading image")
+    im = f.read_image()
+    logger.debug("read_tif loading info")
+    info = {}
+    for k in tag_names:
+        v = f.GetField(k)
+        if v is not None:
+            info[k] = v
+    v = f.GetField('ImageDescription')
+    if (v is not None) and (v != ''):
+        info.update(parse_description(v))
+    f.close()
+    return im, info
 
 
-def write_tif(fn, im, **meta):
+def default_predictor(dtype):
+    """Horizontal differencing for ints, floating point for floats"""
+    if numpy.dtype(dtype).kind == 'f':
+        return 3
+    return 2
+
+
+def write_tif(
+        fn, im, compression=None, predictor=None, bigtiff=False, **meta):
     """
     Will add the current time as DateTime
     Relevant tags:
         DateTime: <timestamp> "YYYY:MM:DD HH:MM:SS"
         Model: <camera serial number>
         ImageDescription: <anything?>
+
+    compression : None (uncompressed) or a lossless compression
+        (see compressions)
+    predictor : tiff predictor (1 = none, 2 = horizontal, 3 = float)
+        if None, compressed images use default_predictor
+    bigtiff : write a BigTIFF (needed for files > 4 GB)
+    A 3d im (pages, height, width) is written as a multi-page stack
+    with meta data on the first page.
     """
+    if compression not in compressions:
+        raise ValueError("Invalid compression: %s" % compression)
+    if compressions[compression] == 'none':
+        predictor = None
+    elif predictor is None:
+        predictor = default_predictor(im.dtype)
     fn = os.path.expanduser(fn)
     logger.debug("write_tif %s %s %s", fn, hex(id(im)), meta)
     d = os.path.dirname(fn)
@@ -95,7 +295,7 @@ def write_tif(fn, im, **meta):
                 "Failed to create directory %s for saving %s [%s]" % (
                     d, fn, E))
     try:
-        t = libtiff.TIFF.open(fn, mode='w')
+        t = libtiff.TIFF.open(fn, mode='w8' if bigtiff else 'w')
     except Exception as E:
         logger.error("Failed to open file %s for saving", fn, exc_info=True)
         raise type(E)(
@@ -117,11 +317,26 @@ def write_tif(fn, im, **meta):
         meta['DateTime'] = time_format.format(meta['DateTime'])
     if 'Software' not in meta:
         meta['Software'] = software_version
-    for k in meta.keys():
-        if k in tag_names:
-            t.SetField(k, meta.pop(k))
-    t.SetField('ImageDescription', encode_description(meta))
-    t.write_image(im)
+    tags = dict([(k, meta.pop(k)) for k in meta.keys() if k in tag_names])
+    description = encode_description(meta)
+    if im.ndim == 2:
+        pages = [im]
+    else:
+        pages = im
+    for (i, p) in enumerate(pages):
+        if i == 0:
+            for k in tags:
+                t.SetField(k, tags[k])
+            t.SetField('ImageDescription', description)
+        if predictor is not None:
+            # libtiff only accepts a Predictor once Compression is set
+            t.SetField(
+                'Compression', t._fix_compression(compressions[compression]))
+            t.SetField('Predictor', predictor)
+        # write_image writes the directory (so tags are per page)
+        t.write_image(
+            numpy.ascontiguousarray(p),
+            compression=compressions[compression])
     t.close()
 
 
@@ -4,6 +4,7 @@ import os
 import tempfile
 import unittest
 
+import montage
 import numpy
 
 from . import raw
@@ -31,6 +32,32 @@ class RawReadWriteTest(unittest.TestCase):
         self.assertEqual(info['bar'], [1, 2, 3])
         self.assertEqual(info['baz'], {'a': 1})
 
+    def map_tif(self):
+        a = numpy.arange(120 * 100, dtype='u2').reshape(120, 100)
+        raw.write_tif(self.fn, a, a=1, Model="abc")
+        im, info = raw.map_tif(self.fn)
+        self.assertTrue(numpy.all(a == im))
+        self.assertFalse(im.flags.writeable)
+        self.assertEqual(info['Model'], "abc")
+        self.assertEqual(info['a'], 1)
+        im, info = raw.read_tif(self.fn, memmap=False)
+        self.assertTrue(im.flags.writeable)
+        self.assertTrue(numpy.all(a == im))
+
+    def write_compressed(self):
+        a = numpy.arange(120 * 100, dtype='u2').reshape(120, 100)
+        raw.write_tif(self.fn, a, compression='deflate', a=1)
+        im, info = raw.read_tif(self.fn)
+        self.assertTrue(numpy.all(a == im))
+        self.assertEqual(info['a'], 1)
+        self.assertLess(os.path.getsize(self.fn), a.nbytes)
+        with self.assertRaises(ValueError):
+            raw.write_tif(self.fn, a, compression='foo')
+        s = numpy.array([a, a + 1, a + 2])
+        raw.write_tif(self.fn, s, compression='lzw', bigtiff=True)
+        im, info = raw.read_tif(self.fn)
+        self.assertTrue(numpy.all(a == im))
+
     def write_tif(self):
         a = numpy.zeros((100, 100))
         raw.write_tif(self.fn, a)
@@ -93,10 +120,68 @@ class OOTest(unittest.TestCase):
         with self.assertRaises(KeyError):
             t.save_image(a, dict(y=10))
 
+    def async_saver(self):
+        t = oo.AsyncSaver(
+            os.path.dirname(self.fn_base), workers=2, max_queue=4)
+        fnf = os.path.basename(self.fn_base) + '_{i}.tif'
+        fs = []
+        for i in xrange(8):
+            a = montage.io.Image(numpy.zeros((100, 100)), {'i': i})
+            fs.append(t.save_image(a, fnf))
+            self.fns.append(self.fn_base + '_%i.tif' % i)
+        self.assertTrue(t.flush(10.))
+        for (f, fn) in zip(fs, self.fns):
+            self.assertEqual(f.result(), fn)
+            self.assertTrue(os.path.exists(fn))
+        s = t.get_stats()
+        self.assertEqual(s['n'], 8)
+        self.assertEqual(s['queue_depth'], 0)
+        self.assertEqual(s['in_flight'], 0)
+        self.assertEqual(s['dropped'], 0)
+        self.assertGreater(s['bytes_per_second'], 0)
+        self.assertLessEqual(s['write_seconds'], s['seconds'])
+        t.stop()
+
+    def async_saver_drop(self):
+        t = oo.AsyncSaver(
+            os.path.dirname(self.fn_base), workers=1, max_queue=2,
+            policy='drop')
+        fnf = os.path.basename(self.fn_base) + '_{i}.tif'
+        # stop the writer so the queue fills
+        t.stop()
+        fs = []
+        for i in xrange(4):
+            a = montage.io.Image(numpy.zeros((100, 100)), {'i': i})
+            fs.append(t.save_image(a, fnf))
+            self.fns.append(self.fn_base + '_%i.tif' % i)
+        for f in fs[2:]:
+            self.assertTrue(f.done())
+            with self.assertRaises(oo.QueueFull):
+                f.result()
+        s = t.get_stats()
+        self.assertEqual(s['dropped'], 2)
+        self.assertEqual(s['in_flight'], 2)
+        self.assertEqual(s['queue_depth'], 2)
+        # queued images are saved once the writer restarts
+        t.start()
+        self.assertTrue(t.flush(10.))
+        for (f, fn) in zip(fs[:2], self.fns[:2]):
+            self.assertEqual(f.result(), fn)
+            self.assertTrue(os.path.exists(fn))
+        self.assertFalse(os.path.exists(self.fns[2]))
+        s = t.get_stats()
+        self.assertEqual(s['n'], 2)
+        self.assertEqual(s['dropped'], 2)
+        t.stop()
+
 
 suite = unittest.TestSuite()
 suite.addTest(RawTest('encode_description'))
 suite.addTest(RawTest('parse_description'))
 suite.addTest(RawReadWriteTest('write_tif'))
 suite.addTest(RawReadWriteTest('read_tif'))
+suite.addTest(RawReadWriteTest('map_tif'))
+suite.addTest(RawReadWriteTest('write_compressed'))
 suite.addTest(OOTest('tif_saver'))
+suite.addTest(OOTest('async_saver'))
+suite.addTest(OOTest('async_saver_drop'))
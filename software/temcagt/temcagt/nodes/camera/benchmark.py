@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Benchmark the camera pipeline (all Lord/Serf processes) without a camera
+
+Runs a CameraNode (with the fake camera) through n simulated tiles and
+reports throughput, per stage latency (see tracing) and peak RSS of
+each process. Images can be replayed from a previous montage.
+
+    python -m temcagt.nodes.camera.benchmark -n 100
+    python -m temcagt.nodes.camera.benchmark -n 100 \\
+        -r '/data/session/0/0001/*_m.tif' -s /tmp/bench -o results.json
+
+Any config (json) file given with -c is cascaded over default_config.
+"""
+
+import argparse
+import copy
+import json
+import os
+import resource
+import sys
+
+from ... import config
+from ... import log
+from . import camera
+from . import tracing
+
+
+logger = log.get_logger(__name__)
+
+# cascaded over default_config
+benchmark_config = {
+    'simulate': True,
+    'broadcast': {'enable': False},
+    'save': {'directory': '/tmp/temcagt_benchmark', 'frame': True},
+    'contrast': {'min': 0.0},
+    'trace': {'enable': True},
+}
+
+
+def peak_rss(pid=None):
+    """Peak resident set size (kB) of a process"""
+    if pid is None:
+        pid = os.getpid()
+    fn = '/proc/%i/status' % pid
+    if os.path.exists(fn):
+        with open(fn, 'r') as f:
+            for l in f:
+                if l.startswith('VmHWM:'):
+                    return int(l.split()[1])
+    if pid == os.getpid():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return None
+
+
+def process_rss(node):
+    rss = {'node': peak_rss()}
+    for k in ('camera', 'norm', 'analysis', 'frame', 'stats'):
+        l = getattr(node, k)
+        if l is not None and l.process is not None:
+            rss[k] = peak_rss(l.process.pid)
+    for (i, l) in enumerate(node.saver.lords):
+        if l.process is not None:
+            rss['saver%i' % i] = peak_rss(l.process.pid)
+    return rss
+
+
+def build_config(cfg=None, replay=None, save=None):
+    c = config.parser.cascade(
+        copy.deepcopy(camera.default_config), benchmark_config)
+    if cfg is not None:
+        c = config.parser.cascade(c, config.parser.parse(cfg))
+    if replay is not None:
+        c['replay'] = {'files': replay}
+    if save is not None:
+        c['save']['directory'] = save
+    return c
+
+
+def run(cfg, n_tiles=10, n_cols=10):
+    """Run n_tiles through a CameraNode, returns a dict of results"""
+    node = camera.CameraNode(cfg)
+    node.connect()
+    try:
+        tile_times = []
+        n_vetos = 0
+        t0 = tracing.monotonic()
+        for i in xrange(n_tiles):
+            while not node.ready_to_grab():
+                node.update_controller()
+            ts = tracing.monotonic()
+            ok, _ = node.start_grab(
+                {'row': i / n_cols, 'col': i % n_cols}, in_pool=True)
+            tile_times.append(tracing.monotonic() - ts)
+            if not ok:
+                n_vetos += 1
+        c = node.controller
+        c.until(c.is_done_saving)
+        t = tracing.monotonic() - t0
+        results = {
+            'n_tiles': n_tiles,
+            'n_vetos': n_vetos,
+            'seconds': t,
+            'tiles_per_second': n_tiles / t,
+            'tile': {
+                'mean': sum(tile_times) / len(tile_times),
+                'max': max(tile_times),
+            },
+            'stages': node.get_trace_stats(),
+            'dispatch': node.get_dispatch_stats(),
+            'saver': node.get_saver_stats(),
+            'peak_rss': process_rss(node),
+        }
+        node.finish_grab()
+    finally:
+        node.disconnect()
+    return results
+
+
+def report(results, f=sys.stdout):
+    f.write(
+        "%(n_tiles)i tiles in %(seconds).2f s "
+        "[%(tiles_per_second).2f tiles/s, %(n_vetos)i vetos]\n" % results)
+    f.write("tile: mean %(mean).4f s, max %(max).4f s\n" % results['tile'])
+    f.write("stage latency [n, mean (s), max (s)]:\n")
+    for s in sorted(results['stages']):
+        st = results['stages'][s]
+        f.write("  %-12s %6i %10.4f %10.4f\n" % (
+            s, st['n'], st['mean'], st['max']))
+    f.write("peak rss [kB]:\n")
+    for p in sorted(results['peak_rss']):
+        f.write("  %-12s %s\n" % (p, results['peak_rss'][p]))
+
+
+def command_line_run(args=None):
+    p = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    p.add_argument('-n', '--tiles', type=int, default=10)
+    p.add_argument('-c', '--config', help="camera config to cascade")
+    p.add_argument('-r', '--replay', help="glob of tifs to replay")
+    p.add_argument('-s', '--save', help="directory to save frames")
+    p.add_argument('-o', '--output', help="save results (json) here")
+    a = p.parse_args(args)
+    cfg = build_config(a.config, a.replay, a.save)
+    results = run(cfg, a.tiles)
+    report(results)
+    if a.output is not None:
+        with open(a.output, 'w') as f:
+            json.dump(results, f, cls=config.parser.NumpyAwareParser)
+    return results
+
+
+if __name__ == '__main__':
+    command_line_run()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""
+Broadcast frames as raw bytes (rather than pickled images)
+
+zmq: frames are published as 2 part messages [header, data] where
+    header is json (dtype, shape, meta) and data is the frame buffer
+    sent with copy=False
+shared memory: the last frame is written to a named segment (a file in
+    /dev/shm) that co-located processes can map without a copy. The
+    segment starts with a sequence number that is odd while a frame
+    is being written. Frames (or headers) that do not fit the segment
+    are only sent over zmq.
+"""
+
+import datetime
+import json
+import mmap
+import os
+
+import numpy
+import zmq
+
+import montage
+
+from ... import config
+from ... import log
+
+
+logger = log.get_logger(__name__)
+
+shm_directory = '/dev/shm'
+# bytes reserved at the start of a shared segment for:
+#   sequence number (u8), header length (u8) and json header
+shm_prefix = 4096
+
+
+class SharedFrameOverflow(ValueError):
+    pass
+
+
+class HeaderEncoder(config.parser.NumpyAwareParser):
+    def default(self, obj):
+        if isinstance(obj, (datetime.datetime, datetime.date)):
+            return obj.isoformat()
+        try:
+            return config.parser.NumpyAwareParser.default(self, obj)
+        except TypeError:
+            return str(obj)
+
+
+def frame_header(im):
+    return json.dumps({
+        'dtype': im.dtype.str,
+        'shape': im.shape,
+        'meta': getattr(im, 'meta', {}),
+    }, cls=HeaderEncoder)
+
+
+def frame_from_parts(header, data, copy=False):
+    """Build an image from a header and a buffer (without a copy)"""
+    h = json.loads(header)
+    a = numpy.frombuffer(data, h['dtype']).reshape(h['shape'])
+    if copy:
+        a = a.copy()
+    return montage.io.Image(a, h['meta'])
+
+
+class SharedFrame(object):
+    """
+    A named shared memory segment holding the most recent frame
+
+    Create with a size (in bytes) to make a new segment, without
+    a size to attach to an existing one.
+    """
+    def __init__(self, name, size=None):
+        self.name = name
+        self.filename = os.path.join(shm_directory, name)
+        if size is not None:
+            with open(self.filename, 'wb') as f:
+                f.truncate(shm_prefix + size)
+        self.file = open(self.filename, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.size = len(self.map) - shm_prefix
+        # [sequence, header length]
+        self.counters = numpy.frombuffer(self.map, 'u8', 2)
+
+    def write(self, im, header=None):
+        if header is None:
+            header = frame_header(im)
+        if len(header) > shm_prefix - self.counters.nbytes:
+            raise SharedFrameOverflow("Header too large: %s" % len(header))
+        if im.nbytes > self.size:
+            raise SharedFrameOverflow(
+                "Frame too large for segment %s: %s > %s" % (
+                    self.name, im.nbytes, self.size))
+        self.counters[0] += 1
+        o = self.counters.nbytes
+        self.map[o:o + len(header)] = header
+        self.counters[1] = len(header)
+        d = numpy.frombuffer(self.map, im.dtype, im.size, shm_prefix)
+        d[:] = im.ravel()
+        self.counters[0] += 1
+
+    def sequence(self):
+        return int(self.counters[0])
+
+    def read(self, copy=True):
+        """Return the last frame or None if no frame or mid-write
+
+        if copy is False the frame is a view of the shared segment
+        and will change when the next frame is written
+        """
+        s = self.sequence()
+        if s == 0 or s % 2:
+            return None
+        o = self.counters.nbytes
+        h = json.loads(self.map[o:o + int(self.counters[1])])
+        n = int(numpy.prod(h['shape']))
+        a = numpy.frombuffer(
+            self.map, h['dtype'], n, shm_prefix).reshape(h['shape'])
+        if copy:
+            a = a.copy()
+            if self.sequence() != s:
+                # overwritten while copying
+                return None
+        im = montage.io.Image(a, h['meta'])
+        im.meta['sequence'] = s / 2
+        return im
+
+    def close(self):
+        del self.counters
+        self.map.close()
+        self.file.close()
+
+    def unlink(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+class FramePublisher(object):
+    def __init__(self, address=None, shm=None, shm_size=None, context=None):
+        logger.debug(
+            "FramePublisher[%s] __init__: %s, %s", self, address, shm)
+        self.address = address
+        self.socket = None
+        if address is not None:
+            if context is None:
+                context = zmq.Context.instance()
+            self.socket = context.socket(zmq.PUB)
+            # drop frames for slow subscribers
+            self.socket.setsockopt(zmq.SNDHWM, 2)
+            self.socket.bind(address)
+        self.shm = None
+        if shm is not None:
+            self.shm = SharedFrame(shm, shm_size)
+
+    def send(self, im, wait=None, copy=False):
+        """Publish a frame
+
+        wait : seconds to wait for zmq to finish with the frame buffer,
+            set this when the buffer will be reused after send returns
+        copy : copy the frame for zmq (so send never waits)
+        """
+        header = frame_header(im)
+        if self.socket is not None:
+            track = (wait is not None) and not copy
+            t = self.socket.send_multipart(
+                [header, numpy.ascontiguousarray(im)],
+                copy=copy, track=track)
+            if track:
+                try:
+                    t.wait(wait)
+                except zmq.NotDone:
+                    logger.warning(
+                        "FramePublisher[%s] send not done after %s",
+                        self, wait)
+        if self.shm is not None:
+            try:
+                self.shm.write(im, header)
+            except SharedFrameOverflow as e:
+                # don't fail the grab, the frame is still sent by zmq
+                logger.warning(
+                    "FramePublisher[%s] skipping shared frame: %s", self, e)
+
+    def close(self):
+        logger.debug("FramePublisher[%s] close", self)
+        if self.socket is not None:
+            self.socket.close(linger=0)
+            self.socket = None
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class FrameSubscriber(object):
+    def __init__(self, address, context=None):
+        logger.debug("FrameSubscriber[%s] __init__: %s", self, address)
+        self.address = address
+        if context is None:
+            context = zmq.Context.instance()
+        self.socket = context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.RCVHWM, 2)
+        self.socket.setsockopt(zmq.SUBSCRIBE, b'')
+        self.socket.connect(address)
+
+    def recv(self, timeout=None, copy=False):
+        """Return the next frame or None on timeout (in seconds)"""
+        if timeout is not None:
+            if not self.socket.poll(int(timeout * 1000)):
+                return None
+        header, data = self.socket.recv_multipart(copy=False)
+        return frame_from_parts(header.bytes, data, copy=copy)
+
+    def close(self):
+        self.socket.close(linger=0)
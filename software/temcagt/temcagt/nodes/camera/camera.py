@@ -47,14 +47,17 @@ from .. import base
 from ... import config
 from ... import log
 
+from . import broadcast
 from . import controllers
 from . import processes
+from . import tracing
 from . import utils
 
 default_config = {
     "loc": 'SFT-1000',
     "addr": 'tcp://127.0.0.1:11020',
     #"log_serfs": "~/Desktop/serf_logs",  # define to log serf states
+    #"simulate": True,  # use the fake camera (even if andor is available)
     "nframes": 4,
     "index": 0,
     "nbuffercopies": 10,
@@ -84,11 +87,14 @@ default_config = {
         "crop": 400,
         "min": 0.01,
         "name": "contrast",
+        #"fused": False,  # measure contrast during normalization
+        #"kernel": None,  # fused kernel: 'numpy', 'compiled' or None (auto)
     },
     "shift": {
         "tcrop": 400,
         "mcrop": 500,
-        "method": "TM_CCORR_NORMED",
+        "method": "TM_CCORR_NORMED",  # or PHASE_CORR
+        #"subpixel": False,  # PHASE_CORR only, adds sx, sy to results
         "max_shift": 4,
         "min_match": 0.8,
         #"max_shift": 400000,  # to make all grabs success
@@ -100,6 +106,14 @@ default_config = {
         "downsample": 8,
         "frame": True,
         "percentiles": [5, 95],
+        # emit frames (pickled) through the new_image signal
+        "signal": True,
+        # also send raw frames (see broadcast.py) to:
+        "zmq": None,  # a zmq bind address, ex: "tcp://*:11120"
+        "shm": None,  # a shared memory segment name, ex: "camera0"
+        # seconds to wait for zmq to send a full size frame before its
+        # buffer is released, 0 copies the frame instead (no blocking)
+        "zmq_wait": 0,
     },
     "stream": {
         "enable": False,
@@ -111,12 +125,24 @@ default_config = {
         "beam": True,
         "mean": True,
         "crop": 512,
+        "stride": 1,  # sample every N pixels of the crop
         "std": True,
         "focus": True,
         "histogram": True,
         "focus_method": "gradient_focus",
     },
     "nregrabs": 1,
+    "trace": {
+        # record per stage latencies for each grab (see tracing.py)
+        "enable": True,
+        # keep a timeline, saved to the save directory by finish_grab
+        "timeline": False,
+    },
+    "frame": {
+        # add grabs to the frame as shifts are measured rather than
+        # building the frame after the last grab is analyzed
+        "accumulate": False,
+    },
     "save": {
         "directory": "/tmp",
         "filename_formats": {
@@ -137,6 +163,15 @@ default_config = {
         "norm": False,
         "frame": True,
         "on_fail": True,  # should be True/False
+        "workers": 1,  # number of saver processes
+        # lossless compression (None, 'lzw', 'deflate', 'zstd' or
+        # 'packbits') and predictor (None = default for dtype), see
+        # imaging.tifio.raw.write_tif
+        "compression": None,
+        "predictor": None,
+        "bigtiff": False,
+        # max images waiting to be written before grabs are held off
+        #"max_in_flight": 8,
     },
 }
 
@@ -152,6 +187,8 @@ class CameraNode(base.IONode):
         cfg['n_words'] = n_words
         base.IONode.__init__(self, cfg)
         self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # resolves when the frames of the current grab are exposed
+        self.exposure = None
 
         self.new_image = pizco.Signal(nargs=1)
         self.new_stats = pizco.Signal(nargs=1)
@@ -169,6 +206,9 @@ class CameraNode(base.IONode):
         self.meta = {}  # non-grab meta
         self.mean_percentiles = None
         self._stream_cb = None
+        self.publisher = None
+        self.tracer = None
+        self.setup_tracer()
 
     def __repr__(self):
         cfg = self.config()
@@ -183,6 +223,11 @@ class CameraNode(base.IONode):
 
     def config_delta(self, delta):
         logger.debug("CameraNode[%s] config_delta: %s", self, delta)
+        if 'broadcast' in delta:
+            # re-open raw frame channels on next broadcast
+            self.close_publisher()
+        if 'trace' in delta:
+            self.setup_tracer()
         if not self.connected():
             return
         # if anything changes buffer sizes, then disconnect and reconnect
@@ -205,6 +250,8 @@ class CameraNode(base.IONode):
             logger.debug(
                 "CameraNode[%s] config_delta(updating analysis)", self)
             self.analysis.set_config(self.config())
+        if 'contrast' in delta:
+            self.norm.set_config(self.config())
         if 'stats' in delta:
             logger.debug(
                 "CameraNode[%s] config_delta(updating stats)", self)
@@ -235,7 +282,11 @@ class CameraNode(base.IONode):
                 self.camera is not None and self.camera.process is not None
                 and self.camera.process.is_alive()):
             self.camera.stop()
-        self.camera = processes.CameraLord(cfg, self.buffers)
+        if cfg.get('simulate', False):
+            # use the fake camera even if andor is available
+            self.camera = processes.fakecamera.CameraLord(cfg, self.buffers)
+        else:
+            self.camera = processes.CameraLord(cfg, self.buffers)
         if (
                 self.frame is not None and self.frame.process is not None
                 and self.frame.process.is_alive()):
@@ -251,11 +302,9 @@ class CameraNode(base.IONode):
                 and self.analysis.process.is_alive()):
             self.analysis.stop()
         self.analysis = processes.AnalysisLord(cfg, self.buffers)
-        if (
-                self.saver is not None and self.saver.process is not None
-                and self.saver.process.is_alive()):
+        if self.saver is not None and self.saver.is_alive():
             self.saver.stop()
-        self.saver = processes.SaverLord(cfg, self.buffers)
+        self.saver = processes.SaverPool(cfg, self.buffers)
         if (
                 self.stats is not None and self.stats.process is not None
                 and self.stats.process.is_alive()):
@@ -277,6 +326,7 @@ class CameraNode(base.IONode):
         if not self.connected() and not force:
             return
         self.stop_streaming()
+        self.close_publisher()
         if hasattr(self, 'controller') and self.controller is not None:
             self.controller.disconnect()
             self.controller = None
@@ -315,7 +365,7 @@ class CameraNode(base.IONode):
 
     def process_state(self):
         processes = {}
-        for k in ('camera', 'analysis', 'frame', 'saver'):
+        for k in ('camera', 'analysis', 'frame'):
             a = getattr(self, k)
             if a is None:
                 processes[k] = 'attribute is None'
@@ -325,6 +375,16 @@ class CameraNode(base.IONode):
                 processes[k] = 'alive'
             else:
                 processes[k] = 'dead'
+        if self.saver is None:
+            processes['saver'] = 'attribute is None'
+        else:
+            for (i, l) in enumerate(self.saver.lords):
+                if l.process is None:
+                    processes['saver%i' % i] = 'process is None'
+                elif l.process.is_alive():
+                    processes['saver%i' % i] = 'alive'
+                else:
+                    processes['saver%i' % i] = 'dead'
         return processes
 
     def connected(self):
@@ -341,8 +401,7 @@ class CameraNode(base.IONode):
                 (self.norm.process is None) or
                 (self.analysis.process is None) or
                 (self.frame.process is None) or
-                (self.stats.process is None) or
-                (self.saver.process is None)):
+                (self.stats.process is None)):
             return False
         if (
                 self.camera.process.is_alive() and
@@ -350,7 +409,7 @@ class CameraNode(base.IONode):
                 self.analysis.process.is_alive() and
                 self.frame.process.is_alive() and
                 self.stats.process.is_alive() and
-                self.saver.process.is_alive()):
+                self.saver.is_alive()):
             return True
         return False
 
@@ -416,12 +475,47 @@ class CameraNode(base.IONode):
         #            im.meta['range'] = (v, v)
         if bcfg.get('frame', True):
             ds = bcfg.get('downsample', 1)
-            if ds == 1:
-                self.new_image.emit(im)
-            else:
-                self.new_image.emit(montage.io.Image(
+            if ds != 1:
+                im = montage.io.Image(
                     cv2.resize(im, None, fx=1./ds, fy=1./ds),
-                    im.meta))
+                    im.meta)
+            p = self.get_publisher()
+            if p is not None:
+                if ds != 1:
+                    p.send(im)
+                elif bcfg.get('zmq_wait', 0):
+                    # full size frames are sent from the shared buffers
+                    # so wait for zmq to finish before they are released
+                    p.send(im, wait=bcfg['zmq_wait'])
+                else:
+                    p.send(im, copy=True)
+            if bcfg.get('signal', True):
+                self.new_image.emit(im)
+
+    def get_publisher(self):
+        if self.publisher is None:
+            bcfg = self.config()['broadcast']
+            if (
+                    bcfg.get('zmq', None) is None and
+                    bcfg.get('shm', None) is None):
+                return None
+            h, w, _ = self.config()['crop']
+            self.publisher = broadcast.FramePublisher(
+                bcfg.get('zmq', None), bcfg.get('shm', None),
+                h * w * numpy.dtype('u2').itemsize)
+        return self.publisher
+
+    def close_publisher(self):
+        if self.publisher is not None:
+            self.publisher.close()
+            self.publisher = None
+
+    def get_broadcast_channels(self):
+        bcfg = self.config()['broadcast']
+        return {
+            'zmq': bcfg.get('zmq', None),
+            'shm': bcfg.get('shm', None),
+        }
 
     def stop_streaming(self):
         if self._stream_cb is None:
@@ -628,7 +722,10 @@ class CameraNode(base.IONode):
 
     def ready_to_grab(self):
         # check if grab buffers are ready
-        return self.buffers.is_ready_for_grab()
+        # and that the savers are keeping up
+        return (
+            self.buffers.is_ready_for_grab() and
+            not self.saver.is_saturated())
 
     def single_grab(self, grab_type='grab', save=False, in_pool=False):
         logger.debug(
@@ -638,16 +735,32 @@ class CameraNode(base.IONode):
             grab_type=grab_type, until_done=True,
             save=save, broadcast=True, in_pool=in_pool)
 
-    def start_grab(self, meta, until_done=True, in_pool=False):
+    def start_grab(
+            self, meta, until_done=True, in_pool=False, exposure=None,
+            regrabs=None):
+        """Grab a tile, returns a Future of (valid, veto_info)
+
+        regrabs : limit regrabs for this grab only (None uses nregrabs)
+        """
         if not self.connected():
             raise IOError(
                 "start_grab called on not connected node")
         if in_pool is False:
+            # each grab resolves only its own exposure future
+            self.exposure = concurrent.futures.Future()
             return self.pool.submit(
-                self.start_grab, meta, until_done=until_done, in_pool=True)
+                self.start_grab, meta, until_done=until_done, in_pool=True,
+                exposure=self.exposure, regrabs=regrabs)
         logger.debug("CameraNode[%s] start_grab", self)
         self.set_controller(controllers.GrabController)
-        self.controller.run(meta, until_done=until_done)
+        self.controller.exposure = exposure
+        try:
+            self.controller.run(
+                meta, until_done=until_done, regrabs=regrabs)
+        except Exception as e:
+            if exposure is not None and not exposure.done():
+                exposure.set_exception(e)
+            raise
         if self.controller.nodata_buffer is not None:
             self.controller.veto = True
             self.controller.veto_info['nodata'] = self.controller.nodata_buffer
@@ -656,6 +769,18 @@ class CameraNode(base.IONode):
             self, self.controller.veto, self.controller.veto_info)
         return not self.controller.veto, self.controller.veto_info
 
+    def wait_for_exposure(self):
+        """Future that resolves when the last start_grab is exposed
+
+        This is when all frames (not counting regrabs) have been read
+        from the camera, so the stage can move while they are analyzed.
+        """
+        if self.exposure is None:
+            f = concurrent.futures.Future()
+            f.set_result(None)
+            return f
+        return self.exposure
+
     def wait_for_save(self, in_pool=False):
         if not isinstance(self.controller, controllers.GrabController):
             raise AttributeError("wait_for_save only valid after start_grab")
@@ -676,6 +801,9 @@ class CameraNode(base.IONode):
             self.controller = None
         else:
             nodata = None
+        if self.tracer is not None and self.tracer.timeline:
+            self.save_trace_timeline()
+            self.tracer.events = []
         return nodata
 
     def update_controller(self):  # needs to be run in tight-loop
@@ -683,6 +811,46 @@ class CameraNode(base.IONode):
         if self.controller is not None:
             self.controller.update()
 
+    def get_dispatch_stats(self):
+        if self.controller is None:
+            return {}
+        return self.controller.get_dispatch_stats()
+
+    def setup_tracer(self):
+        tcfg = self.config().get('trace', {})
+        if not tcfg.get('enable', False):
+            self.tracer = None
+            return
+        timeline = tcfg.get('timeline', False)
+        if self.tracer is None:
+            self.tracer = tracing.Tracer(timeline=timeline)
+        self.tracer.timeline = timeline
+
+    def get_trace_stats(self):
+        """Per stage latency (seconds) stats and histograms"""
+        if self.tracer is None:
+            return {}
+        return self.tracer.get_stats()
+
+    def clear_trace(self):
+        if self.tracer is not None:
+            self.tracer.clear()
+
+    def save_trace_timeline(self, fn=None):
+        if self.tracer is None:
+            return None
+        cfg = self.config()
+        if fn is None:
+            fn = os.path.join(
+                cfg['save']['directory'],
+                'cam%i_trace.json' % cfg['index'])
+        return self.tracer.save_timeline(fn, pid=cfg['index'])
+
+    def get_saver_stats(self):
+        if self.saver is None:
+            return {}
+        return self.saver.get_stats()
+
     def get_buffer_locks(self):
         if self.buffers is None:
             return {}
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import logging
+import select
 import time
 
 from .... import log
@@ -11,12 +12,30 @@ logger = log.get_logger(__name__)
 #logger.setLevel(logging.DEBUG)
 
 
+def lord_fileno(lord):
+    """Return the file descriptor of a lords pipe or None"""
+    pipe = getattr(lord, 'pipe', None)
+    if pipe is None:
+        return None
+    try:
+        return pipe.fileno()
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
 class NodeController(object):
+    # lords (attributes of node) that send messages to this controller
+    lord_names = ('camera', 'norm', 'analysis', 'frame', 'saver', 'stats')
+    # max seconds to block waiting for a message, used so test functions
+    # that do not depend on a message (timeouts, etc) are rechecked
+    dispatch_timeout = 0.1
+
     def __init__(self, node):
         logger.debug("NodeController[%s] __init__: %s", self, node)
         self.node = node
         self.state = 'init'
         self.callbacks = {}
+        self.clear_dispatch_stats()
         self.connect()
 
     def connect(self):
@@ -36,19 +55,86 @@ class NodeController(object):
         self.callbacks = {}
         self.node = None
 
-    def until(self, test_function, timeout=0.000001):
+    def lords(self):
+        if self.node is None:
+            return []
+        lords = []
+        for n in self.lord_names:
+            l = getattr(self.node, n, None)
+            if l is None:
+                continue
+            if hasattr(l, 'lords'):
+                # pool of lords (see SaverPool)
+                lords.extend([
+                    ('%s%i' % (n, i), sl) for (i, sl) in enumerate(l.lords)])
+            else:
+                lords.append((n, l))
+        return lords
+
+    def clear_dispatch_stats(self):
+        self.dispatch_stats = {}
+
+    def get_dispatch_stats(self):
+        """Per lord message counts and dispatch latency (seconds)"""
+        stats = {}
+        for n in self.dispatch_stats:
+            s = self.dispatch_stats[n].copy()
+            if s['n']:
+                s['mean'] = s['total'] / s['n']
+            else:
+                s['mean'] = 0.
+            stats[n] = s
+        return stats
+
+    def _record_dispatch(self, name, latency):
+        if name not in self.dispatch_stats:
+            self.dispatch_stats[name] = {'n': 0, 'total': 0., 'max': 0.}
+        s = self.dispatch_stats[name]
+        s['n'] += 1
+        s['total'] += latency
+        s['max'] = max(s['max'], latency)
+
+    def dispatch(self, timeout=None):
+        """Block until a lord has a message and update only that lord
+
+        Falls back to update (polling all lords) if any lord does not
+        expose a selectable pipe. Returns the number of lords updated.
+        """
+        if timeout is None:
+            timeout = self.dispatch_timeout
+        fds = {}
+        for (n, l) in self.lords():
+            fd = lord_fileno(l)
+            if fd is None:
+                self.update()
+                return len(self.lord_names)
+            fds[fd] = (n, l)
+        if not len(fds):
+            return 0
+        try:
+            ready, _, _ = select.select(fds.keys(), [], [], timeout)
+        except select.error as e:
+            # interrupted system call, let the caller recheck
+            logger.debug("NodeController[%s] dispatch: %s", self, e)
+            return 0
+        for fd in ready:
+            n, l = fds[fd]
+            t0 = time.time()
+            self.update_lord(n, l)
+            self._record_dispatch(n, time.time() - t0)
+        return len(ready)
+
+    def update_lord(self, name, lord):
+        lord.update(timeout=0)
+
+    def until(self, test_function, timeout=None):
         if isinstance(test_function, (str, unicode)):
             test_function = lambda state=test_function: self.state == state
         logger.debug(
             "NodeController[%s] until: %s", self,
             getattr(test_function, '__name__', 'UNKNOWN'))
         while not test_function():
-            #s = ""
-            #if hasattr(self, 'saving'):
-            #    s = self.saving
-            #logger.debug(
-            #    "%s() %s: %s", test_function.__name__, test_function(), s)
-            self.update(timeout=timeout)
+            self.dispatch(timeout=timeout)
         logger.debug(
             "NodeController[%s] until [done]: %s", self,
             getattr(test_function, '__name__', 'UNKNOWN'))
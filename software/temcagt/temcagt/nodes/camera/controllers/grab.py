@@ -37,13 +37,17 @@ class GrabController(NodeController):
         logger.debug("GrabController[%s] __init__: %s", self, node)
         self.nodatas = []
         self.nodata_buffer = None
+        # resolved once this grab is exposed (see CameraNode.start_grab)
+        self.exposure = None
         NodeController.__init__(self, node)
         cfg = self.node.config()
         self.nframes = cfg['nframes']
         self.contrast_threshold = cfg['contrast']['min']
         self.shift_d_threshold = cfg['shift']['max_shift']
         self.shift_m_threshold = cfg['shift']['min_match']
-        self.max_regrabs = cfg['nregrabs']
+        # buffers are sized for nregrabs, run can only lower this
+        self.nregrabs_limit = cfg['nregrabs']
+        self.max_regrabs = self.nregrabs_limit
         # load save, broadcast info, etc... from cfg
         # only build frame if needed for save or broadcast
         # only support frame broadcasting
@@ -60,6 +64,10 @@ class GrabController(NodeController):
             'frame': cfg['save'].get('frame', False),
         }
         self.frame_on_fail = cfg['save']['on_fail']
+        # add each grab to the frame as soon as its shift is known
+        self.accumulate = (
+            cfg.get('frame', {}).get('accumulate', False) and
+            (self.save['frame'] or self.broadcast['frame']))
         self.meta = {}
         self.state = 'wait'
         self.clear()
@@ -74,6 +82,7 @@ class GrabController(NodeController):
         self.shifts = {}
         self.nregrabs = 0
         self.ngrabs = 0
+        self.accumulated = []
         self.node.analysis.clear_template()
 
     def connect(self):
@@ -92,6 +101,11 @@ class GrabController(NodeController):
             self.node.frame.attach('frame', self.on_frame), ]
         self.callbacks['stats'] = [
             self.node.stats.attach('stats', self.on_stats), ]
+        self.callbacks['saver'] = [
+            self.node.saver.attach('backpressure', self.on_backpressure),
+            self.node.saver.attach('grab', self.on_saved_grab),
+            self.node.saver.attach('norm', self.on_saved_norm),
+            self.node.saver.attach('frame', self.on_saved_frame), ]
 
     def disconnect(self):
         logger.debug("GrabController[%s] disconnect", self)
@@ -102,6 +116,11 @@ class GrabController(NodeController):
                 self.until(self.is_done_saving)
         NodeController.disconnect(self)
 
+    def trace(self, meta, stage):
+        # record a completed stage span (see tracing)
+        if self.node.tracer is not None:
+            self.node.tracer.record(meta, stage)
+
     def on_nodata(self, buffer_index):
         logger.debug("GrabController[%s] on_nodata: %s", self, buffer_index)
         self.nodata_buffer = buffer_index
@@ -110,9 +129,12 @@ class GrabController(NodeController):
     def on_grab(self, meta):
         logger.debug("GrabController[%s] on_grab: %s", self, meta)
         index = meta['buffer_index']
+        self.trace(meta, 'camera')
         self.indices.append(index)
         meta['grab'] = self.ngrabs
         self.ngrabs += 1
+        if self.ngrabs >= self.nframes:
+            self.exposed()
         self.node.buffers.grabs[index].meta = meta
         if self.broadcast['grab']:
             self.node.broadcast(self.node.buffers.grabs[index])
@@ -122,15 +144,21 @@ class GrabController(NodeController):
         #if self.nregrabs == self.max_regrabs:
         #    self.node.camera.flush()
 
-    def on_norm(self, index):
+    def on_norm(self, index, results=None):
         logger.debug("GrabController[%s] on_norm: %s", self, index)
-        self.node.analysis.analyze_grab(index)
         meta = self.node.buffers.grabs[index].meta
+        self.trace(meta, 'norm')
+        self.node.buffers.norms[index].meta = meta
+        if results is not None and 'contrast' in results:
+            # contrast was measured during normalization
+            self.on_contrast(index, results['contrast'])
+            self.node.analysis.analyze_grab(index, contrast=False)
+        else:
+            self.node.analysis.analyze_grab(index)
         if self.broadcast['norm']:
             self.node.broadcast(self.node.buffers.norms[index])
         if self.save['norm']:
             self.node.saver.save_norm(index)
-        self.node.buffers.norms[index].meta = meta
 
     def on_contrast(self, index, result):
         logger.debug(
@@ -142,7 +170,14 @@ class GrabController(NodeController):
         logger.debug(
             "GrabController[%s] on_shift: %s, %s", self, index, result)
         self.node.buffers.norms[index].meta['shift'] = result
+        self.trace(self.node.buffers.norms[index].meta, 'analysis')
         self.shifts[index] = result
+        if self.nregrabs == 0:
+            # largest shift after the first settle (see montaging.settle)
+            self.veto_info['drift'] = max(
+                self.veto_info.get('drift', 0.), result['d'])
+        if self.accumulate:
+            self.accumulate_grab(index, result)
         if (
                 result['d'] > self.shift_d_threshold or
                 result['m'] < self.shift_m_threshold):
@@ -156,6 +191,12 @@ class GrabController(NodeController):
                     self.shifts[bi]['x'] = 0.
                     self.shifts[bi]['y'] = 0.
                     self.node.buffers.norms[bi].meta['shift'] = self.shifts[bi]
+                if self.accumulate:
+                    # re-add all grabs without shifts
+                    self.node.frame.clear_frame()
+                    self.accumulated = []
+                    for bi in self.indices[1:]:
+                        self.accumulate_grab(bi, self.shifts[bi])
             if not self.veto:
                 self.success()
             elif self.nregrabs == self.max_regrabs:
@@ -163,12 +204,35 @@ class GrabController(NodeController):
             else:
                 self.regrab()
 
+    def accumulate_grab(self, index, shift):
+        if not self.node.frame.is_accumulating():
+            self.node.frame.start_frame()
+        if not len(self.accumulated):
+            # first grab is the shift template
+            self.node.frame.add_grab(self.indices[0])
+            self.accumulated.append(self.indices[0])
+        self.node.frame.add_grab(index, shift)
+        self.accumulated.append(index)
+
+    def finish_frame(self):
+        shifts = [self.shifts[i] for i in self.indices[1:]]
+        if self.accumulate:
+            self.node.frame.finish_frame(shifts, self.indices)
+        else:
+            self.node.frame.build_frame(shifts, self.indices)
+
+    def exposed(self):
+        # tell anyone waiting on this grab (see CameraNode.start_grab)
+        f = self.exposure
+        if f is not None and not f.done():
+            f.set_result(self.ngrabs)
+
     def success(self):
         logger.debug("GrabController[%s] success", self)
+        self.exposed()
         # build frame?
         if (self.save['frame'] or self.broadcast['frame']):
-            shifts = [self.shifts[i] for i in self.indices[1:]]
-            self.node.frame.build_frame(shifts, self.indices)
+            self.finish_frame()
         else:
             # dont' build a frame, release all grabs
             for bi in self.low_contrasts:
@@ -183,12 +247,14 @@ class GrabController(NodeController):
     def fail(self):
         # build frame?
         logger.debug("GrabController[%s] fail", self)
+        self.exposed()
         if (
                 (self.save['frame'] or self.broadcast['frame'])
                 and self.frame_on_fail):
-            shifts = [self.shifts[i] for i in self.indices[1:]]
-            self.node.frame.build_frame(shifts, self.indices)
+            self.finish_frame()
         else:
+            if self.accumulate:
+                self.node.frame.cancel_frame()
             # dont' build a frame, release all grabs
             for bi in self.low_contrasts:
                 self.node.buffers.unlock_grab(bi)
@@ -215,6 +281,11 @@ class GrabController(NodeController):
             self.meta, trigger_next=self.nregrabs != self.max_regrabs)
         # clear the shift template, set to first norm
         self.shifts = {}
+        if self.accumulate:
+            # shifts will change with the new template, so drop all
+            # contributions, grabs are re-added as new shifts arrive
+            self.node.frame.clear_frame()
+            self.accumulated = []
         self.node.analysis.set_template(self.indices[0])
         # queue up remaining buffers to shift
         for i in self.indices[1:]:
@@ -225,6 +296,7 @@ class GrabController(NodeController):
             "GrabController[%s] on_frame: %s, %s", self, index, meta)
         #index = meta['buffer_index']
         #self.node.buffers.frames[index].meta.update(meta)
+        self.trace(meta, 'frame')
         for bi in meta['buffer_indices']:
             self.node.buffers.unlock_grab(bi)
         if self.nodata_buffer is not None:
@@ -241,9 +313,28 @@ class GrabController(NodeController):
             self.node.stats.compute_stats('frame', index)
         self.node.buffers.unlock_frame(index)
 
+    def on_saved_grab(self, index, fn, info=None):
+        self.trace(self.node.buffers.grabs[index].meta, 'saver_grab')
+
+    def on_saved_norm(self, index, fn, info=None):
+        self.trace(self.node.buffers.norms[index].meta, 'saver_norm')
+
+    def on_saved_frame(self, index, fn, info=None):
+        self.trace(self.node.buffers.frames[index].meta, 'saver_frame')
+
+    def on_backpressure(self, n):
+        logger.warning(
+            "GrabController[%s] savers are not keeping up: %s in flight",
+            self, n)
+
+    def is_saver_ready(self):
+        return not self.node.saver.is_saturated()
+
     def on_stats(self, btype, index, stats):
         logger.debug(
             "GrabController[%s] on_stats: %s, %s", self, btype, index)
+        b = getattr(self.node.buffers, btype + 's')[index]
+        self.trace(b.meta, 'stats')
         self.node.broadcast_stats(stats)
 
     def is_done_grabbing(self):
@@ -255,14 +346,21 @@ class GrabController(NodeController):
     def is_done_saving(self):
         return self.is_done_grabbing() and self.node.buffers.is_empty()
 
-    def run(self, meta, until_done=True):
+    def run(self, meta, until_done=True, regrabs=None):
         logger.debug("GrabController[%s] run", self)
         if self.is_running():
             logger.debug(
                 "GrabController[%s] run is_running, updating: %s",
                 self, self.state)
             self.until(self.is_done_grabbing)
+        if not self.is_saver_ready():
+            # hold off grabbing until the savers free up buffers
+            self.until(self.is_saver_ready)
         self.clear()
+        if regrabs is None:
+            self.max_regrabs = self.nregrabs_limit
+        else:
+            self.max_regrabs = min(regrabs, self.nregrabs_limit)
         self.state = 'grab'
         self.meta = meta
         self.node.camera.start_grab(meta)
@@ -271,9 +369,5 @@ class GrabController(NodeController):
             self.until(f)
 
     def update(self, timeout=0.000001):
-        self.node.camera.update(timeout=timeout)
-        self.node.norm.update(timeout=timeout)
-        self.node.analysis.update(timeout=timeout)
-        self.node.frame.update(timeout=timeout)
-        self.node.saver.update(timeout=timeout)
-        self.node.stats.update(timeout=timeout)
+        for (_, l) in self.lords():
+            l.update(timeout=timeout)
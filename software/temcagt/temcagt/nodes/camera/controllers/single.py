@@ -59,7 +59,7 @@ class SingleGrabController(NodeController):
             return
         self.node.norm.normalize_grab(index)
 
-    def on_norm(self, index):
+    def on_norm(self, index, results=None):
         logger.debug("SingleGrabController[%s] on_norm: %s", self, index)
         self.node.buffers.norms[index].meta = \
             self.node.buffers.grabs[index].meta
@@ -69,7 +69,12 @@ class SingleGrabController(NodeController):
             #self.state = 'done'
             self.state = 'stats'
             return
-        self.node.analysis.analyze_grab(index)
+        if results is not None and 'contrast' in results:
+            # contrast was measured during normalization
+            self.on_contrast(index, results['contrast'])
+            self.node.analysis.analyze_grab(index, contrast=False)
+        else:
+            self.node.analysis.analyze_grab(index)
 
     def on_contrast(self, index, result):
         logger.debug(
@@ -143,6 +148,22 @@ class SingleGrabController(NodeController):
             self.until('done')
             return self.result[0]
 
+    def update_error(self, e):
+        logger.error(
+            "SingleGrabController[%s] update error: %s", self, e)
+        logger.error(
+            "SingleGrabController[%s] update: new_stats_future: %s",
+            self, self.node.new_stats_future)
+        if self.node.new_stats_future is not None:
+            self.node.new_stats_future.set_exception(e)
+
+    def update_lord(self, name, lord):
+        try:
+            lord.update(timeout=0)
+        except Exception as e:
+            self.update_error(e)
+            raise e
+
     def update(self, timeout=0.000001):
         #lp = getattr(self, '_lp', -1)
         #t = time.time()
@@ -151,20 +172,10 @@ class SingleGrabController(NodeController):
         #    logger.debug(
         #        "SingleGrabController[%s] update: %s", self, self.state)
         try:
-            self.node.camera.update(timeout=timeout)
-            self.node.norm.update(timeout=timeout)
-            self.node.analysis.update(timeout=timeout)
-            self.node.frame.update(timeout=timeout)
-            self.node.saver.update(timeout=timeout)
-            self.node.stats.update(timeout=timeout)
+            for (_, l) in self.lords():
+                l.update(timeout=timeout)
         except Exception as e:
-            logger.error(
-                "SingleGrabController[%s] update error: %s", self, e)
-            logger.error(
-                "SingleGrabController[%s] update: new_stats_future: %s",
-                self, self.node.new_stats_future)
-            if self.node.new_stats_future is not None:
-                self.node.new_stats_future.set_exception(e)
+            self.update_error(e)
             raise e
         #if w:
         #    logger.debug(
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from .analysis import AnalysisLord, AnalysisSerf
+from . import fakecamera
 has_andor = False
 try:
     import andor
@@ -13,15 +14,15 @@ else:
     from .fakecamera import CameraLord, CameraSerf
 from .frame import FrameLord, FrameSerf
 from .norm import NormLord, NormSerf
-from .saver import SaverLord, SaverSerf
+from .saver import SaverLord, SaverPool, SaverSerf
 from .stats import StatsLord, StatsSerf
 
 
 __all__ = [
     'AnalysisLord', 'AnalysisSerf',
-    'CameraLord', 'CameraSerf',
+    'CameraLord', 'CameraSerf', 'fakecamera',
     'FrameLord', 'FrameSerf',
     'NormLord', 'NormSerf',
-    'SaverLord', 'SaverSerf',
+    'SaverLord', 'SaverPool', 'SaverSerf',
     'StatsLord', 'StatsSerf',
 ]
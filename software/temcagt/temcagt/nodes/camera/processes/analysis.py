@@ -5,6 +5,8 @@ import datautils.structures.mp
 import montage
 
 from .... import log
+from ....imaging.processing import shift
+from .. import tracing
 from .. import utils
 
 
@@ -14,11 +16,12 @@ logger = log.get_logger(__name__)
 
 
 class AnalysisSerf(datautils.structures.mp.TimedSerf):
-    def setup(self, config, norm_buffers):
+    def setup(self, config, norm_buffers, rings):
         logger.debug(
             "AnalysisSerf[%s] setup: %s, %s",
             self, config, norm_buffers)
         self.config = config
+        self.rings = rings
         self.image_size = config['crop'][:2]
         self.norm_buffers = norm_buffers
         self.setup_buffers()
@@ -48,8 +51,12 @@ class AnalysisSerf(datautils.structures.mp.TimedSerf):
     def configure_shift(self, cfg):
         logger.debug("AnalysisSerf[%s] configure_shift: %s", self, cfg)
         self.shift_results = [dict() for _ in xrange(len(self.norms))]
-        self.shift_measurer = montage.ops.measures.shift.ShiftMeasurer(
-            cfg['tcrop'], cfg['mcrop'], cfg['method'], self.image_size)
+        if cfg['method'] == 'PHASE_CORR':
+            self.shift_measurer = shift.PhaseCorrelator(
+                cfg['tcrop'], cfg['mcrop'], cfg.get('subpixel', False))
+        else:
+            self.shift_measurer = montage.ops.measures.shift.ShiftMeasurer(
+                cfg['tcrop'], cfg['mcrop'], cfg['method'], self.image_size)
 
     def check_contrast(self, buffer_index):
         logger.debug("AnalysisSerf[%s] check_contrast: %s", self, buffer_index)
@@ -65,6 +72,7 @@ class AnalysisSerf(datautils.structures.mp.TimedSerf):
     def set_template(self, buffer_index):
         logger.debug("AnalysisSerf[%s] set_template: %s", self, buffer_index)
         self.shift_measurer.set_template(self.norms[buffer_index])
+        self.rings['grab'].release(buffer_index, 'analysis')
 
     def check_shift(self, buffer_index):
         logger.debug("AnalysisSerf[%s] check_shift: %s", self, buffer_index)
@@ -72,11 +80,16 @@ class AnalysisSerf(datautils.structures.mp.TimedSerf):
             self.norms[buffer_index])
         result['buffer_index'] = buffer_index
         self.shift_results[buffer_index] = result
+        self.rings['grab'].release(buffer_index, 'analysis')
         self.send('shift', buffer_index, result)
 
-    def analyze_grab(self, buffer_index):
+    def analyze_grab(self, buffer_index, contrast=True):
         logger.debug("AnalysisSerf[%s] analyze_grab: %s", self, buffer_index)
-        self.check_contrast(buffer_index)
+        # the lord claimed this buffer once for the whole analysis
+        # and set_template/check_shift each release a claim
+        if contrast:
+            # contrast is skipped if it was measured during normalization
+            self.check_contrast(buffer_index)
         if self.shift_measurer.template is None:
             self.set_template(buffer_index)
         else:
@@ -97,7 +110,8 @@ class AnalysisLord(datautils.structures.mp.Lord):
         logger.debug("AnalysisLord[%s] start", self)
         datautils.structures.mp.Lord.start(
             self, AnalysisSerf, (
-                self.config, self.buffers.norm_buffers), wait=wait)
+                self.config, self.buffers.norm_buffers,
+                self.buffers.get_rings()), wait=wait)
 
     def set_config(self, config):
         logger.debug("AnalysisLord[%s] set_config: %s", self, config)
@@ -109,15 +123,20 @@ class AnalysisLord(datautils.structures.mp.Lord):
 
     def set_template(self, index):
         logger.debug("AnalysisLord[%s] set_template: %s", self, index)
+        self.buffers.lock_grab(index, 'analysis')
         self.send('set_template', index)
 
     def check_shift(self, index):
         logger.debug("AnalysisLord[%s] check_shift: %s", self, index)
+        self.buffers.lock_grab(index, 'analysis')
+        tracing.start(self.buffers.norms[index].meta, 'analysis')
         self.send('check_shift', index)
 
-    def analyze_grab(self, index):
+    def analyze_grab(self, index, contrast=True):
         logger.debug("AnalysisLord[%s] analyze_grab: %s", self, index)
-        self.send('analyze_grab', index)
+        self.buffers.lock_grab(index, 'analysis')
+        tracing.start(self.buffers.norms[index].meta, 'analysis')
+        self.send('analyze_grab', index, contrast)
 
     def contrast(self, index, result):
         logger.debug("AnalysisLord[%s] contrast: %s, %s", self, index, result)
@@ -125,4 +144,5 @@ class AnalysisLord(datautils.structures.mp.Lord):
 
     def shift(self, index, result):
         logger.debug("AnalysisLord[%s] shift: %s, %s", self, index, result)
+        tracing.end(self.buffers.norms[index].meta, 'analysis')
         self.shift_results[index] = result
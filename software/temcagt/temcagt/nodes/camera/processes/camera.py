@@ -7,6 +7,7 @@ import andor
 import datautils.structures.mp
 
 from .... import log
+from .. import tracing
 from .. import utils
 
 
@@ -38,10 +39,11 @@ class SharedBufferQueue(andor.bufferqueue.BufferQueue):
 
 
 class CameraSerf(datautils.structures.mp.TimedSerf):
-    def setup(self, config, grab_buffers):
+    def setup(self, config, grab_buffers, rings):
         logger.debug(
             "CameraSerf[%s] setup: %s, %s", self, config, grab_buffers)
         self.config = config
+        self.rings = rings
         self.triggers = 0
         self.nframes = self.config['nframes']
         self.connect()
@@ -175,6 +177,7 @@ class CameraSerf(datautils.structures.mp.TimedSerf):
                 m['reacquired'] = True
             m['buffer_index'] = buffer_index
             # report buffer as ready
+            self.rings['grab'].claim(m['buffer_index'], 'camera')
             self.send('grab', m)
 
     def regrab(self, meta, trigger_next=True, flush=False):
@@ -232,6 +235,7 @@ class CameraSerf(datautils.structures.mp.TimedSerf):
                 with open(fn, 'r') as f:
                     v = int(f.read())
                     im[:] = v
+        self.rings['grab'].claim(meta['buffer_index'], 'camera')
         self.send('grab', meta)
 
     def single(self, meta):
@@ -281,7 +285,8 @@ class CameraLord(datautils.structures.mp.Lord):
     def start(self, wait=True):
         logger.debug("CameraLord[%s] start", self)
         datautils.structures.mp.Lord.start(self, CameraSerf, (
-            self.config, self.buffers.grab_buffers), wait=wait)
+            self.config, self.buffers.grab_buffers,
+            self.buffers.get_rings()), wait=wait)
 
     def restart_acquisition(self):
         logger.debug("CameraLord[%s] restart_acquisition", self)
@@ -306,21 +311,25 @@ class CameraLord(datautils.structures.mp.Lord):
     def start_grab(self, meta):
         logger.debug("CameraLord[%s] start_grab", self)
         meta['camera'] = self.config['index']
+        tracing.start(meta, 'camera')
         self.send('grab', meta)
 
     def grab(self, meta):
         logger.debug("CameraLord[%s] grab: %s", self, meta)
         index = meta['buffer_index']
-        self.buffers.lock_grab(meta['buffer_index'])
+        # grab lock was claimed by the serf
+        tracing.end(meta, 'camera')
         self.buffers.grabs[index].meta.update(meta)
 
     def regrab(self, meta, trigger_next=True, flush=False):
         logger.debug(
             "CameraLord[%s] regrab: %s, %s", self, trigger_next, flush)
+        tracing.start(meta, 'camera')
         self.send('regrab', meta, trigger_next, flush)
 
     def single(self, meta):
         logger.debug("CameraLord[%s] single", self)
+        tracing.start(meta, 'camera')
         self.send('single', meta)
 
     def flush(self):
@@ -1,14 +1,15 @@
 #!/usr/bin/env python
 
 import datetime
+import glob
 import os
 
-import numpy
-
 import datautils.structures.mp
 import montage
 
 from .... import log
+from ....imaging import tifio
+from .. import tracing
 from .. import utils
 
 
@@ -32,15 +33,17 @@ logger = log.get_logger(__name__)
 
 
 class CameraSerf(datautils.structures.mp.TimedSerf):
-    def setup(self, config, grab_buffers):
+    def setup(self, config, grab_buffers, rings):
         logger.debug(
             "CameraSerf[%s] setup: %s, %s", self, config, grab_buffers)
         self.config = config
+        self.rings = rings
         self.triggers = 0
         self.nframes = self.config['nframes']
         self.connect()
         self.configure(config['features'])
         self.setup_buffers(grab_buffers)
+        self.setup_replay()
         self.grab_count = 0
         if 'log_serfs' in config:
             utils.log_serf_to_directory(self, config['log_serfs'])
@@ -65,6 +68,32 @@ class CameraSerf(datautils.structures.mp.TimedSerf):
             for b in grab_buffers]
         self.bi = 0
 
+    def setup_replay(self):
+        # replay images (ex: from a previous montage) instead of
+        # filling grabs with the grab count, config:
+        #   replay: {files: glob pattern, max_images: N (default 16)}
+        self.replay = []
+        self.replay_index = 0
+        rcfg = self.config.get('replay', None)
+        if rcfg is None:
+            return
+        fns = sorted(glob.glob(os.path.expanduser(rcfg['files'])))
+        fns = fns[:rcfg.get('max_images', 16)]
+        logger.debug("CameraSerf[%s] replaying %s files", self, len(fns))
+        for fn in fns:
+            im, _ = tifio.raw.read_tif(fn, memmap=False)
+            self.replay.append(im)
+
+    def fill(self, g):
+        if not len(self.replay):
+            g[:, :] = self.grab_count
+            return
+        im = self.replay[self.replay_index]
+        self.replay_index = (self.replay_index + 1) % len(self.replay)
+        h = min(im.shape[0], g.shape[0])
+        w = min(im.shape[1], g.shape[1])
+        g[:h, :w] = im[:h, :w]
+
     def trigger(self):
         logger.debug("CameraSerf[%s] trigger", self)
         self.triggers += 1
@@ -76,7 +105,7 @@ class CameraSerf(datautils.structures.mp.TimedSerf):
         for i in xrange(self.nframes):
             self.trigger()  # i + 1
             g = self.grabs[self.bi]
-            g[:, :] = self.grab_count
+            self.fill(g)
             self.grab_count += 1
             if self.grab_count > 65535:
                 self.grab_count = 0
@@ -90,6 +119,7 @@ class CameraSerf(datautils.structures.mp.TimedSerf):
             if self.bi >= len(self.grabs):
                 self.bi = 0
             # report buffer as ready
+            self.rings['grab'].claim(m['buffer_index'], 'camera')
             self.send('grab', m)
 
     def regrab(self, meta, trigger_next=True, flush=False):
@@ -99,7 +129,7 @@ class CameraSerf(datautils.structures.mp.TimedSerf):
         if self.triggers == 0:
             self.trigger()
         g = self.grabs[self.bi]
-        g[:, :] = self.grab_count
+        self.fill(g)
         self.grab_count += 1
         if self.grab_count > 65535:
             self.grab_count = 0
@@ -122,6 +152,7 @@ class CameraSerf(datautils.structures.mp.TimedSerf):
                 with open(fn, 'r') as f:
                     v = int(f.read())
                     g[:] = v
+        self.rings['grab'].claim(meta['buffer_index'], 'camera')
         self.send('grab', meta)
 
     def single(self, meta):
@@ -159,7 +190,8 @@ class CameraLord(datautils.structures.mp.Lord):
     def start(self, wait=True):
         logger.debug("CameraLord[%s] start", self)
         datautils.structures.mp.Lord.start(self, CameraSerf, (
-            self.config, self.buffers.grab_buffers), wait=wait)
+            self.config, self.buffers.grab_buffers,
+            self.buffers.get_rings()), wait=wait)
 
     def set_cooling(self, value):
         logger.debug("CameraLord[%s] set_cooling: %s", self, value)
@@ -180,21 +212,25 @@ class CameraLord(datautils.structures.mp.Lord):
     def start_grab(self, meta):
         logger.debug("CameraLord[%s] start_grab", self)
         meta['camera'] = self.config['index']
+        tracing.start(meta, 'camera')
         self.send('grab', meta)
 
     def grab(self, meta):
         logger.debug("CameraLord[%s] grab: %s", self, meta)
         index = meta['buffer_index']
-        self.buffers.lock_grab(meta['buffer_index'])
+        # grab lock was claimed by the serf
+        tracing.end(meta, 'camera')
         self.buffers.grabs[index].meta.update(meta)
 
     def regrab(self, meta, trigger_next=True, flush=False):
         logger.debug(
             "CameraLord[%s] regrab: %s, %s", self, trigger_next, flush)
+        tracing.start(meta, 'camera')
         self.send('regrab', meta, trigger_next, flush)
 
     def single(self, meta):
         logger.debug("CameraLord[%s] single", self)
+        tracing.start(meta, 'camera')
         self.send('single', meta)
 
     def flush(self):
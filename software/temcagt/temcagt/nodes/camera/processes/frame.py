@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 
 import cv2
+import numpy
 
 import datautils.structures.mp
 import montage
 
 from .... import log
+from ....imaging.processing import shift
+from .. import tracing
 from .. import utils
 
 
@@ -15,14 +18,19 @@ logger = log.get_logger(__name__)
 
 
 class FrameSerf(datautils.structures.mp.TimedSerf):
-    def setup(self, config, norm_buffers, frame_buffers):
+    def setup(self, config, norm_buffers, frame_buffers, rings):
         logger.debug(
             "FrameSerf[%s] setup: %s, %s, %s",
             self, config, norm_buffers, frame_buffers)
         self.config = config
+        self.rings = rings
         self.norm_buffers = norm_buffers
         self.frame_buffers = frame_buffers
         self.setup_buffers()
+        # running sum and count for accumulated frames
+        self.total = None
+        self.count = None
+        self.accumulate_index = None
         if 'log_serfs' in config:
             utils.log_serf_to_directory(self, config['log_serfs'])
 
@@ -44,6 +52,44 @@ class FrameSerf(datautils.structures.mp.TimedSerf):
         norms = [self.norms[i] for i in buffer_indices]
         frame = montage.ops.transform.shift.deshift_and_average(
             norms, shifts)
+        # norms are no longer needed, release them
+        [self.rings['grab'].release(i, 'frame') for i in buffer_indices]
+        self.send_frame(frame, shifts, buffer_indices, frame_buffer_index)
+
+    def start_frame(self, frame_buffer_index):
+        logger.debug(
+            "FrameSerf[%s] start_frame: %s", self, frame_buffer_index)
+        if self.total is None:
+            shape = self.norms[0].shape
+            self.total = numpy.zeros(shape, dtype='f4')
+            self.count = numpy.zeros(shape, dtype='f4')
+        self.clear_frame()
+        self.accumulate_index = frame_buffer_index
+
+    def clear_frame(self):
+        logger.debug("FrameSerf[%s] clear_frame", self)
+        self.total[:, :] = 0
+        self.count[:, :] = 0
+
+    def add_grab(self, buffer_index, grab_shift=None):
+        logger.debug(
+            "FrameSerf[%s] add_grab: %s, %s", self, buffer_index, grab_shift)
+        shift.accumulate(
+            self.total, self.count, self.norms[buffer_index], grab_shift)
+        # the norm is now in the running sum so it can be released
+        self.rings['grab'].release(buffer_index, 'frame')
+
+    def finish_frame(self, shifts, buffer_indices):
+        logger.debug(
+            "FrameSerf[%s] finish_frame: %s, %s",
+            self, shifts, buffer_indices)
+        # pixels without data (count == 0) are set to 0
+        frame = cv2.divide(self.total, self.count)
+        frame_buffer_index = self.accumulate_index
+        self.accumulate_index = None
+        self.send_frame(frame, shifts, buffer_indices, frame_buffer_index)
+
+    def send_frame(self, frame, shifts, buffer_indices, frame_buffer_index):
         fmin, fmax, _, _ = cv2.minMaxLoc(frame)
         cv2.normalize(frame, frame, 0, 65535, cv2.NORM_MINMAX)
         self.frames[frame_buffer_index][:, :] = frame.astype('u2')
@@ -63,13 +109,17 @@ class FrameLord(datautils.structures.mp.Lord):
         datautils.structures.mp.Lord.__init__(self)
         self.config = config
         self.buffers = buffers
+        self.accumulate_index = None
+        # when the last frame was requested (for tracing)
+        self.frame_start = None
 
     def start(self, wait=True):
         logger.debug("FrameLord[%s] start", self)
         datautils.structures.mp.Lord.start(
             self, FrameSerf, (
                 self.config, self.buffers.norm_buffers,
-                self.buffers.frame_buffers), wait=wait)
+                self.buffers.frame_buffers, self.buffers.get_rings()),
+            wait=wait)
 
     def build_frame(self, shifts, buffer_indices):
         logger.debug(
@@ -79,9 +129,50 @@ class FrameLord(datautils.structures.mp.Lord):
         # TODO what to do here?
         if frame_buffer_index is None:
             raise IOError("Failed to find an empty frame buffer")
-        [self.buffers.lock_grab(i) for i in buffer_indices]
+        [self.buffers.lock_grab(i, 'frame') for i in buffer_indices]
+        self.frame_start = tracing.monotonic()
         self.send('build_frame', shifts, buffer_indices, frame_buffer_index)
 
+    # -- accumulated (streaming) frames --
+    # start_frame, add_grab as each shift is known, then finish_frame
+    # or cancel_frame. clear_frame drops all contributions (for regrabs)
+    def start_frame(self):
+        logger.debug("FrameLord[%s] start_frame", self)
+        frame_buffer_index = self.buffers.request_frame_lock()
+        if frame_buffer_index is None:
+            raise IOError("Failed to find an empty frame buffer")
+        self.accumulate_index = frame_buffer_index
+        self.send('start_frame', frame_buffer_index)
+
+    def is_accumulating(self):
+        return self.accumulate_index is not None
+
+    def add_grab(self, index, grab_shift=None):
+        logger.debug(
+            "FrameLord[%s] add_grab: %s, %s", self, index, grab_shift)
+        self.buffers.lock_grab(index, 'frame')
+        self.send('add_grab', index, grab_shift)
+
+    def clear_frame(self):
+        logger.debug("FrameLord[%s] clear_frame", self)
+        self.send('clear_frame')
+
+    def finish_frame(self, shifts, buffer_indices):
+        logger.debug(
+            "FrameLord[%s] finish_frame: %s, %s",
+            self, shifts, buffer_indices)
+        self.accumulate_index = None
+        self.frame_start = tracing.monotonic()
+        self.send('finish_frame', shifts, buffer_indices)
+
+    def cancel_frame(self):
+        logger.debug("FrameLord[%s] cancel_frame", self)
+        if self.accumulate_index is None:
+            return
+        self.send('clear_frame')
+        self.buffers.unlock_frame(self.accumulate_index)
+        self.accumulate_index = None
+
     def frame(self, index, meta):
         logger.debug("FrameLord[%s] frame: %s, %s", self, index, meta)
         # get meta from norms
@@ -97,6 +188,8 @@ class FrameLord(datautils.structures.mp.Lord):
             meta['contrasts'].append(n.meta['contrast'])
             meta['frame counts'].append(n.meta['frame count'])
             meta['times'].append(n.meta['DateTime'].strftime('%y%m%d%H%M%S%f'))
-            self.buffers.unlock_grab(ni)
         meta['buffer_index'] = index
+        # the frame gets its own trace (not the one copied from the norms)
+        meta['trace'] = {'frame': [self.frame_start, None]}
+        tracing.end(meta, 'frame')
         self.buffers.frames[index].meta = meta
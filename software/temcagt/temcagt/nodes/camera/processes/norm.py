@@ -6,6 +6,8 @@ import datautils.structures.mp
 import montage
 
 from .... import log
+from ....imaging.processing import normalize
+from .. import tracing
 from .. import utils
 
 
@@ -15,22 +17,33 @@ logger = log.get_logger(__name__)
 
 
 class NormSerf(datautils.structures.mp.TimedSerf):
-    def setup(self, config, grab_buffers, norm_buffers, bg_buffer):
+    def setup(self, config, grab_buffers, norm_buffers, bg_buffer, rings):
         logger.debug(
             "NormSerf[%s] setup: %s, %s, %s, %s",
             self, config, grab_buffers, norm_buffers, bg_buffer)
         self.config = config
+        self.rings = rings
         self.image_size = config['crop'][:2]
         self.grab_buffers = grab_buffers
         self.norm_buffers = norm_buffers
         self.bg_buffer = bg_buffer
         self.setup_buffers()
+        self.configure_contrast(self.config['contrast'])
         if 'log_serfs' in config:
             utils.log_serf_to_directory(self, config['log_serfs'])
 
     def set_config(self, config):
         logger.debug("NormSerf[%s] set_config: %s", self, config)
         self.config = config
+        self.configure_contrast(self.config['contrast'])
+
+    def configure_contrast(self, cfg):
+        logger.debug("NormSerf[%s] configure_contrast: %s", self, cfg)
+        # if fused, measure contrast while normalizing
+        self.fused = cfg.get('fused', False)
+        self.fused_kernel = cfg.get('kernel', None)
+        self.contrast_crop = montage.ops.transform.cropping.calculate_crop(
+            self.image_size, cfg['crop'])
 
     def setup_buffers(self):
         logger.debug("NormSerf[%s] setup_buffers", self)
@@ -45,11 +58,20 @@ class NormSerf(datautils.structures.mp.TimedSerf):
 
     def normalize_grab(self, buffer_index):
         logger.debug("NormSerf[%s] normalize_grab: %s", self, buffer_index)
+        if self.fused:
+            contrast = normalize.normalize(
+                self.grabs[buffer_index], self.bg,
+                self.norms[buffer_index], self.contrast_crop,
+                kernel=self.fused_kernel)
+            self.rings['grab'].release(buffer_index, 'norm')
+            self.send('norm', buffer_index, {'contrast': contrast})
+            return
         # tests on camera node show cv2 is faster (7 ms vs 12 ms)
         cv2.multiply(
             self.grabs[buffer_index], self.bg,
             self.norms[buffer_index], dtype=cv2.CV_32F)
         #self.norms[buffer_index][:, :] = self.grabs[buffer_index] * self.bg
+        self.rings['grab'].release(buffer_index, 'norm')
         self.send('norm', buffer_index)
 
 
@@ -66,7 +88,8 @@ class NormLord(datautils.structures.mp.Lord):
         datautils.structures.mp.Lord.start(
             self, NormSerf, (
                 self.config, self.buffers.grab_buffers,
-                self.buffers.norm_buffers, self.buffers.bg_buffer), wait=wait)
+                self.buffers.norm_buffers, self.buffers.bg_buffer,
+                self.buffers.get_rings()), wait=wait)
 
     def set_config(self, config):
         logger.debug("NormLord[%s] set_config: %s", self, config)
@@ -74,9 +97,11 @@ class NormLord(datautils.structures.mp.Lord):
 
     def normalize_grab(self, index):
         logger.debug("NormLord[%s] normalize_grab: %s", self, index)
-        self.buffers.lock_grab(index)
+        self.buffers.lock_grab(index, 'norm')
+        tracing.start(self.buffers.grabs[index].meta, 'norm')
         self.send('normalize_grab', index)
 
-    def norm(self, index):
-        logger.debug("NormLord[%s] norm: %s", self, index)
-        self.buffers.unlock_grab(index)
+    def norm(self, index, results=None):
+        logger.debug("NormLord[%s] norm: %s, %s", self, index, results)
+        tracing.end(self.buffers.grabs[index].meta, 'norm')
+        # grab lock was released by the serf
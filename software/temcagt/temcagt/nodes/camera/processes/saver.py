@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 
+import functools
+import os
+import time
+
 import datautils.structures.mp
 import montage
 
 from .... import log
+from .. import tracing
 from .. import utils
 
 
@@ -13,12 +18,14 @@ logger = log.get_logger(__name__)
 
 
 class SaverSerf(datautils.structures.mp.TimedSerf):
-    def setup(self, config, grab_buffers, norm_buffers, frame_buffers):
+    def setup(
+            self, config, grab_buffers, norm_buffers, frame_buffers, rings):
         logger.debug(
             "SaverSerf[%s] setup: %s, %s, %s, %s",
             self, config, grab_buffers, norm_buffers, frame_buffers)
         # accumulate then save (to give the ability to drop bad frames)
         self.config = config
+        self.rings = rings
         self.grab_buffers = grab_buffers
         self.norm_buffers = norm_buffers
         self.frame_buffers = frame_buffers
@@ -43,39 +50,53 @@ class SaverSerf(datautils.structures.mp.TimedSerf):
             montage.io.Image(utils.buffer_as_array(b, 'u2', (h, w)))
             for b in self.frame_buffers]
 
+    def write(self, im, imtype):
+        # returns filename and write info (bytes, seconds)
+        t0 = time.time()
+        fn = utils.imwrite(im, self.config, imtype)
+        dt = time.time() - t0
+        return fn, {
+            'bytes': im.nbytes, 'seconds': dt,
+            'file_bytes': os.path.getsize(fn)}
+
     def save_grab(self, index, meta):
         logger.debug("SaverSerf[%s] save_grab: %s, %s", self, index, meta)
         self.grabs[index].meta = meta
-        fn = utils.imwrite(self.grabs[index], self.config, 'grab')
-        self.send('grab', index, fn)
+        fn, info = self.write(self.grabs[index], 'grab')
+        self.rings['grab'].release(index, 'saver')
+        self.send('grab', index, fn, info)
 
     def save_grabs(self, indicies, metas):
         logger.debug("SaverSerf[%s] save_grabs: %s, %s", self, indicies, metas)
         for (i, (bi, m)) in enumerate(zip(indicies, metas)):
             self.grabs[bi].meta = m
             self.grabs[bi].meta['grab'] = i
-            fn = utils.imwrite(self.grabs[bi], self.config, 'grab')
-            self.send('grab', bi, fn)
+            fn, info = self.write(self.grabs[bi], 'grab')
+            self.rings['grab'].release(bi, 'saver')
+            self.send('grab', bi, fn, info)
 
     def save_norm(self, index, meta):
         logger.debug("SaverSerf[%s] save_norm: %s, %s", self, index, meta)
         self.norms[index].meta = meta
-        fn = utils.imwrite(self.norms[index], self.config, 'norm')
-        self.send('norm', index, fn)
+        fn, info = self.write(self.norms[index], 'norm')
+        self.rings['grab'].release(index, 'saver')
+        self.send('norm', index, fn, info)
 
     def save_norms(self, indicies, metas):
         logger.debug("SaverSerf[%s] save_norms: %s, %s", self, indicies, metas)
         for (i, (bi, m)) in enumerate(zip(indicies, metas)):
             self.norms[bi].meta = m
             self.norms[bi].meta['grab'] = i
-            fn = utils.imwrite(self.norms[bi], self.config, 'norm')
-            self.send('norm', bi, fn)
+            fn, info = self.write(self.norms[bi], 'norm')
+            self.rings['grab'].release(bi, 'saver')
+            self.send('norm', bi, fn, info)
 
     def save_frame(self, index, meta):
         logger.debug("SaverSerf[%s] save_frame: %s, %s", self, index, meta)
         self.frames[index].meta = meta
-        fn = utils.imwrite(self.frames[index], self.config, 'frame')
-        self.send('frame', index, fn)
+        fn, info = self.write(self.frames[index], 'frame')
+        self.rings['frame'].release(index, 'saver')
+        self.send('frame', index, fn, info)
 
 
 class SaverLord(datautils.structures.mp.Lord):
@@ -84,6 +105,25 @@ class SaverLord(datautils.structures.mp.Lord):
         datautils.structures.mp.Lord.__init__(self)
         self.config = config
         self.buffers = buffers
+        # number of images sent to the serf but not yet written
+        self.in_flight = 0
+        self.clear_stats()
+
+    def clear_stats(self):
+        self.stats = {'n': 0, 'bytes': 0, 'file_bytes': 0, 'seconds': 0.}
+
+    def get_stats(self):
+        s = self.stats.copy()
+        if s['seconds'] > 0:
+            s['bytes_per_second'] = s['bytes'] / s['seconds']
+        else:
+            s['bytes_per_second'] = 0.
+        if s['file_bytes'] > 0:
+            s['compression_ratio'] = s['bytes'] / float(s['file_bytes'])
+        else:
+            s['compression_ratio'] = 1.
+        s['in_flight'] = self.in_flight
+        return s
 
     def set_config(self, config):
         logger.debug("SaverLord[%s] set_config: %s", self, config)
@@ -94,53 +134,216 @@ class SaverLord(datautils.structures.mp.Lord):
         datautils.structures.mp.Lord.start(
             self, SaverSerf, (
                 self.config, self.buffers.grab_buffers,
-                self.buffers.norm_buffers, self.buffers.frame_buffers
+                self.buffers.norm_buffers, self.buffers.frame_buffers,
+                self.buffers.get_rings()
             ), wait=wait)
 
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
     def save_grab(self, index):
         logger.debug("SaverLord[%s] save_grab: %s", self, index)
-        self.buffers.lock_grab(index)
+        self.buffers.lock_grab(index, 'saver')
+        tracing.start(self.buffers.grabs[index].meta, 'saver_grab')
         meta = self.buffers.grabs[index].meta.copy()
+        meta.pop('trace', None)
+        self.in_flight += 1
         self.send('save_grab', index, meta)
 
     def save_grabs(self, indices, **meta):
         logger.debug("SaverLord[%s] save_grabs: %s", self, meta)
         ms = []
         for i in indices:
+            tracing.start(self.buffers.grabs[i].meta, 'saver_grab')
             m = self.buffers.grabs[i].meta.copy()
-            self.buffers.lock_grab(i)
+            m.pop('trace', None)
+            self.buffers.lock_grab(i, 'saver')
             m.update(meta)
             ms.append(m)
+        self.in_flight += len(indices)
         self.send('save_grabs', indices, ms)
 
     def save_norm(self, index):
         logger.debug("SaverLord[%s] save_norm: %s", self, index)
-        self.buffers.lock_grab(index)
+        self.buffers.lock_grab(index, 'saver')
+        tracing.start(self.buffers.norms[index].meta, 'saver_norm')
         meta = self.buffers.norms[index].meta.copy()
+        meta.pop('trace', None)
+        self.in_flight += 1
         self.send('save_norm', index, meta)
 
     def save_norms(self, indices, **meta):
         logger.debug("SaverLord[%s] save_norms: %s", self, meta)
         ms = []
         for i in indices:
+            tracing.start(self.buffers.norms[i].meta, 'saver_norm')
             m = self.buffers.norms[i].meta.copy()
-            self.buffers.lock_grab(i)
+            m.pop('trace', None)
+            self.buffers.lock_grab(i, 'saver')
             m.update(meta)
             ms.append(m)
+        self.in_flight += len(indices)
         self.send('save_norms', indices, ms)
 
     def save_frame(self, index, **meta):
         logger.debug("SaverLord[%s] save_frame: %s, %s", self, index, meta)
-        self.buffers.lock_frame(index)
+        self.buffers.lock_frame(index, 'saver')
+        tracing.start(self.buffers.frames[index].meta, 'saver_frame')
         m = self.buffers.frames[index].meta.copy()
+        m.pop('trace', None)
         m.update(meta)
+        self.in_flight += 1
         self.send('save_frame', index, m)
 
-    def grab(self, index, fn):
-        self.buffers.unlock_grab(index)
+    def _written(self, info):
+        self.in_flight -= 1
+        if info is None:
+            return
+        self.stats['n'] += 1
+        self.stats['bytes'] += info['bytes']
+        self.stats['file_bytes'] += info.get('file_bytes', 0)
+        self.stats['seconds'] += info['seconds']
+
+    # buffers are released by the serf after each write
+    def grab(self, index, fn, info=None):
+        tracing.end(self.buffers.grabs[index].meta, 'saver_grab')
+        self._written(info)
+
+    def norm(self, index, fn, info=None):
+        tracing.end(self.buffers.norms[index].meta, 'saver_norm')
+        self._written(info)
+
+    def frame(self, index, fn, info=None):
+        tracing.end(self.buffers.frames[index].meta, 'saver_frame')
+        self._written(info)
+
+
+class SaverPool(object):
+    """
+    A pool of SaverLords, each with its own SaverSerf process
+
+    Each save is sent to the worker with the fewest images in flight.
+    When the total number of images in flight reaches max_in_flight the
+    pool is saturated and 'backpressure' callbacks are called, once it
+    drains to half of max_in_flight 'drained' callbacks are called.
+    'grab', 'norm' and 'frame' messages from all workers are forwarded
+    to callbacks attached to the pool.
+
+    Config (save):
+        workers : number of saver processes [default 1]
+        max_in_flight : [default number of grab buffers - nframes]
+    """
+    def __init__(self, config, buffers):
+        logger.debug("SaverPool[%s] __init__: %s, %s", self, config, buffers)
+        self.config = config
+        self.buffers = buffers
+        scfg = config['save']
+        self.max_in_flight = scfg.get(
+            'max_in_flight',
+            max(1, len(buffers.grabs) - buffers.n_frames))
+        self.lords = [
+            SaverLord(config, buffers)
+            for _ in xrange(max(1, scfg.get('workers', 1)))]
+        self.saturated = False
+        self.callbacks = {}
+        self._cbid = 0
+        for l in self.lords:
+            for attr in ('grab', 'norm', 'frame'):
+                l.attach(attr, functools.partial(self._on_written, attr))
+
+    def __len__(self):
+        return len(self.lords)
+
+    def start(self, wait=True):
+        logger.debug("SaverPool[%s] start", self)
+        [l.start(wait=wait) for l in self.lords]
+
+    def stop(self):
+        logger.debug("SaverPool[%s] stop", self)
+        [l.stop() for l in self.lords if l.is_alive()]
+
+    def is_alive(self):
+        return all([l.is_alive() for l in self.lords])
+
+    def update(self, timeout=0):
+        [l.update(timeout=timeout) for l in self.lords]
+
+    def send(self, *args, **kwargs):
+        [l.send(*args, **kwargs) for l in self.lords]
+
+    def set_config(self, config):
+        logger.debug("SaverPool[%s] set_config: %s", self, config)
+        self.config = config
+        [l.set_config(config) for l in self.lords]
+
+    def attach(self, attr, func):
+        cbid = self._cbid
+        self._cbid += 1
+        self.callbacks[cbid] = (attr, func)
+        return cbid
+
+    def detatch(self, cbid):
+        del self.callbacks[cbid]
+
+    def _call(self, attr, *args):
+        for (a, f) in self.callbacks.values():
+            if a == attr:
+                f(*args)
+
+    def in_flight(self):
+        return sum([l.in_flight for l in self.lords])
+
+    def is_saturated(self):
+        return self.saturated
+
+    def _check_in_flight(self):
+        n = self.in_flight()
+        if not self.saturated and n >= self.max_in_flight:
+            logger.warning(
+                "SaverPool[%s] saturated: %s in flight", self, n)
+            self.saturated = True
+            self._call('backpressure', n)
+        elif self.saturated and n <= self.max_in_flight / 2:
+            logger.debug("SaverPool[%s] drained: %s in flight", self, n)
+            self.saturated = False
+            self._call('drained', n)
+
+    def _on_written(self, attr, index, fn, info=None):
+        # forward 'grab', 'norm' and 'frame' to callbacks attached to pool
+        self._call(attr, index, fn, info)
+        self._check_in_flight()
+
+    def _next_lord(self):
+        return min(self.lords, key=lambda l: l.in_flight)
+
+    def save_grab(self, index):
+        self._next_lord().save_grab(index)
+        self._check_in_flight()
+
+    def save_grabs(self, indices, **meta):
+        self._next_lord().save_grabs(indices, **meta)
+        self._check_in_flight()
+
+    def save_norm(self, index):
+        self._next_lord().save_norm(index)
+        self._check_in_flight()
+
+    def save_norms(self, indices, **meta):
+        self._next_lord().save_norms(indices, **meta)
+        self._check_in_flight()
+
+    def save_frame(self, index, **meta):
+        self._next_lord().save_frame(index, **meta)
+        self._check_in_flight()
 
-    def norm(self, index, fn):
-        self.buffers.unlock_grab(index)
+    def clear_stats(self):
+        [l.clear_stats() for l in self.lords]
 
-    def frame(self, index, fn):
-        self.buffers.unlock_frame(index)
+    def get_stats(self):
+        """Per worker write counts, bytes, seconds and throughput"""
+        return {
+            'workers': [l.get_stats() for l in self.lords],
+            'in_flight': self.in_flight(),
+            'max_in_flight': self.max_in_flight,
+            'saturated': self.saturated,
+        }
@@ -5,14 +5,16 @@ Stats:
     - histogram (on grabs, norms or frames)
 Intelligently manage crops
 May need to know camera masks...
-"""
 
-import numpy
+see imaging.processing.stats for how each measure is computed
+"""
 
 import datautils.structures.mp
 import montage
 
 from .... import log
+from ....imaging.processing import stats
+from .. import tracing
 from .. import utils
 
 
@@ -22,23 +24,32 @@ logger = log.get_logger(__name__)
 
 
 class StatsSerf(datautils.structures.mp.TimedSerf):
-    def setup(self, config, grab_buffers, norm_buffers, frame_buffers):
+    def setup(
+            self, config, grab_buffers, norm_buffers, frame_buffers, rings):
         logger.debug(
             "StatsSerf[%s] setup: %s, %s, %s, %s",
             self, config, grab_buffers, norm_buffers, frame_buffers)
         # accumulate then save (to give the ability to drop bad frames)
         self.config = config
+        self.rings = rings
         self.grab_buffers = grab_buffers
         self.norm_buffers = norm_buffers
         self.frame_buffers = frame_buffers
         self.btypes = {}
         self.setup_buffers()
+        self.setup_engine()
         if 'log_serfs' in config:
             utils.log_serf_to_directory(self, config['log_serfs'])
 
     def set_config(self, config):
         logger.debug("StatsSerf[%s] set_config: %s", self, config)
         self.config = config
+        self.setup_engine()
+
+    def setup_engine(self):
+        # scratch buffers are kept between frames
+        self.engine = stats.StatsEngine.from_config(
+            self.config['stats'], self.config['index'])
 
     def setup_buffers(self):
         logger.debug("StatsSerf[%s] setup_buffers", self)
@@ -57,55 +68,15 @@ class StatsSerf(datautils.structures.mp.TimedSerf):
             'norm': self.norms,
             'frame': self.frames}
 
-    def compute_stats(self, btype, index, meta):
+    def compute_stats(self, btype, index, meta, measures=None):
         logger.debug(
             "StatsSerf[%s] compute_stats: %s, %s", self, btype, index)
         b = self.btypes[btype][index]
-        cfg = self.config['stats']
-        logger.debug("StatsSerf[%s] crop: %s", self, cfg['crop'])
-        c = montage.ops.transform.cropping.crop(b, cfg['crop'])
-        stats = {}
-        if cfg.get('focus', False):
-            m = cfg.get('focus_method', 'gradient_focus')
-            # default to gradient focus
-            f = getattr(
-                montage.ops.measures.focus,
-                m,
-                montage.ops.measures.focus.gradient_focus)
-            stats['focus'] = float(f(c))
-            #stats['focus'] = float(
-            #    montage.ops.measures.focus.gradient_focus(c))
-            #stats['focus'] = float(montage.ops.measures.focus.fft_focus(c))
-        if cfg.get('histogram', False):
-            # TODO unstretch histogram?
-            # TODO set nbins?
-            stats['histogram'] = montage.ops.measures.histogram.cvhistogram(
-                c, bins=256)
-        if cfg.get('std', False):
-            stats['std'] = float(numpy.std(c))
-        if cfg.get('mean', False):
-            stats['mean'] = float(numpy.mean(c))
-        if cfg.get('beam', False):
-            i = self.config['index']
-            if i == 0:
-                vs = b.diagonal()
-            elif i == 1:
-                vs = b[:, ::-1].diagonal()
-            elif i == 2:
-                vs = b[:, ::-1].diagonal()[::-1]
-            else:
-                vs = b.diagonal()[::-1]
-            t = vs[len(vs)/2:].max() / 2.
-            inds = numpy.where(vs > t)[0]
-            if len(inds):
-                i = int(inds[0])
-            else:
-                i = -1
-            stats['beam'] = {
-                'vs': numpy.array(vs),
-                't': float(t),
-                'i': i,
-            }
+        # only compute measures that are enabled (and requested)
+        ms = self.engine.enabled(self.config['stats'])
+        if measures is not None:
+            ms = [m for m in ms if m in measures]
+        stats = self.engine.compute(b, ms)
         # add stats from meta
         if 'row' in meta:
             stats['row'] = meta['row']
@@ -119,6 +90,8 @@ class StatsSerf(datautils.structures.mp.TimedSerf):
             stats['range'] = meta['range']
         stats['btype'] = btype
         stats['buffer_index'] = index
+        self.rings['frame' if btype == 'frame' else 'grab'].release(
+            index, 'stats')
         self.send('stats', btype, index, stats)
 
 
@@ -139,12 +112,6 @@ class StatsLord(datautils.structures.mp.Lord):
             'frame': self.buffers.lock_frame,
         }
 
-        self.unlock_by_btype = {
-            'grab': self.buffers.unlock_grab,
-            'norm': self.buffers.unlock_grab,
-            'frame': self.buffers.unlock_frame,
-        }
-
     def set_config(self, config):
         logger.debug("StatsLord[%s] set_config: %s", self, config)
         self.config = config
@@ -155,17 +122,21 @@ class StatsLord(datautils.structures.mp.Lord):
         datautils.structures.mp.Lord.start(
             self, StatsSerf, (
                 self.config, self.buffers.grab_buffers,
-                self.buffers.norm_buffers, self.buffers.frame_buffers
+                self.buffers.norm_buffers, self.buffers.frame_buffers,
+                self.buffers.get_rings()
             ), wait=wait)
 
-    def compute_stats(self, btype, index):
+    def compute_stats(self, btype, index, measures=None):
+        """measures : list of measures to compute, None for all enabled"""
         logger.debug(
             "StatsLord[%s] compute_stats: %s, %s", self, btype, index)
-        self.lock_by_btype[btype](index)
+        self.lock_by_btype[btype](index, 'stats')
         meta = self.btypes[btype][index].meta
-        self.send('compute_stats', btype, index, meta)
+        tracing.start(meta, 'stats')
+        self.send('compute_stats', btype, index, meta, measures)
 
     def stats(self, btype, index, stats):
         logger.debug(
             "StatsLord[%s] stats: %s, %s", self, btype, index)
-        self.unlock_by_btype[btype](index)
+        # buffer was released by the serf
+        tracing.end(self.btypes[btype][index].meta, 'stats')
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+Trace how long each buffer spends in each pipeline stage
+
+Lords stamp buffer meta when a stage is started (work is sent to a serf)
+and ended (the result is received):
+    meta['trace'][stage] = [start, end]
+The controller then records completed spans in a Tracer that keeps
+per stage histograms (and optionally a timeline that can be saved in
+the chrome trace event format, see chrome://tracing).
+
+All times are from a monotonic clock (seconds).
+"""
+
+import ctypes
+import ctypes.util
+import json
+import os
+import time
+
+import numpy
+
+from ... import config
+from ... import log
+
+
+logger = log.get_logger(__name__)
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _load_clock():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt'), use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        logger.warning("monotonic clock not found, using time.time")
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    ts = _timespec()
+
+    def monotonic():
+        # CLOCK_MONOTONIC = 1
+        if clock_gettime(1, ctypes.pointer(ts)) != 0:
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+
+monotonic = _load_clock()
+
+# histogram bin edges (seconds), 100 us to ~100 s
+default_bins = numpy.logspace(-4, 2, 25)
+
+
+def start(meta, stage):
+    meta.setdefault('trace', {})[stage] = [monotonic(), None]
+
+
+def end(meta, stage):
+    t = meta.setdefault('trace', {})
+    if stage not in t:
+        t[stage] = [None, monotonic()]
+    else:
+        t[stage][1] = monotonic()
+
+
+def span(meta, stage):
+    """Return (start, end) of a completed stage or None"""
+    s = meta.get('trace', {}).get(stage, None)
+    if s is None or s[0] is None or s[1] is None:
+        return None
+    return s[0], s[1]
+
+
+class Tracer(object):
+    def __init__(self, bins=None, timeline=False):
+        if bins is None:
+            bins = default_bins
+        self.bins = numpy.asarray(bins)
+        self.timeline = timeline
+        self.clear()
+
+    def clear(self):
+        self.stages = {}
+        self.events = []
+
+    def record(self, meta, stage, name=None):
+        """Record the span of stage in meta (if complete)
+
+        name : stage name to record under (defaults to stage)
+        """
+        s = span(meta, stage)
+        if s is None:
+            return None
+        if name is None:
+            name = stage
+        dt = s[1] - s[0]
+        if name not in self.stages:
+            self.stages[name] = {
+                'n': 0, 'total': 0., 'max': 0.,
+                'counts': numpy.zeros(len(self.bins) + 1, dtype='i8')}
+        st = self.stages[name]
+        st['n'] += 1
+        st['total'] += dt
+        st['max'] = max(st['max'], dt)
+        st['counts'][numpy.searchsorted(self.bins, dt)] += 1
+        if self.timeline:
+            self.events.append((name, s[0], s[1], dict([
+                (k, meta[k]) for k in
+                ('row', 'col', 'grab', 'camera', 'buffer_index')
+                if k in meta])))
+        return dt
+
+    def get_stats(self):
+        """Per stage counts, mean/max latency and a latency histogram
+
+        histogram counts[i] are for latencies < edges[i]
+        (the last count is for latencies >= edges[-1])
+        """
+        stats = {}
+        for name in self.stages:
+            st = self.stages[name]
+            stats[name] = {
+                'n': st['n'],
+                'mean': st['total'] / st['n'] if st['n'] else 0.,
+                'max': st['max'],
+                'histogram': {
+                    'edges': self.bins.tolist(),
+                    'counts': st['counts'].tolist(),
+                },
+            }
+        return stats
+
+    def save_timeline(self, fn, pid=0):
+        """Save the timeline in the chrome trace event format"""
+        fn = os.path.expanduser(fn)
+        d = os.path.dirname(fn)
+        if d != '' and not os.path.exists(d):
+            os.makedirs(d)
+        events = []
+        for (name, t0, t1, args) in self.events:
+            events.append({
+                'name': name, 'ph': 'X', 'pid': pid,
+                'tid': name.split('_')[0],
+                'ts': t0 * 1E6, 'dur': (t1 - t0) * 1E6,
+                'args': args})
+        logger.info(
+            "Tracer[%s] saving %s events to %s", self, len(events), fn)
+        with open(fn, 'w') as f:
+            json.dump(
+                {'traceEvents': events}, f,
+                cls=config.parser.NumpyAwareParser)
+        return fn
@@ -11,6 +11,7 @@ import numpy
 import montage
 
 from ... import log
+from ...imaging import tifio
 
 
 logger = log.get_logger(__name__)
@@ -33,7 +34,15 @@ def imwrite(im, cfg, imtype):
     d = cfg['save']['directory']
     fmt = cfg['save']['filename_formats'][imtype]
     fn = os.path.join(d, fmt.format(**im.meta))
-    montage.io.imwrite(fn, im)
+    compression = cfg['save'].get('compression', None)
+    bigtiff = cfg['save'].get('bigtiff', False)
+    if compression is None and not bigtiff:
+        montage.io.imwrite(fn, im)
+    else:
+        tifio.raw.write_tif(
+            fn, im, compression=compression,
+            predictor=cfg['save'].get('predictor', None),
+            bigtiff=bigtiff, **im.meta)
     return fn
 
 
@@ -65,6 +74,79 @@ def lookup_image_dimensions(config):
     return crop, 4218880
 
 
+# stages that can hold a reference to a shared buffer slot
+ring_stages = ('camera', 'norm', 'analysis', 'frame', 'saver', 'stats')
+
+
+class SharedRing(object):
+    """
+    Reference counts for a ring of shared buffers
+
+    The per-slot state words and per-stage occupancy counters live in
+    shared memory so any process (lord or serf) can claim and release
+    slots directly. A single shared lock makes each update atomic.
+    """
+    def __init__(self, n_slots, name=''):
+        self.name = name
+        self.n_slots = n_slots
+        self.lock = multiprocessing.Lock()
+        self.refs = multiprocessing.RawArray(ctypes.c_int32, n_slots)
+        self.occupancy = multiprocessing.RawArray(
+            ctypes.c_int32, len(ring_stages))
+        # total claims/releases by stage, useful for throughput checks
+        self.claims = multiprocessing.RawArray(
+            ctypes.c_uint32, len(ring_stages))
+
+    def __len__(self):
+        return self.n_slots
+
+    def __getitem__(self, index):
+        return self.refs[index]
+
+    def __iter__(self):
+        return iter(self.refs[:])
+
+    def claim(self, index, stage):
+        si = ring_stages.index(stage)
+        with self.lock:
+            self.refs[index] += 1
+            self.occupancy[si] += 1
+            self.claims[si] += 1
+
+    def release(self, index, stage):
+        si = ring_stages.index(stage)
+        with self.lock:
+            if self.refs[index] == 0:
+                raise ValueError(
+                    "Attempt to reduce %s lock[%s] to < 1" %
+                    (self.name, index))
+            self.refs[index] -= 1
+            if self.occupancy[si] > 0:
+                self.occupancy[si] -= 1
+
+    def claim_free(self, stage, start=0):
+        """Claim the first unused slot at or after start (wrapping)"""
+        si = ring_stages.index(stage)
+        with self.lock:
+            for i in xrange(self.n_slots):
+                index = (start + i) % self.n_slots
+                if self.refs[index] == 0:
+                    self.refs[index] += 1
+                    self.occupancy[si] += 1
+                    self.claims[si] += 1
+                    return index
+        return None
+
+    def n_free(self):
+        return sum(r == 0 for r in self.refs[:])
+
+    def get_occupancy(self):
+        return dict(zip(ring_stages, self.occupancy[:]))
+
+    def get_claims(self):
+        return dict(zip(ring_stages, self.claims[:]))
+
+
 class SharedBuffers(object):
     def __init__(self, config):
         h, w, s = config['crop']
@@ -99,67 +181,67 @@ class SharedBuffers(object):
             for b in self.frame_buffers]
 
         # combine norm and grab locks
-        # these are more reference counts then locks
-        self.grab_locks = [0 for _ in self.grabs]
-        self.frame_locks = [0 for _ in self.frames]
+        # these are more reference counts then locks and are kept in
+        # shared memory so serfs can release buffers without a round
+        # trip through the lord (see SharedRing)
+        self.grab_locks = SharedRing(len(self.grabs), 'grab')
+        self.frame_locks = SharedRing(len(self.frames), 'frame')
         self._frame_lock_index = 0
-        #self.locks = {
-        #    'grab': [None for _ in self.grabs],
-        #    'norm': [None for _ in self.norms],
-        #    'frame': [None for _ in self.frames],
-        #}
+
+    def get_rings(self):
+        # passed to serfs so they can claim/release slots directly
+        return {
+            'grab': self.grab_locks,
+            'frame': self.frame_locks,
+        }
 
     def get_locks(self):
         return {
-            'frame': self.frame_locks[:],
-            'grab': self.grab_locks[:],
+            'frame': self.frame_locks.refs[:],
+            'grab': self.grab_locks.refs[:],
+            'occupancy': {
+                'frame': self.frame_locks.get_occupancy(),
+                'grab': self.grab_locks.get_occupancy(),
+            },
         }
 
     def is_ready_for_grab(self):
         # look for 1 unassigned frame
-        if not any(f == 0 for f in self.frame_locks):
+        if self.frame_locks.n_free() == 0:
             return False
         # look for self.n_frames unassigned grabs & norms
-        if sum([g == 0 for g in self.grab_locks]) < self.n_frames:
+        if self.grab_locks.n_free() < self.n_frames:
             return False
         return True
 
     def is_empty(self):
-        if any(f != 0 for f in self.frame_locks):
+        if self.frame_locks.n_free() != len(self.frame_locks):
             return False
-        if any(g != 0 for g in self.grab_locks):
+        if self.grab_locks.n_free() != len(self.grab_locks):
             return False
         return True
 
-    def lock_grab(self, index):
-        self.grab_locks[index] += 1
+    def lock_grab(self, index, stage='camera'):
+        self.grab_locks.claim(index, stage)
 
-    def unlock_grab(self, index):
-        if self.grab_locks[index] == 0:
-            raise ValueError("Attempt to reduce grab lock[%s] to < 1" % index)
-        self.grab_locks[index] -= 1
+    def unlock_grab(self, index, stage='camera'):
+        self.grab_locks.release(index, stage)
 
-    def _inc_frame_lock_index(self):
+    def request_frame_lock(self):
+        # always increment frame lock
         self._frame_lock_index += 1
         if self._frame_lock_index == len(self.frame_locks):
             self._frame_lock_index = 0
-
-    def request_frame_lock(self):
-        # always increment frame lock
-        self._inc_frame_lock_index()
-        si = self._frame_lock_index
-        while self.frame_locks[self._frame_lock_index] != 0:
-            self._inc_frame_lock_index()
-            if self._frame_lock_index == si:
-                # failed to find unused frame
-                return None
-        self.frame_locks[self._frame_lock_index] += 1
-        return self._frame_lock_index
-
-    def lock_frame(self, index):
-        self.frame_locks[index] += 1
-
-    def unlock_frame(self, index):
-        if self.frame_locks[index] == 0:
-            raise ValueError("Attempt to reduce frame lock[%s] to < 1" % index)
-        self.frame_locks[index] -= 1
+        index = self.frame_locks.claim_free(
+            'frame', self._frame_lock_index)
+        if index is None:
+            # failed to find unused frame
+            return None
+        self._frame_lock_index = index
+        return index
+
+    def lock_frame(self, index, stage='frame'):
+        self.frame_locks.claim(index, stage)
+
+    def unlock_frame(self, index, stage='frame'):
+        self.frame_locks.release(index, stage)
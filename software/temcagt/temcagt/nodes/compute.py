@@ -26,11 +26,14 @@ import numpy
 from PIL import Image
 import pizco
 import slackclient
+import threading
 import time
 
 import montage
+import zmq
 
 from . import base
+from .camera import broadcast
 from .. import log
 from .. import imaging
 
@@ -40,6 +43,9 @@ default_config = {
     'cameras': [
         {
             'addr': 'tcp://127.0.0.1:11020',
+            # receive raw frames from the camera broadcast.zmq address
+            # rather than through the new_image signal
+            #'frames': 'tcp://127.0.0.1:11120',
         },
     ],
     'montager': {
@@ -141,13 +147,18 @@ class ComputeNode(base.StatefulIONode):
         self.frame_callbacks = []
         self.stats_callbacks = []
         self.frames = [None for _ in xrange(len(self.cameras))]
+        self.frame_subscribers = {}
         self.stats = None
         # Setup callbacks
         for (i, c) in enumerate(self.cameras):
             callback = lambda im, index=i: self._receive_frame(im, index)
             stats_callback = lambda stats, index=i: \
                 self._receive_stats(stats, index)
-            c.new_image.connect(callback)
+            if 'frames' in cfg['cameras'][i]:
+                self.frame_subscribers[i] = broadcast.FrameSubscriber(
+                    cfg['cameras'][i]['frames'])
+            else:
+                c.new_image.connect(callback)
             c.new_stats.connect(stats_callback)
             self.frame_callbacks.append(callback)
             self.stats_callbacks.append(stats_callback)
@@ -162,6 +173,12 @@ class ComputeNode(base.StatefulIONode):
         self.new_tile = pizco.Signal(nargs=1)
         self.new_coarse_montage = pizco.Signal(nargs=1)
         self.mean_percentiles = None
+        self._frame_thread = None
+        if len(self.frame_subscribers):
+            self._frame_thread = threading.Thread(
+                target=self._receive_frames)
+            self._frame_thread.daemon = True
+            self._frame_thread.start()
 
     def connect(self, index=None):
         logger.info("ComputeNode[%s] connect", self)
@@ -176,8 +193,10 @@ class ComputeNode(base.StatefulIONode):
     def __del__(self):
         # disconnect signals
         for i in xrange(len(self.frame_callbacks)):
-            self.cameras[i].new_image.disconnect(self.frame_callbacks[i])
+            if i not in self.frame_subscribers:
+                self.cameras[i].new_image.disconnect(self.frame_callbacks[i])
             self.cameras[i].new_stats.disconnect(self.stats_callbacks[i])
+        self.frame_subscribers = {}
 
     def config_changed(self, delta):
         pass
@@ -263,6 +282,21 @@ class ComputeNode(base.StatefulIONode):
         # for now just re-broadcast tile
         self.new_tile.emit(tile)
 
+    def _receive_frames(self):
+        # runs in _frame_thread, hands frames to the node loop
+        poller = zmq.Poller()
+        subscribers = {}
+        for (i, s) in self.frame_subscribers.items():
+            poller.register(s.socket, zmq.POLLIN)
+            subscribers[s.socket] = (i, s)
+        while len(self.frame_subscribers):
+            for (socket, _) in poller.poll(100):
+                i, s = subscribers[socket]
+                im = s.recv()
+                if self.loop is not None:
+                    self.loop.add_callback(self._receive_frame, im, i)
+        [s.close() for (_, s) in subscribers.values()]
+
     def _receive_frame(self, image, index):
         logger.debug("ComputeNode[%s] _receive_frame: %s, %s", self,
                      index, id(image))
@@ -92,6 +92,36 @@ default_config = {
             'width': 50000, 'height': 50000,
         },
         'use_vertices': True,
+        # tile in roi test: 'numpy' or 'shapely', see planning.tile_mask
+        'filter_method': 'numpy',
+        # tile order: 'plan' (as planned) or 'optimize' (minimize the
+        # predicted move + settle time), see planning.order_points
+        'order': {
+            'method': 'plan',
+            'speed': [1000000, 1000000],  # estimated stage speed [x, y]
+            'settle': [0.080, 0.3],  # [x, y], see settling_time
+            'time_limit': 2.0,
+        },
+    },
+    'pipeline': {
+        # start the move to the next tile once the current one is
+        # exposed (camera regrabs are disabled, vetoed tiles are
+        # re-imaged by moving back up to max_regrabs times)
+        'enable': False,
+        'max_regrabs': 1,
+    },
+    'index': {
+        # sessions by roi and montage id, used to resume montages
+        'filename': '~/.temcagt/montages/index.json',
+        # re-image vetoed tiles when resuming
+        'resume_vetoed': True,
+    },
+    'journal': {
+        # tiles are appended to <session>_tiles.jsonl as they finish
+        # (fsync'd every sync_every tiles or sync_interval seconds) and
+        # compacted to <session>_tiles.json at finish
+        'sync_every': 16,
+        'sync_interval': 5.0,
     },
     'settling_time': {
         # 'x': 0.025,
@@ -105,6 +135,17 @@ default_config = {
         #'row_jump': False,
         #'jump_steps': [10, ],
         'jump_size': 160000,
+        # predict settle time from move distance and direction, the
+        # model is refined from the post-grab drift of each tile and
+        # saved in 'state', see montaging.settle
+        'model': {
+            'enable': False,
+            'tolerance': 1.0,  # acceptable drift [pixels]
+            'min': 0.0,
+            'max': 1.0,
+            'min_samples': 10,
+            'fit': [],  # _tiles.json(l) files to fit from
+        },
     },
     'bake': {
         'time': 0.01,
@@ -224,18 +265,52 @@ class BakeSM(base.StateMachine):
 
 
 class MontageSM(base.StateMachine):
+    def __init__(self, node):
+        super(MontageSM, self).__init__(node)
+        self.resuming = False
+
+    def resume(self):
+        # image only the tiles missing from an earlier montage
+        self.resuming = True
+        return 'setup'
+
     def setup(self):
         cfg = self.node.config()
-        self.tiles = []
+        self.n_tiles = 0
         # record start time
         start_time = time.localtime()
-        [c.stop_streaming() for c in self.node.cameras]
         pts = compute_points(cfg['montage'])
+        self.index = montaging.index.SessionIndex(cfg['index']['filename'])
+        self.roi_key = montaging.index.roi_key(cfg['montage'])
+        self.resumes = None
+        locs = range(len(pts))
+        if self.resuming:
+            session = self.index.session(self.roi_key, self.node.resume_id)
+            self.resumes = session['id']
+            completed = self.index.completed_tiles(
+                self.roi_key, self.resumes,
+                include_vetoed=not cfg['index'].get('resume_vetoed', True))
+            locs = montaging.index.missing_indices(pts, completed)
+            logger.info(
+                "MontageSM resuming %s: %i of %i tiles missing",
+                self.resumes, len(locs), len(pts))
+            if not len(locs):
+                # nothing to image, finish the resumed session
+                tiles_fn = os.path.join(
+                    session['directory'], session['id'] + '_tiles.json')
+                montaging.journal.compact(
+                    self.index.journals(self.roi_key, self.resumes),
+                    tiles_fn)
+                self.index.finish_session(
+                    self.roi_key, self.resumes, n_completed=len(completed))
+                return None
+        [c.stop_streaming() for c in self.node.cameras]
         # pre-compute dr dc moves
         self.n_vetos = 0
         self.pts = []
         pp = None
-        for (i, p) in enumerate(pts):  # make pts: x, y, r, c, dr, dc, i
+        for i in locs:  # make pts: x, y, r, c, dr, dc, i
+            p = pts[i]
             dr = False
             dc = False
             if pp is None or pp[2] != p[2]:
@@ -248,8 +323,16 @@ class MontageSM(base.StateMachine):
         # move to postion 0
         x, y, _, _, _, _, _ = self.pts[0]
         self.node.motion.move(x, y, wait=True, poll=True, hold=60000)
+        self.position = (x, y)
+        self.settle_model = None
+        if cfg['settling_time'].get('model', {}).get('enable', False):
+            self.settle_model = montaging.settle.SettleModel.from_config(
+                cfg['settling_time'])
+            for fn in cfg['settling_time']['model'].get('fit', []):
+                self.settle_model.fit(montaging.settle.records_from_tiles(
+                    montaging.journal.load_tiles(fn)))
         # jump?
-        if cfg['settling_time']['jump']:
+        if cfg['settling_time']['jump'] and len(self.pts) > 1:
             x2, y2, _, _, _, _, _ = self.pts[1]
             jump_x = cfg['settling_time']['jump_size']
             if x2 < x:  # determine safe direction from next point
@@ -301,6 +384,26 @@ class MontageSM(base.StateMachine):
         for n in [self.node, self.node.motion] + self.node.cameras:
             n.start_logging(save_dir, log_level)
 
+        # tiles are journaled as they finish
+        jcfg = cfg.get('journal', {})
+        journal_fn = os.path.join(save_dir, session_name + '_tiles.jsonl')
+        self.journal = montaging.journal.TileJournal(
+            journal_fn, jcfg.get('sync_every', 16),
+            jcfg.get('sync_interval', 5.0))
+
+        # pipelined: move to the next tile once the cameras have exposed
+        # the current tile, checking grabs while the stage moves
+        pcfg = cfg.get('pipeline', {})
+        self.pipelined = pcfg.get('enable', False)
+        self.max_regrabs = pcfg.get('max_regrabs', 1)
+        self.pending = []
+        self.regrabs = {}
+        self.grab_error = None
+        # the stage may have moved before a camera could regrab so
+        # pipelined grabs are run without camera regrabs and vetoed
+        # tiles are regrabbed by moving back (see tile_done)
+        self.camera_regrabs = 0 if self.pipelined else None
+
         # configure cameras
         for c in self.node.cameras:
             c.restart_acquisition()
@@ -311,10 +414,15 @@ class MontageSM(base.StateMachine):
         config.parser.save(
             self.node.motion.config(), os.path.join(
                 save_dir, session_name + '_motion.json'))
+        self.frame_formats = []
         for (i, c) in enumerate(self.node.cameras):
+            ccfg = c.config()
             config.parser.save(
-                c.config(), os.path.join(
+                ccfg, os.path.join(
                     save_dir, session_name + '_cam%i.json' % i))
+            self.frame_formats.append((
+                ccfg.get('index', i), os.path.join(
+                    save_dir, ccfg['save']['filename_formats']['frame'])))
 
         # report start of montage, size [nr x nc], etc
         # - name
@@ -328,7 +436,17 @@ class MontageSM(base.StateMachine):
             'start': time.mktime(start_time),
             'size': (n_rows, n_cols),
             'n_tiles': len(self.pts),
+            'journal': journal_fn,
+            'resumes': self.resumes,
         }
+        ocfg = cfg['montage'].get('order', {})
+        if 'speed' in ocfg and 'settle' in ocfg:
+            sd['predicted_move_time'] = \
+                montaging.planning.predict_duration(
+                    [p[:4] for p in self.pts], ocfg['speed'], ocfg['settle'])
+        self.index.add_session(
+            self.roi_key, session_name, save_dir, journal_fn, len(self.pts),
+            resumes=self.resumes)
         self.node.new_session.emit(sd)
 
         self.node.config({'session': {'montage': sd}})
@@ -343,50 +461,63 @@ class MontageSM(base.StateMachine):
         return 'move'
 
     def move(self):
+        if self.grab_error is not None:
+            # a tracked grab failed, stop the montage
+            raise self.grab_error
         if len(self.pts) == 0:
             #if not all([c.ready_to_grab() for c in self.node.cameras]):
             #    logger.warning(
             ##        "Cameras were not ready to grab... delaying finish")
             #    # if not, call check_grabs after a short delay
             #    return 'move', 0.001
+            if len(self.pending):
+                # wait for in flight tiles (which might need regrabs)
+                return 'move', list(self.pending)
             return 'finish'
         cfg = self.node.config()
-        x, y, r, c, dr, dc, i = self.pts.pop(0)
-        # move only necessary axes
+        self.point = self.pts.pop(0)
+        x, y, r, c, _, _, i = self.point
+        # move only necessary axes, these are found from the last
+        # commanded position (not the planned dr, dc) as tiles can be
+        # re-queued out of order (see tile_done)
         # get wait, poll, hold from cfg
         mkwargs = {
             'wait': cfg['settling_time']['wait'],
             'poll': cfg['settling_time']['poll'],
             'hold': cfg['settling_time']['hold'],
         }
+        px, py = self.position
+        dx = x - px
+        dy = y - py
         settle = None
-        if dr and dc:
+        if dx and dy:
             mr = self.node.motion.move(x=x, y=y, **mkwargs)
             settle = max(cfg['settling_time']['x'], cfg['settling_time']['y'])
-        elif dr:
+        elif dy:
             mr = self.node.motion.move(y=y, **mkwargs)
             settle = cfg['settling_time']['y']
             # TODO jump?
-        elif dc:
+        elif dx:
             mr = self.node.motion.move(x=x, **mkwargs)
             settle = cfg['settling_time']['x']
         else:
-            # TODO error?
+            # already at this tile
             mr = None
+        if self.settle_model is not None and mr is not None:
+            settle = self.settle_model.predict(dx, dy)
+        self.position = (x, y)
         self.meta = {
             'x': x, 'y': y, 'row': r, 'col': c,
             'loc': i,
+            'move': [dx, dy],
             'settle': settle}
         if mr is not None:
             self.meta['x'] = mr.get('x', x)
             self.meta['y'] = mr.get('y', y)
-        if settle is None:
+        if not settle:
             return 'grab'
-        t0 = time.time()
-        while time.time() - t0 < settle:
-            [c.update_controller() for c in self.node.cameras]
-        #return 'grab', settle
-        return 'grab'
+        # grab (from the loop) after settling
+        return 'grab', settle
 
     def grab(self):
         # check buffers are available
@@ -397,7 +528,13 @@ class MontageSM(base.StateMachine):
             return 'grab', 0.001
         # start grabs
         meta = self.meta.copy()
-        self.grabs = [c.start_grab(meta) for c in self.node.cameras]
+        self.grabs = [
+            c.start_grab(meta, regrabs=self.camera_regrabs)
+            for c in self.node.cameras]
+        if self.pipelined:
+            self.track_tile(self.point, meta, self.grabs)
+            return 'move', [
+                c.wait_for_exposure() for c in self.node.cameras]
         self.grab_results = {}
         # attach done callbacks to store vetos
         for g in self.grabs:
@@ -414,29 +551,90 @@ class MontageSM(base.StateMachine):
         self.grab_results[grab] = grab.result()
         #self.grab_results[index] = grab.result()
 
-    def check_grabs(self):
+    def build_tile(self, meta, results):
         # vetos, regrabs, vetoed
-        logger.debug("check_grabs: %s", self.grab_results)
         tile = {
-            'vetoed': False, 'regrabs': 0, 'vetos': [],
-            'meta': self.meta.copy()}
-        for g in self.grabs:
-            valid, reason = self.grab_results[g]
+            'vetoed': False, 'regrabs': 0, 'vetos': [], 'drift': None,
+            'meta': meta.copy(), 'paths': []}
+        for (ci, fmt) in self.frame_formats:
+            try:
+                tile['paths'].append(fmt.format(
+                    camera=ci, row=meta['row'], col=meta['col']))
+            except (KeyError, IndexError, ValueError):
+                # format needs more than the tile location
+                tile['paths'].append(None)
+        for (valid, reason) in results:
             if valid:
                 tile['vetos'].append(None)
             else:
                 tile['vetos'].append(reason)
                 tile['vetoed'] = True
-                self.n_vetos += 1
             tile['regrabs'] = max(tile['regrabs'], reason.get('regrabs', 0))
+            if reason.get('drift', None) is not None:
+                tile['drift'] = max(tile['drift'], reason['drift'])
+        if self.settle_model is not None:
+            self.settle_model.update(
+                meta['move'][0], meta['move'][1], meta['settle'],
+                tile['drift'])
+        return tile
+
+    def add_tile(self, tile):
+        self.n_vetos += len([v for v in tile['vetos'] if v is not None])
+        self.n_tiles += 1
+        self.journal.write(tile)
         # send new tile
-        self.tiles.append(tile)
         self.node.new_tile.emit(tile)
+
+    def check_grabs(self):
+        logger.debug("check_grabs: %s", self.grab_results)
+        self.add_tile(self.build_tile(
+            self.meta, [self.grab_results[g] for g in self.grabs]))
         return 'move'
 
+    def track_tile(self, point, meta, grabs):
+        # call tile_done (in the loop) when all grabs for a tile finish
+        self.pending.extend(grabs)
+        state = {'done': False}
+
+        def check(f):
+            if state['done'] or not all([g.done() for g in grabs]):
+                return
+            state['done'] = True
+            [self.pending.remove(g) for g in grabs]
+            errors = [
+                g.exception() for g in grabs if g.exception() is not None]
+            if len(errors):
+                # error the state machine on the next move
+                logger.error(
+                    "MontageSM grab failed for tile %s: %s", point, errors[0])
+                if self.grab_error is None:
+                    self.grab_error = errors[0]
+                return
+            self.tile_done(point, meta, [g.result() for g in grabs])
+
+        for g in grabs:
+            self.node.loop.add_future(g, check)
+
+    def tile_done(self, point, meta, results):
+        tile = self.build_tile(meta, results)
+        i = point[-1]
+        tile['regrabs'] = max(tile['regrabs'], self.regrabs.get(i, 0))
+        if tile['vetoed'] and self.regrabs.get(i, 0) < self.max_regrabs:
+            # move back and grab this tile again next
+            logger.info("MontageSM regrabbing vetoed tile: %s", point)
+            self.regrabs[i] = self.regrabs.get(i, 0) + 1
+            x, y, r, c, _, _, i = point
+            self.pts.insert(0, (x, y, r, c, True, True, i))
+            return
+        self.add_tile(tile)
+
     def finish(self):
         cfg = self.node.config()
         nodatas = [c.finish_grab() for c in self.node.cameras]
+        if self.settle_model is not None:
+            # save the refined model for the next montage
+            self.node.config({'settling_time': {'model': {
+                'state': self.settle_model.get_state()}}})
         n_nodatas = 0
         for n in nodatas:
             if n is not None:
@@ -447,11 +645,17 @@ class MontageSM(base.StateMachine):
         for n in [self.node, self.node.motion] + self.node.cameras:
             n.stop_logging()
 
-        # save tiles
+        # compact tile journal (and any resumed journals) to tiles
+        self.journal.close()
+        session_name = cfg['session']['montage']['name']
         tiles_fn = os.path.join(
             cfg['session']['montage']['directory'],
-            cfg['session']['montage']['name'] + '_tiles.json')
-        config.parser.save(self.tiles, tiles_fn)
+            session_name + '_tiles.json')
+        montaging.journal.compact(
+            self.index.journals(self.roi_key, session_name), tiles_fn)
+        self.index.finish_session(
+            self.roi_key, session_name,
+            n_completed=self.n_tiles, n_vetos=self.n_vetos)
 
         # poll position
         self.node.motion.poll_position()
@@ -505,6 +709,7 @@ class MontagerNode(base.StatefulIONode):
             lambda p: self.new_position.emit(p))
 
         #self.tiles = []
+        self.resume_id = None
         self.new_tile = pizco.Signal(nargs=1)
         self.new_session = pizco.Signal(nargs=1)
 
@@ -606,6 +811,17 @@ class MontagerNode(base.StatefulIONode):
         self.attach_state_machine(
             MontageSM, 'setup')
 
+    def resume(self, montage_id=None):
+        """Resume an unfinished montage of the configured roi
+
+        Only tiles missing from that montage (and any it resumed) are
+        imaged, defaults to the latest unfinished montage of the roi
+        """
+        self.new_tile.emit([])
+        self.resume_id = montage_id
+        self.attach_state_machine(
+            MontageSM, 'resume')
+
     def check_save_directory(self, directory, next_directory=None, npts=None):
         cfg = self.config()
         if npts is None:
@@ -3,7 +3,9 @@
 """
 
 import os
+import time
 
+import concurrent.futures
 import pizco
 import smaract
 
@@ -37,7 +39,12 @@ default_config = {
     },
     'cfg': {
         'sensor_enabled': 1,
-    }
+    },
+    # check for completion of batch_move every poll seconds
+    'batch_move': {
+        'poll': 0.002,
+        'timeout': 60.0,
+    },
 }
 
 
@@ -250,11 +257,8 @@ class MotionNode(base.IONode):
         logger.debug("MotionNode[%s] poll_position", self)
         if wait:
             self.wait_till_moved()
-        self._controller.poll_position(self._axes['x'], flush=False)
-        self._controller.poll_position(self._axes['y'], flush=False)
-        self._controller.flush()
-        x = self._controller.last_position(self._axes['x'])
-        y = self._controller.last_position(self._axes['y'])
+        x, y = self._controller.get_positions(
+            [self._axes['x'], self._axes['y']])
         r = {'x': x, 'y': y}
         #if machine:
         #    r = {'x': x, 'y': y, 'system': 'machine'}
@@ -332,30 +336,7 @@ class MotionNode(base.IONode):
         logger.debug("MotionNode[%s] move, %s", self,
                      (x, y, wait, relative, poll, hold))
         #self._write_position(x, y, relative, machine)
-        self._write_position(x, y, relative)
-        if relative:
-            if x is not None:
-                self._controller.move_relative(
-                    self._axes['x'], int(x), hold_time=hold, flush=False)
-            if y is not None:
-                self._controller.move_relative(
-                    self._axes['y'], int(y), hold_time=hold, flush=False)
-        else:
-            mx = x
-            my = y
-            #if machine:
-            #    mx = x
-            #    my = y
-            #else:
-            #    mx = self._to_machine_position('x', x)
-            #    my = self._to_machine_position('y', y)
-            if x is not None:
-                self._controller.move_absolute(
-                    self._axes['x'], int(mx), hold_time=hold, flush=False)
-            if y is not None:
-                self._controller.move_absolute(
-                    self._axes['y'], int(my), hold_time=hold, flush=False)
-        self._controller.flush()
+        self._start_move({'x': x, 'y': y}, relative, hold)
         try:
             if poll:
                 return self.poll_position(wait=True)
@@ -374,6 +355,76 @@ class MotionNode(base.IONode):
                 raise e
         return
 
+    def _start_move(self, moves, relative, hold):
+        # send all axis moves in one flush, returns the moved channels
+        self._write_position(moves.get('x'), moves.get('y'), relative)
+        axes = [a for a in ('x', 'y') if moves.get(a, None) is not None]
+        channels = [self._axes[a] for a in axes]
+        if len(channels):
+            self._controller.move(
+                channels, [int(moves[a]) for a in axes],
+                relative=relative, hold_time=hold)
+        return channels
+
+    def batch_move(self, moves, relative=False, hold=0, poll=True):
+        """Move several axes at once, returns a Future
+
+        moves: {axis: position}, e.g. {'x': 1000, 'y': 2000}
+        All axis commands are sent in one flush and the future is done
+        when all axes complete (the result is the new position if poll).
+        Completion is checked from the loop (when served) so this does
+        not block other calls.
+        """
+        if not self.connected():
+            msg = 'Attempt to batch_move when un-connected'
+            logger.error(msg)
+            raise IOError(msg)
+        if self._locked:
+            msg = 'Attempt to move locked stage'
+            logger.error(msg)
+            raise IOError(msg)
+        logger.debug(
+            "MotionNode[%s] batch_move, %s", self,
+            (moves, relative, hold, poll))
+        bcfg = self.config().get('batch_move', {})
+        future = concurrent.futures.Future()
+        try:
+            channels = self._start_move(moves, relative, hold)
+        except Exception as e:
+            future.set_exception(e)
+            return future
+        if self.loop is None:
+            # not served, wait here
+            try:
+                self._controller.wait(
+                    channels, timeout=bcfg.get('timeout', 60.0))
+                future.set_result(
+                    self.poll_position(wait=False) if poll else None)
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        self._watch_move(
+            future, channels, poll, time.time(),
+            bcfg.get('poll', 0.002), bcfg.get('timeout', 60.0))
+        return future
+
+    def _watch_move(self, future, channels, poll, t0, pause, timeout):
+        # completion is driven by the controller packet stream
+        try:
+            if self._controller.moving(channels):
+                if time.time() - t0 > timeout:
+                    raise IOError(
+                        "batch_move exceeded timeout: %s" % timeout)
+                self.loop.call_later(
+                    pause, self._watch_move, future, channels, poll, t0,
+                    pause, timeout)
+                return
+            future.set_result(
+                self.poll_position(wait=False) if poll else None)
+        except Exception as e:
+            logger.error("MotionNode[%s] batch_move failed: %s", self, e)
+            future.set_exception(e)
+
 
 def test_node(config):
     n = MotionNode(config)
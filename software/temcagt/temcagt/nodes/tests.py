@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 
+import copy
+import os
+import threading
 import unittest
 
+import concurrent.futures
+import numpy
+
 from . import base
 
 
@@ -55,6 +61,201 @@ class CameraTest(unittest.TestCase):
     def new_images_signal(self):
         pass
 
+    def exposure(self):
+        from .camera.controllers import grab
+
+        class Lord(object):
+            def attach(self, attr, func):
+                return 0
+
+            def detatch(self, cbid):
+                pass
+
+            def update(self, timeout=0):
+                pass
+
+            def clear_template(self):
+                pass
+
+            def is_saturated(self):
+                return False
+
+            def start_grab(self, meta):
+                pass
+
+            def normalize_grab(self, index):
+                pass
+
+        class Buffer(object):
+            meta = None
+
+        class Buffers(object):
+            grabs = [Buffer() for _ in xrange(4)]
+
+            def is_empty(self):
+                return True
+
+        class Node(object):
+            camera = norm = analysis = frame = stats = saver = Lord()
+            buffers = Buffers()
+            tracer = None
+
+            def config(self):
+                return {
+                    'nframes': 3, 'nregrabs': 2,
+                    'contrast': {'min': 0}, 'stats': {},
+                    'shift': {'max_shift': 1, 'min_match': 0},
+                    'broadcast': {'enable': False},
+                    'save': {'on_fail': False}, 'frame': {}}
+
+        c = grab.GrabController(Node())
+        try:
+            e = concurrent.futures.Future()
+            c.exposure = e
+            c.run({}, until_done=False, regrabs=0)
+            self.assertEqual(c.max_regrabs, 0)
+            # exposed once nframes are grabbed
+            for i in xrange(3):
+                self.assertFalse(e.done())
+                c.on_grab({'buffer_index': i})
+            self.assertEqual(e.result(), 3)
+            # a later run resolves only its own future
+            c.state = 'success'
+            e2 = concurrent.futures.Future()
+            c.exposure = e2
+            c.run({}, until_done=False)
+            self.assertEqual(c.max_regrabs, 2)
+            c.on_grab({'buffer_index': 3})
+            self.assertFalse(e2.done())
+            self.assertEqual(e.result(), 3)
+            # regrabs can only be lowered per run
+            c.state = 'success'
+            c.run({}, until_done=False, regrabs=5)
+            self.assertEqual(c.max_regrabs, 2)
+        finally:
+            c.state = 'success'
+            c.disconnect()
+
+    def exposure_per_grab(self):
+        from .camera import camera
+
+        class Controller(object):
+            nodata_buffer = None
+            veto = False
+            veto_info = {}
+            exposure = None
+
+            def __init__(self):
+                self.ready = [threading.Event(), threading.Event()]
+
+            def run(self, meta, until_done=True, regrabs=None):
+                self.ready[meta['i']].wait(5.0)
+                self.exposure.set_result(meta['i'])
+
+        class Node(camera.CameraNode):
+            def __init__(self):
+                self.pool = concurrent.futures.ThreadPoolExecutor(1)
+                self.exposure = None
+                self.controller = Controller()
+
+            def __del__(self):
+                self.pool.shutdown()
+
+            def connected(self):
+                return True
+
+            def set_controller(self, cls):
+                pass
+
+        n = Node()
+        g0 = n.start_grab({'i': 0})
+        e0 = n.wait_for_exposure()
+        # queue a second grab before the first is exposed
+        g1 = n.start_grab({'i': 1})
+        e1 = n.wait_for_exposure()
+        self.assertIsNot(e0, e1)
+        n.controller.ready[0].set()
+        self.assertEqual(e0.result(5.0), 0)
+        self.assertEqual(g0.result(5.0), (True, {}))
+        self.assertFalse(e1.done())
+        n.controller.ready[1].set()
+        self.assertEqual(e1.result(5.0), 1)
+        self.assertEqual(g1.result(5.0), (True, {}))
+        n.pool.shutdown()
+
+    def broadcast_overflow(self):
+        from .camera import broadcast
+
+        class Frame(numpy.ndarray):
+            pass
+
+        a = numpy.zeros((8, 8), dtype='u2').view(Frame)
+        a.meta = {}
+        p = broadcast.FramePublisher(
+            'inproc://broadcast_overflow',
+            'temcagt_test_%i' % os.getpid(), a.nbytes)
+        try:
+            p.send(a, copy=True)
+            self.assertEqual(p.shm.sequence(), 2)
+            p.send(a, wait=1.0)
+            self.assertEqual(p.shm.sequence(), 4)
+            # frames with large headers are only sent over zmq
+            a.meta = {'vetos': ['x' * 100] * 100}
+            p.send(a)
+            self.assertEqual(p.shm.sequence(), 4)
+            # as are frames too large for the segment
+            b = numpy.zeros((16, 16), dtype='u2').view(Frame)
+            b.meta = {}
+            p.send(b)
+            self.assertEqual(p.shm.sequence(), 4)
+            with self.assertRaises(broadcast.SharedFrameOverflow):
+                p.shm.write(b)
+        finally:
+            p.close()
+
+    def dispatch_pool(self):
+        from .camera.controllers import base as controllers
+
+        class Pipe(object):
+            def __init__(self):
+                self.r, self.w = os.pipe()
+
+            def fileno(self):
+                return self.r
+
+        class Lord(object):
+            def __init__(self):
+                self.pipe = Pipe()
+
+        class Pool(object):
+            def __init__(self, n):
+                self.lords = [Lord() for _ in xrange(n)]
+
+        class Node(object):
+            saver = Pool(2)
+
+        class Controller(controllers.NodeController):
+            def update(self, timeout=0.000001):
+                raise AssertionError("dispatch fell back to update")
+
+            def update_lord(self, name, lord):
+                os.read(lord.pipe.r, 1)
+                self.updated.append(name)
+
+        c = Controller(Node())
+        c.updated = []
+        self.assertEqual([n for (n, _) in c.lords()], ['saver0', 'saver1'])
+        # nothing to read, select times out
+        self.assertEqual(c.dispatch(timeout=0.01), 0)
+        # only the pool member with a message is updated
+        os.write(Node.saver.lords[1].pipe.w, 'm')
+        self.assertEqual(c.dispatch(timeout=0.01), 1)
+        self.assertEqual(c.updated, ['saver1'])
+        self.assertEqual(c.get_dispatch_stats()['saver1']['n'], 1)
+        for l in Node.saver.lords:
+            os.close(l.pipe.r)
+            os.close(l.pipe.w)
+
 
 class ControlTest(unittest.TestCase):
     def connect(self):
@@ -75,6 +276,97 @@ class ControlTest(unittest.TestCase):
     def montage(self):
         pass
 
+    def _montage_sm(self):
+        from . import montager
+
+        class Loop(object):
+            def add_future(self, f, cb):
+                f.add_done_callback(cb)
+
+        class Motion(object):
+            def __init__(self):
+                self.moves = []
+
+            def move(self, x=None, y=None, **kwargs):
+                self.moves.append((x, y))
+                return {}
+
+        class Signal(object):
+            def emit(self, v):
+                pass
+
+        class Journal(object):
+            def __init__(self):
+                self.tiles = []
+
+            def write(self, tile):
+                self.tiles.append(tile)
+
+        class Node(object):
+            loop = Loop()
+            motion = Motion()
+            new_tile = Signal()
+            cameras = []
+
+            def config(self):
+                return {'settling_time': {
+                    'wait': False, 'poll': False, 'hold': 0,
+                    'x': 0.1, 'y': 0.2}}
+
+        sm = montager.MontageSM(Node())
+        sm.journal = Journal()
+        sm.frame_formats = []
+        sm.settle_model = None
+        sm.n_tiles = 0
+        sm.n_vetos = 0
+        sm.pending = []
+        sm.regrabs = {}
+        sm.max_regrabs = 1
+        sm.grab_error = None
+        return sm
+
+    def pipeline_regrab(self):
+        sm = self._montage_sm()
+        # at tile 1 (10, 0), tile 0 (0, 0) was vetoed
+        sm.position = (10., 0.)
+        # planned: move only y from tile 1 to tile 2
+        sm.pts = [(10., 10., 1, 1, True, False, 2)]
+        p = (0., 0., 0, 0, True, True, 0)
+        meta = {'row': 0, 'col': 0, 'move': [0, 0], 'settle': None}
+        vetoed = [(False, {'regrabs': 0})]
+        sm.tile_done(p, meta, vetoed)
+        self.assertEqual(sm.pts[0][:4], p[:4])
+        self.assertEqual(len(sm.journal.tiles), 0)
+        # move back to tile 0 (only x)
+        self.assertEqual(sm.move(), ('grab', 0.1))
+        self.assertEqual(sm.node.motion.moves[-1], (0., None))
+        self.assertEqual(sm.meta['move'], [-10., 0.])
+        # tile 2 now needs both axes
+        self.assertEqual(sm.move(), ('grab', 0.2))
+        self.assertEqual(sm.node.motion.moves[-1], (10., 10.))
+        self.assertEqual(sm.meta['move'], [10., 10.])
+        # vetoed again, max_regrabs reached so it is kept
+        sm.tile_done(p, meta, vetoed)
+        self.assertEqual(len(sm.pts), 0)
+        self.assertEqual(len(sm.journal.tiles), 1)
+        self.assertTrue(sm.journal.tiles[0]['vetoed'])
+        self.assertEqual(sm.journal.tiles[0]['regrabs'], 1)
+
+    def pipeline_error(self):
+        sm = self._montage_sm()
+        sm.position = (0., 0.)
+        sm.pts = [(10., 0., 0, 1, False, True, 1)]
+        gs = [concurrent.futures.Future(), concurrent.futures.Future()]
+        sm.track_tile(
+            (0., 0., 0, 0, True, True, 0), {'row': 0, 'col': 0}, gs)
+        self.assertEqual(len(sm.pending), 2)
+        gs[0].set_result((True, {}))
+        gs[1].set_exception(IOError('failed'))
+        self.assertEqual(len(sm.pending), 0)
+        self.assertEqual(len(sm.journal.tiles), 0)
+        with self.assertRaises(IOError):
+            sm.move()
+
 
 class MotionTest(unittest.TestCase):
     def connect(self):
@@ -92,6 +384,29 @@ class MotionTest(unittest.TestCase):
     def move(self):
         pass
 
+    def batch_move(self):
+        from . import motion
+        n = motion.MotionNode(copy.deepcopy(motion.default_config))
+        n.connect()
+        # absolute
+        f = n.batch_move({'x': 1000, 'y': 2000})
+        self.assertEqual(f.result(), {'x': 1000, 'y': 2000})
+        # relative
+        f = n.batch_move({'x': 10, 'y': -20}, relative=True)
+        self.assertEqual(f.result(), {'x': 1010, 'y': 1980})
+        # single axis
+        f = n.batch_move({'y': 0})
+        self.assertEqual(f.result(), {'x': 1010, 'y': 0})
+        # without polling the result is None
+        f = n.batch_move({'x': 5}, poll=False)
+        self.assertIsNone(f.result())
+        self.assertEqual(n.poll_position(wait=False), {'x': 5, 'y': 0})
+        n.lock()
+        with self.assertRaises(IOError):
+            n.batch_move({'x': 0})
+        n.unlock()
+        n.disconnect()
+
     def check_calibrate(self):
         pass
 
@@ -108,6 +423,10 @@ suite.addTest(CameraTest('check_config'))
 suite.addTest(CameraTest('start_grab'))
 suite.addTest(CameraTest('grab'))
 suite.addTest(CameraTest('save_images'))
+suite.addTest(CameraTest('exposure'))
+suite.addTest(CameraTest('exposure_per_grab'))
+suite.addTest(CameraTest('dispatch_pool'))
+suite.addTest(CameraTest('broadcast_overflow'))
 
 suite.addTest(ControlTest('connect'))
 suite.addTest(ControlTest('disconnect'))
@@ -115,9 +434,12 @@ suite.addTest(ControlTest('check_config'))
 suite.addTest(ControlTest('calculate_montage'))
 suite.addTest(ControlTest('bake'))
 suite.addTest(ControlTest('montage'))
+suite.addTest(ControlTest('pipeline_regrab'))
+suite.addTest(ControlTest('pipeline_error'))
 
 suite.addTest(MotionTest('connect'))
 suite.addTest(MotionTest('disconnect'))
 suite.addTest(MotionTest('check_config'))
 suite.addTest(MotionTest('move'))
+suite.addTest(MotionTest('batch_move'))
 suite.addTest(MotionTest('check_calibrate'))